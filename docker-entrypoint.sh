@@ -4,18 +4,26 @@ if [ -z "CHECK_INTERVAL" ]; then
   export CHECK_INTERVAL=300
 fi
 
+if [ -z "$RELOAD_INTERVAL" ]; then
+  export RELOAD_INTERVAL=60
+fi
+
 case "$1" in
     availability)
         exec python monitoring/availability.py \
             --endpoints-csv data/availability_service_targets.csv \
             --output out/availability_$(date +%Y%m%d_%H%M%S).csv \
-            --check-interval ${CHECK_INTERVAL}
+            --state out/availability.state.json \
+            --check-interval ${CHECK_INTERVAL} \
+            --reload-interval ${RELOAD_INTERVAL}
         ;;
     reliability)
         exec python monitoring/reliability.py \
             --endpoints-csv data/reliability_service_targets.csv \
             --output out/reliability_$(date +%Y%m%d_%H%M%S) \
-            --check-interval ${CHECK_INTERVAL}
+            --state out/reliability.state.json \
+            --check-interval ${CHECK_INTERVAL} \
+            --reload-interval ${RELOAD_INTERVAL}
         ;;
     *)
 esac
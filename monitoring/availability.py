@@ -1,34 +1,69 @@
+import asyncio
 import logging
-import csv
 from datetime import datetime
+from functools import partial
+import aiohttp
 import pytz
 import requests
-from monitoring.common import HTTPCheckResult, Monitor, get_service_urls
-
+from monitoring.client import (
+    DEFAULT_DNS_TIMEOUT,
+    DEFAULT_IDLE_TIMEOUT,
+    DEFAULT_POOL_SIZE,
+    CircuitOpenError,
+    is_dns_error,
+)
+from monitoring.checkpoint import DEFAULT_CHECKPOINT_INTERVAL
+from monitoring.common import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_FLUSH_INTERVAL,
+    DEFAULT_MAX_QUEUE,
+    OUTPUT_CSV,
+    OVERFLOW_SKIP,
+    PHASE_EVEN,
+    AsyncMonitor,
+    HTTPCheckResult,
+    Monitor,
+    TargetsWatcher,
+    get_service_urls,
+    wait_for_shutdown,
+)
+from monitoring.scheduler import OVERFLOW_POLICIES, PHASE_MODES
+from monitoring.sharding import parse_shard, run_shards, shard_output_path
+from monitoring.sinks import OUTPUT_FORMATS
 
 logger = logging.getLogger("availability_check")
 info, debug, error = logger.info, logger.debug, logger.error
 
+# Bodies up to this size are read, so the connection can be reused
+DRAIN_LIMIT = 65536
+
 
-def check_availability(url, url_id, output_path, csv_write_lock, timeout):
+def check_availability(url, url_id, sink, timeout, client, check_interval):
     """
-    Checks the availability of a URL, and appends the result to a CSV file.
+    Checks the availability of a URL, and queues the result for writing.
     URL's are verified using a streaming GET request - the connection is severed
     once the headers are received, to avoid impacting services with a sizeable
-    response content size.
+    response content size. Responses of up to `DRAIN_LIMIT` bytes are read
+    instead, so the connection goes back to the pool.
 
     Parameters:
           url(str) : The URL to check
           url_id(int) : The is written to file instead of the URL, for correlation.
-          output_path(str): The path of the CSV file to append the results to.
-          csv_write_lock (threading.Lock): Lock for writing to CSV.
+          sink(ResultSink): The sink to write the result to.
           timeout(float): The timeout in seconds for the GET requests - if `None`,
             defaults to `DEFAULT_CHECK_INTERVAL`.
+          client(HTTPClient): The shared HTTP client.
+          check_interval(float): The URL's current check interval, recorded
+            with the result.
+
+    Returns:
+        The `HTTPCheckResult`.
     """
 
     info(f"Checking {url}")
     try:
-        with requests.get(url, timeout=timeout, stream=True) as r:
+        with client.get(url, timeout=timeout, stream=True) as r:
             try:
                 content_length = int(r.headers["Content-Length"])
             except (KeyError, ValueError):
@@ -40,28 +75,187 @@ def check_availability(url, url_id, output_path, csv_write_lock, timeout):
                 content_type=r.headers.get("Content-Type"),
                 duration=r.elapsed.total_seconds(),
                 last_modified=r.headers.get("Last-Modified"),
+                **r.timings,
             )
+            if content_length is not None and content_length <= DRAIN_LIMIT:
+                try:
+                    r.content
+                except requests.exceptions.RequestException:
+                    pass  # The headers were received, which is what counts
     except requests.exceptions.Timeout:
         result = HTTPCheckResult(timeout=True)
-    except requests.exceptions.ConnectionError:
-        result = HTTPCheckResult(connection_error=True)
-
-    with csv_write_lock:
-        with open(output_path, "a") as f:
-            w = csv.writer(f, delimiter="\t")
-            w.writerow(
-                [
-                    datetime.now(pytz.UTC).isoformat(),
-                    url_id,
-                    result.status_code,
-                    result.content_length,
-                    result.content_type,
-                    result.duration,
-                    result.last_modified,
-                    1 if result.timeout else 0,
-                    1 if result.connection_error else 0,
-                ]
+    except CircuitOpenError:
+        result = HTTPCheckResult(connection_error=True, circuit_open=True)
+    except requests.exceptions.ConnectionError as e:
+        if is_dns_error(e):
+            result = HTTPCheckResult(connection_error=True, dns_error=True)
+        else:
+            result = HTTPCheckResult(connection_error=True)
+
+    sink.put(result_row(url_id, result, check_interval))
+    return result
+
+
+async def check_availability_async(
+    session, url, url_id, sink, timeout, check_interval, circuit_breaker=None
+):
+    """
+    Non-blocking variant of `check_availability`, for use with `AsyncMonitor`.
+
+    Parameters:
+          session(aiohttp.ClientSession): The session to issue the request with.
+          circuit_breaker(CircuitBreaker): If set, hosts whose circuit is open
+            are not requested.
+          (the others as for `check_availability`)
+    """
+
+    if circuit_breaker is not None and not circuit_breaker.allow(url):
+        result = HTTPCheckResult(connection_error=True, circuit_open=True)
+        sink.put(result_row(url_id, result, check_interval))
+        return result
+
+    info(f"Checking {url}")
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    timings = {}
+    try:
+        async with session.get(
+            url,
+            timeout=aiohttp.ClientTimeout(connect=timeout, sock_read=timeout),
+            trace_request_ctx=timings,
+        ) as r:
+            try:
+                content_length = int(r.headers["Content-Length"])
+            except (KeyError, ValueError):
+                content_length = None
+
+            result = HTTPCheckResult(
+                status_code=r.status,
+                content_length=content_length,
+                content_type=r.headers.get("Content-Type"),
+                duration=loop.time() - start,
+                last_modified=r.headers.get("Last-Modified"),
+                dns_duration=timings["dns_duration"],
+                connect_duration=timings["connect_duration"],
+                ttfb=timings["ttfb"],
             )
+            if content_length is not None and content_length <= DRAIN_LIMIT:
+                try:
+                    await r.read()
+                except (asyncio.TimeoutError, aiohttp.ClientError):
+                    pass  # The headers were received, which is what counts
+    except asyncio.TimeoutError:
+        result = HTTPCheckResult(timeout=True)
+    except aiohttp.ClientConnectionError as e:
+        if is_dns_error(e):
+            result = HTTPCheckResult(connection_error=True, dns_error=True)
+        else:
+            result = HTTPCheckResult(connection_error=True)
+    if circuit_breaker is not None:
+        failed = result.timeout or result.connection_error
+        circuit_breaker.record(url, failed=failed)
+
+    sink.put(result_row(url_id, result, check_interval))
+    return result
+
+
+def result_row(url_id, result, check_interval):
+    """
+    Returns:
+        The result row for a check, timestamped now (see `RESULT_SCHEMA`).
+    """
+    return [
+        datetime.now(pytz.UTC),
+        url_id,
+        result.status_code,
+        result.content_length,
+        result.content_type,
+        result.duration,
+        result.last_modified,
+        1 if result.timeout else 0,
+        1 if result.connection_error else 0,
+        check_interval,
+        result.dns_duration,
+        result.connect_duration,
+        result.tls_duration,
+        result.ttfb,
+        1 if result.dns_error else 0,
+        1 if result.circuit_open else 0,
+    ]
+
+
+def run_monitor(args, shard=None):
+    """
+    Runs the monitor configured by the command line arguments until SIGTERM
+    or SIGINT, checking only the endpoints of `shard` if set. A CSV output
+    file and the state file get a per-shard name (see `monitoring.sharding`).
+    """
+    read_urls = partial(get_service_urls, col_no=args.urls_col_no)
+    urls = read_urls(args.endpoints_csv)
+    watcher = None
+    if args.reload_interval:
+        watcher = TargetsWatcher(args.endpoints_csv, read_urls, args.reload_interval)
+    output_path = args.output
+    state_path = args.state
+    if shard is not None:
+        if args.output_format == OUTPUT_CSV:
+            output_path = shard_output_path(output_path, shard)
+        if state_path:
+            state_path = shard_output_path(state_path, shard)
+    if args.use_async:
+        monitor = AsyncMonitor(
+            service_urls=urls,
+            check_func=check_availability_async,
+            output_path=output_path,
+            check_interval=args.check_interval,
+            output_format=args.output_format,
+            batch_size=args.batch_size,
+            flush_interval=args.flush_interval,
+            pool_size=args.pool_size,
+            idle_timeout=args.idle_timeout,
+            dns_cache=args.dns_cache,
+            dns_timeout=args.dns_timeout,
+            max_per_host=args.max_per_host,
+            rate_per_host=args.rate_per_host,
+            circuit_threshold=args.circuit_threshold,
+            phase=args.phase,
+            jitter=args.jitter,
+            max_check_interval=args.max_check_interval,
+            concurrency=args.concurrency,
+            shard=shard,
+            watcher=watcher,
+            state_path=state_path,
+            checkpoint_interval=args.checkpoint_interval,
+        )
+    else:
+        monitor = Monitor(
+            service_urls=urls,
+            check_func=check_availability,
+            output_path=output_path,
+            check_interval=args.check_interval,
+            output_format=args.output_format,
+            batch_size=args.batch_size,
+            flush_interval=args.flush_interval,
+            pool_size=args.pool_size,
+            idle_timeout=args.idle_timeout,
+            dns_cache=args.dns_cache,
+            dns_timeout=args.dns_timeout,
+            max_per_host=args.max_per_host,
+            rate_per_host=args.rate_per_host,
+            circuit_threshold=args.circuit_threshold,
+            phase=args.phase,
+            jitter=args.jitter,
+            max_check_interval=args.max_check_interval,
+            max_workers=args.max_workers,
+            max_queue=args.max_queue,
+            overflow=args.overflow,
+            shard=shard,
+            watcher=watcher,
+            state_path=state_path,
+            checkpoint_interval=args.checkpoint_interval,
+        )
+    wait_for_shutdown(monitor.run())
+    monitor.close()
 
 
 if __name__ == "__main__":
@@ -75,22 +269,152 @@ if __name__ == "__main__":
     parser.add_argument(
         "--urls-col-no", default=0, type=int, help="URL's column number in the CSV file"
     )
+    parser.add_argument(
+        "--reload-interval",
+        type=float,
+        help="Reload the endpoints CSV when changed, checking it this often, in seconds",
+    )
+    parser.add_argument(
+        "--state",
+        help="Save the schedule to this file, and resume from it when restarted",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        default=DEFAULT_CHECKPOINT_INTERVAL,
+        type=float,
+        help="How often to save the schedule, in seconds, with --state",
+    )
     parser.add_argument(
         "--check-interval",
         default=300,
-        type=int,
+        type=float,
         help="Interval to check every endpoint at, in seconds. Defaults to 5 min.",
     )
+    parser.add_argument(
+        "--output-format",
+        default=OUTPUT_CSV,
+        choices=OUTPUT_FORMATS,
+        help="Append to a CSV file, or write day-partitioned Parquet files to "
+        "the --output directory",
+    )
+    parser.add_argument(
+        "--batch-size",
+        default=DEFAULT_BATCH_SIZE,
+        type=int,
+        help="Number of results written to the output file at once",
+    )
+    parser.add_argument(
+        "--flush-interval",
+        default=DEFAULT_FLUSH_INTERVAL,
+        type=float,
+        help="Maximum delay before a result is written to the output file, in seconds",
+    )
+    parser.add_argument(
+        "--pool-size",
+        default=DEFAULT_POOL_SIZE,
+        type=int,
+        help="Number of connections kept alive per host",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        default=DEFAULT_IDLE_TIMEOUT,
+        type=float,
+        help="Close connections to hosts not requested for this long, in seconds",
+    )
+    parser.add_argument(
+        "--dns-cache",
+        action="store_true",
+        default=False,
+        help="Cache DNS lookups in-process, for their TTL",
+    )
+    parser.add_argument(
+        "--dns-timeout",
+        default=DEFAULT_DNS_TIMEOUT,
+        type=float,
+        help="Maximum time for a DNS lookup, in seconds, with --dns-cache",
+    )
+    parser.add_argument(
+        "--max-per-host",
+        type=int,
+        help="Maximum number of concurrent checks per host",
+    )
+    parser.add_argument(
+        "--rate-per-host",
+        type=float,
+        help="Maximum number of checks per second per host",
+    )
+    parser.add_argument(
+        "--circuit-threshold",
+        type=int,
+        help="Fail fast for a host after this many consecutive failed checks, "
+        "probing it once per check interval until it responds again",
+    )
+    parser.add_argument(
+        "--phase",
+        default=PHASE_EVEN,
+        choices=PHASE_MODES,
+        help="How to spread the checks over the interval: evenly, by URL hash, or not at all",
+    )
+    parser.add_argument(
+        "--jitter",
+        default=0,
+        type=float,
+        help="Maximum random shift of each check, in seconds",
+    )
+    parser.add_argument(
+        "--max-check-interval",
+        type=float,
+        help="Adapt each endpoint's interval to its results, backing off up to "
+        "this many seconds while it is down",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        default=False,
+        help="Run all checks from a single event loop instead of a thread per check",
+    )
+    parser.add_argument(
+        "--concurrency",
+        default=DEFAULT_CONCURRENCY,
+        type=int,
+        help="Maximum number of checks in flight, in --async mode",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        help="Run checks on a fixed pool of this many threads, instead of a thread per check",
+    )
+    parser.add_argument(
+        "--max-queue",
+        default=DEFAULT_MAX_QUEUE,
+        type=int,
+        help="Maximum number of checks waiting for a worker, with --max-workers",
+    )
+    parser.add_argument(
+        "--overflow",
+        default=OVERFLOW_SKIP,
+        choices=OVERFLOW_POLICIES,
+        help="What to do with new checks once the queue is full, with --max-workers",
+    )
+    sharding = parser.add_mutually_exclusive_group()
+    sharding.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="Only check the endpoints of shard i out of N (from 0), given as i/N",
+    )
+    sharding.add_argument(
+        "--processes",
+        default=1,
+        type=int,
+        help="Split the endpoints across this many processes",
+    )
 
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO, format="%(message)s")
     logging.getLogger("schedule").setLevel(logging.WARNING)
 
-    urls = get_service_urls(args.endpoints_csv, col_no=args.urls_col_no)
-    monitor = Monitor(
-        service_urls=urls,
-        check_func=check_availability,
-        output_path=args.output,
-        check_interval=args.check_interval,
-    )
-    monitor.run()
+    if args.processes > 1:
+        run_shards(args.processes, run_monitor, args)
+    else:
+        run_monitor(args, args.shard)
@@ -0,0 +1,476 @@
+import asyncio
+import io
+import json
+import logging
+import multiprocessing
+import random
+import resource
+import signal
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+import attr
+from aiohttp import web
+
+from monitoring.availability import check_availability, check_availability_async
+from monitoring.common import AsyncMonitor, Monitor
+from monitoring.reliability import ReliabilityMonitor, check_reliability
+
+logger = logging.getLogger("benchmark")
+info, debug, error = logger.info, logger.debug, logger.error
+
+MONITOR_THREADED = "threaded"
+MONITOR_ASYNC = "async"
+MONITOR_RELIABILITY = "reliability"
+MONITOR_TYPES = (MONITOR_THREADED, MONITOR_ASYNC, MONITOR_RELIABILITY)
+
+ENDPOINT_KINDS = ("ok", "slow", "flap", "timeout", "zip", "atom")
+DEFAULT_MIX = "ok=80,slow=8,flap=5,timeout=2,zip=2,atom=3"
+DEFAULT_BASE_PORT = 18000
+
+ATOM_FEED = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Benchmark download service {n}</title>
+  <id>{base}/atom/{n}</id>
+  <updated>2018-01-01T00:00:00Z</updated>
+{entries}
+</feed>
+"""
+ATOM_ENTRY = """  <entry>
+    <title>Dataset {i}</title>
+    <id>{base}/zip/{n}-{i}</id>
+    <link rel="alternate" type="application/zip" href="{base}/zip/{n}-{i}"/>
+    <updated>2018-01-01T00:00:00Z</updated>
+  </entry>"""
+
+
+@attr.s
+class FarmConfig:
+    """
+    Behaviour of the fake endpoints.
+
+    Parameters:
+        hosts(int): Number of hosts, 127.0.0.1 to 127.0.0.<hosts>, each served
+            by its own process.
+        base_port(int): The hosts listen on `base_port + host number`.
+        slow_delay(float): Response delay of the `slow` endpoints, in seconds.
+        timeout_delay(float): Response delay of the `timeout` endpoints, in
+            seconds - should be longer than the monitor's timeout.
+        flap_period(float): The `flap` endpoints alternate between 200 and
+            503 responses every this many seconds.
+        zip_size(int): Size of the `zip` endpoints' archive, in bytes.
+        atom_entries(int): Number of entries of the `atom` endpoints' feeds.
+    """
+
+    hosts = attr.ib(default=4)
+    base_port = attr.ib(default=DEFAULT_BASE_PORT)
+    slow_delay = attr.ib(default=2.0)
+    timeout_delay = attr.ib(default=20.0)
+    flap_period = attr.ib(default=30.0)
+    zip_size = attr.ib(default=5 * 2 ** 20)
+    atom_entries = attr.ib(default=10)
+
+    def base_url(self, host_no):
+        return f"http://127.0.0.{host_no + 1}:{self.base_port + host_no}"
+
+
+def make_zip(size):
+    """
+    Returns:
+        A ZIP archive of about `size` bytes, with incompressible content.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        archive.writestr("data.gml", random.Random(0).getrandbits(8 * size).to_bytes(size, "big"))
+    return buffer.getvalue()
+
+
+def make_app(config, base_url):
+    """
+    Returns:
+        The `aiohttp.web.Application` serving the fake endpoints of a host,
+        at `/<kind>/<n>` for each of `ENDPOINT_KINDS`.
+    """
+    zip_content = make_zip(config.zip_size)
+
+    async def ok(request):
+        return web.Response(text="OK", content_type="text/plain")
+
+    async def slow(request):
+        await asyncio.sleep(config.slow_delay)
+        return web.Response(text="OK", content_type="text/plain")
+
+    async def flap(request):
+        n = int(request.match_info["n"])
+        up = (int(time.time() / config.flap_period) + n) % 2 == 0
+        return web.Response(status=200 if up else 503, text="OK" if up else "Down")
+
+    async def timeout(request):
+        await asyncio.sleep(config.timeout_delay)
+        return web.Response(text="Too late", content_type="text/plain")
+
+    async def zip_file(request):
+        return web.Response(
+            body=zip_content,
+            content_type="application/zip",
+            headers={"Last-Modified": "Mon, 01 Jan 2018 00:00:00 GMT"},
+        )
+
+    async def atom(request):
+        n = request.match_info["n"]
+        entries = "\n".join(
+            ATOM_ENTRY.format(base=base_url, n=n, i=i) for i in range(config.atom_entries)
+        )
+        return web.Response(
+            text=ATOM_FEED.format(base=base_url, n=n, entries=entries),
+            content_type="application/atom+xml",
+        )
+
+    app = web.Application()
+    app.router.add_get("/ok/{n}", ok)
+    app.router.add_get("/slow/{n}", slow)
+    app.router.add_get("/flap/{n}", flap)
+    app.router.add_get("/timeout/{n}", timeout)
+    app.router.add_get("/zip/{n}", zip_file)
+    app.router.add_get("/atom/{n}", atom)
+    return app
+
+
+def serve_host(config, host_no, ready):
+    """
+    Serves the fake endpoints of a host until SIGTERM.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    runner = web.AppRunner(make_app(config, config.base_url(host_no)), access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(
+        runner, f"127.0.0.{host_no + 1}", config.base_port + host_no, backlog=4096
+    )
+    loop.run_until_complete(site.start())
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    ready.set()
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+
+class ServerFarm:
+    """
+    Runs the fake endpoints, in a process per host so the servers do not
+    compete with the monitor for the GIL. Use as a context manager.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.processes = []
+
+    def __enter__(self):
+        for host_no in range(self.config.hosts):
+            ready = multiprocessing.Event()
+            process = multiprocessing.Process(
+                target=serve_host, args=(self.config, host_no, ready), daemon=True
+            )
+            process.start()
+            if not ready.wait(30):
+                raise RuntimeError(f"Fake host {host_no} did not start")
+            self.processes.append(process)
+        return self
+
+    def __exit__(self, *exc_info):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+
+def parse_mix(value):
+    """
+    Parses an endpoint mix like `ok=80,slow=20`.
+
+    Returns:
+        A dict of the weight of each endpoint kind.
+    """
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ENDPOINT_KINDS:
+            raise ValueError(f"Unknown endpoint kind: {kind}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def make_targets(count, mix, config):
+    """
+    Returns:
+        `count` distinct target URL's, spread over the hosts, and of each
+        endpoint kind in proportion to its weight in `mix`.
+    """
+    rng = random.Random(count)
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=count)
+    return [
+        f"{config.base_url(n % config.hosts)}/{kind}/{n}" for n, kind in enumerate(kinds)
+    ]
+
+
+def counted(check_func, counter):
+    """
+    Wraps a check function to count completed checks in `counter`, a
+    `multiprocessing.Value`. Coroutine functions stay coroutine functions.
+    """
+    if asyncio.iscoroutinefunction(check_func):
+
+        async def check(**kwargs):
+            result = await check_func(**kwargs)
+            with counter.get_lock():
+                counter.value += 1
+            return result
+
+    else:
+
+        def check(**kwargs):
+            result = check_func(**kwargs)
+            with counter.get_lock():
+                counter.value += 1
+            return result
+
+    return check
+
+
+def process_stats():
+    """
+    Returns:
+        The current process' CPU time in seconds, resident set size in MB and
+        number of threads.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    status = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            status[name] = value.split()
+    return (
+        usage.ru_utime + usage.ru_stime,
+        int(status["VmRSS"][0]) / 1024,
+        int(status["Threads"][0]),
+    )
+
+
+def run_monitor(args, urls, work_dir, counter, results):
+    """
+    Runs a monitor against the targets for the warmup and measurement period,
+    then puts its figures in the `results` queue.
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("urllib3").setLevel(logging.ERROR)
+    if args.monitor == MONITOR_RELIABILITY:
+        services_csv = work_dir / "services.csv"
+        services_csv.write_text("".join(f"BM\tGSDS\t{url}\n" for url in urls))
+        monitor = ReliabilityMonitor(
+            services_csv=str(services_csv),
+            check_func=counted(check_reliability, counter),
+            output_dir=str(work_dir / "reliability"),
+            check_interval=args.check_interval,
+            timeout=args.timeout,
+            pool_size=args.pool_size,
+            max_workers=args.max_workers,
+        )
+    elif args.monitor == MONITOR_ASYNC:
+        monitor = AsyncMonitor(
+            service_urls=urls,
+            check_func=counted(check_availability_async, counter),
+            output_path=str(work_dir / "availability.csv"),
+            check_interval=args.check_interval,
+            timeout=args.timeout,
+            pool_size=args.pool_size,
+            concurrency=args.concurrency,
+        )
+    else:
+        monitor = Monitor(
+            service_urls=urls,
+            check_func=counted(check_availability, counter),
+            output_path=str(work_dir / "availability.csv"),
+            check_interval=args.check_interval,
+            timeout=args.timeout,
+            pool_size=args.pool_size,
+            max_workers=args.max_workers,
+        )
+
+    stop = monitor.run()
+    time.sleep(args.warmup)
+    monitor.lag_stats.reset()
+    checks_start = counter.value
+    cpu_start, _, _ = process_stats()
+    start = time.monotonic()
+    max_rss = max_threads = 0
+    while time.monotonic() - start < args.duration:
+        time.sleep(1)
+        _, rss, threads = process_stats()
+        max_rss, max_threads = max(max_rss, rss), max(max_threads, threads)
+    elapsed = time.monotonic() - start
+    cpu_end, _, _ = process_stats()
+    checks = counter.value - checks_start
+    lag = monitor.lag_stats.stats()
+    stop.set()
+    if hasattr(monitor, "close"):
+        monitor.close()
+
+    results.put(
+        {
+            "monitor": args.monitor,
+            "targets": len(urls),
+            "expected_rate": len(urls) / args.check_interval,
+            "check_rate": checks / elapsed,
+            "lag_p50": lag["p50"],
+            "lag_p95": lag["p95"],
+            "lag_max": lag["max"],
+            "missed": lag["missed"],
+            "cpu": (cpu_end - cpu_start) / elapsed,
+            "max_rss_mb": max_rss,
+            "max_threads": max_threads,
+        }
+    )
+
+
+def benchmark(args, count, config):
+    """
+    Runs a monitor against `count` targets in a fresh process, so each run
+    starts with a clean heap and thread count.
+
+    Returns:
+        A dict with the run's figures.
+    """
+    urls = make_targets(count, parse_mix(args.mix), config)
+    counter = multiprocessing.Value("l", 0)
+    results = multiprocessing.Queue()
+    with tempfile.TemporaryDirectory() as work_dir:
+        process = multiprocessing.Process(
+            target=run_monitor, args=(args, urls, Path(work_dir), counter, results)
+        )
+        process.start()
+        result = results.get(timeout=args.warmup + args.duration + 60)
+        process.join(args.timeout + 10)
+        if process.is_alive():
+            process.terminate()
+    return result
+
+
+def format_result(result):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.0f}"
+
+    return (
+        f"{result['monitor']:>11} {result['targets']:>7} "
+        f"{result['expected_rate']:>9.1f} {result['check_rate']:>9.1f} "
+        f"{ms(result['lag_p50']):>8} {ms(result['lag_p95']):>8} {ms(result['lag_max']):>8} "
+        f"{result['missed']:>7} "
+        f"{result['cpu'] * 100:>6.0f} {result['max_rss_mb']:>8.0f} {result['max_threads']:>8}"
+    )
+
+
+def raise_fd_limit():
+    """
+    Raises the open files limit to the hard limit, as thousands of targets
+    need thousands of sockets.
+    """
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the monitors against a farm of local fake "
+        "endpoints (Linux only: uses 127.0.0.x loopback addresses and /proc)"
+    )
+    parser.add_argument(
+        "--targets",
+        default="1000,5000,10000,50000",
+        help="Comma separated numbers of targets to benchmark with",
+    )
+    parser.add_argument(
+        "--monitor",
+        default=MONITOR_THREADED,
+        choices=MONITOR_TYPES,
+        help="The monitor to benchmark",
+    )
+    parser.add_argument(
+        "--mix",
+        default=DEFAULT_MIX,
+        help=f"Relative weights of the endpoint kinds ({', '.join(ENDPOINT_KINDS)})",
+    )
+    parser.add_argument(
+        "--check-interval",
+        default=60,
+        type=float,
+        help="Interval to check every target at, in seconds",
+    )
+    parser.add_argument(
+        "--timeout", default=10, type=float, help="Check timeout, in seconds"
+    )
+    parser.add_argument(
+        "--warmup",
+        default=10,
+        type=float,
+        help="Seconds to run before measuring",
+    )
+    parser.add_argument(
+        "--duration", default=60, type=float, help="Seconds to measure for"
+    )
+    parser.add_argument(
+        "--pool-size", default=10, type=int, help="Connections kept alive per host"
+    )
+    parser.add_argument(
+        "--max-workers", type=int, help="Worker pool size of the threaded monitors"
+    )
+    parser.add_argument(
+        "--concurrency",
+        default=500,
+        type=int,
+        help="Maximum checks in flight of the async monitor",
+    )
+    parser.add_argument(
+        "--hosts", default=4, type=int, help="Number of fake hosts (and server processes)"
+    )
+    parser.add_argument(
+        "--base-port",
+        default=DEFAULT_BASE_PORT,
+        type=int,
+        help="Fake host n listens on this port + n",
+    )
+    parser.add_argument(
+        "--zip-size",
+        default=5,
+        type=float,
+        help="Size of the fake ZIP downloads, in MB",
+    )
+    parser.add_argument(
+        "--output", help="Append the results to this file, as JSON lines"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    raise_fd_limit()
+
+    config = FarmConfig(
+        hosts=args.hosts,
+        base_port=args.base_port,
+        timeout_delay=args.timeout * 2,
+        zip_size=int(args.zip_size * 2 ** 20),
+    )
+    with ServerFarm(config):
+        info(
+            f"{'monitor':>11} {'targets':>7} {'expected':>9} {'checks/s':>9} "
+            f"{'lag p50':>8} {'lag p95':>8} {'lag max':>8} {'missed':>7} "
+            f"{'cpu %':>6} {'rss MB':>8} {'threads':>8}"
+        )
+        for count in (int(n) for n in args.targets.split(",")):
+            result = benchmark(args, count, config)
+            info(format_result(result))
+            if args.output:
+                with open(args.output, "a") as f:
+                    f.write(json.dumps(result) + "\n")
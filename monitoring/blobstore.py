@@ -0,0 +1,206 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from functools import partial
+from pathlib import Path
+
+logger = logging.getLogger("blobstore")
+info, debug, error = logger.info, logger.debug, logger.error
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_COMPRESS_LEVEL = 6
+BLOBS_DIR_NAME = "blobs"  # In a reliability monitor's output directory
+MANIFEST_FILE_NAME = "manifest.json"  # In each snapshot directory
+DIFF_FILE_NAME = "diff"  # Diff with the previous snapshot, not part of it
+
+
+def file_digest(path):
+    """
+    Returns:
+        The SHA-256 digest of a file, read in chunks.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(partial(f.read, CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class BlobStore:
+    """
+    Content-addressed store of files, compressed with gzip at rest. Each
+    distinct content is stored once, under its SHA-256 digest, however many
+    times and under whatever names it is added.
+
+    Blobs are written to a temporary file and moved into place, so several
+    processes can share a store, and a blob is never seen half written.
+
+    Parameters:
+        root_dir(Path): The directory of the store. Created if need be.
+        compress_level(int): The gzip compression level, from 1 to 9.
+    """
+
+    def __init__(self, root_dir, compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.root_dir = Path(root_dir)
+        self.compress_level = compress_level
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, digest):
+        return self.root_dir / digest[:2] / f"{digest}.gz"
+
+    def __contains__(self, digest):
+        return self.path(digest).exists()
+
+    def put(self, path):
+        """
+        Adds a file to the store, unless its content already is.
+
+        Returns:
+            The digest of the file, to read it back with `open`.
+        """
+        digest = file_digest(path)
+        if digest in self:
+            debug(f"Blob {digest} already stored")
+            return digest
+        blob_path = self.path(digest)
+        blob_path.parent.mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(blob_path.parent), suffix=".tmp")
+        try:
+            with open(path, "rb") as f, open(fd, "wb") as tmp:
+                with gzip.GzipFile(
+                    fileobj=tmp, mode="wb", compresslevel=self.compress_level
+                ) as gz:
+                    shutil.copyfileobj(f, gz, CHUNK_SIZE)
+            os.replace(tmp_path, str(blob_path))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return digest
+
+    def open(self, digest):
+        """
+        Returns:
+            The content of a blob, as a binary file object decompressed as it
+            is read.
+        """
+        return gzip.open(str(self.path(digest)), "rb")
+
+
+def write_manifest(snapshot_dir, entries):
+    """
+    Writes the manifest of a snapshot, which refers to the blobs of its files
+    instead of holding copies.
+
+    Parameters:
+        snapshot_dir(Path): The snapshot directory.
+        entries(list): A dict per file of the snapshot, with its `name`, the
+            digest of its `blob`, and possibly more about it.
+    """
+    with open(Path(snapshot_dir) / MANIFEST_FILE_NAME, "w") as f:
+        json.dump({"files": entries}, f, indent=2)
+
+
+def read_manifest(snapshot_dir):
+    """
+    Returns:
+        The manifest entry of each file of a snapshot, by file name, or `None`
+        if the snapshot has no manifest, its files being stored as plain
+        copies.
+    """
+    try:
+        with open(Path(snapshot_dir) / MANIFEST_FILE_NAME) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    return {entry["name"]: entry for entry in manifest["files"]}
+
+
+def open_snapshot_file(snapshot_dir, file_name, blobs):
+    """
+    Returns:
+        A file of a snapshot, as a binary file object, whether it is stored in
+        `blobs` or as a plain copy in the snapshot directory. A snapshot with
+        a single file in its manifest returns it whatever its name, e.g. for
+        a ZIP archive of several files reduced to one.
+
+    Raises:
+        KeyError: The snapshot has no such file.
+        FileNotFoundError: Idem, for a snapshot of plain copies.
+    """
+    entries = read_manifest(snapshot_dir)
+    if entries is None:
+        return open(Path(snapshot_dir) / file_name, "rb")
+    entry = entries.get(file_name)
+    if entry is None and len(entries) == 1:
+        entry = next(iter(entries.values()))
+    if entry is None:
+        raise KeyError(f"No {file_name} in snapshot {snapshot_dir}")
+    return blobs.open(entry["blob"])
+
+
+def snapshot_file_names(snapshot_dir):
+    """
+    Returns:
+        The names of the files of a snapshot: those of its manifest, or for
+        snapshots of previous versions, the plain copies in its directory.
+    """
+    entries = read_manifest(snapshot_dir)
+    if entries is not None:
+        return list(entries)
+    return sorted(
+        path.name
+        for path in Path(snapshot_dir).iterdir()
+        if path.is_file() and path.name != DIFF_FILE_NAME
+    )
+
+
+def extract_snapshot(snapshot_dir, blobs, dest_dir):
+    """
+    Writes the files of a snapshot to a directory, whether they are stored
+    in `blobs` or as plain copies in the snapshot directory.
+
+    Returns:
+        The number of files written.
+    """
+    dest_dir = Path(dest_dir)
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    extracted = 0
+    for file_name in snapshot_file_names(snapshot_dir):
+        if Path(file_name).is_absolute() or ".." in Path(file_name).parts:
+            error(f"Skipping {file_name}, outside of {dest_dir}")
+            continue
+        (dest_dir / file_name).parent.mkdir(parents=True, exist_ok=True)
+        with open_snapshot_file(snapshot_dir, file_name, blobs) as f, open(
+            dest_dir / file_name, "wb"
+        ) as out:
+            shutil.copyfileobj(f, out, CHUNK_SIZE)
+        info(f"Extracted {dest_dir / file_name}")
+        extracted += 1
+    if not extracted:
+        error(f"No files extracted from {snapshot_dir}")
+    return extracted
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Extract the files of a reliability snapshot from the blob store"
+    )
+    parser.add_argument("snapshot_dir", help="Snapshot directory, with a manifest.json")
+    parser.add_argument("dest_dir", help="Directory to write the files to")
+    parser.add_argument(
+        "--blobs",
+        help="Blob store directory, by default the blobs directory of the "
+        "monitor's output directory the snapshot is in",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    blobs_dir = args.blobs or Path(args.snapshot_dir).resolve().parents[2] / BLOBS_DIR_NAME
+    if not extract_snapshot(args.snapshot_dir, BlobStore(blobs_dir), args.dest_dir):
+        parser.exit(1)
@@ -0,0 +1,108 @@
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger("checkpoint")
+info, debug, error = logger.info, logger.debug, logger.error
+
+DEFAULT_CHECKPOINT_INTERVAL = 60
+STATE_VERSION = 1
+
+
+def monotonic_to_wall(value):
+    """
+    Returns:
+        The `time.time()` value of a `time.monotonic()` value, or `None`.
+    """
+    if value is None:
+        return None
+    return value + time.time() - time.monotonic()
+
+
+class Checkpoint:
+    """
+    Saves the schedule of a monitor's jobs to a JSON file, so that a
+    restarted monitor picks up where it left off: each job resumes at its
+    saved next run time and interval, and the results keep going to the
+    same location.
+
+    Times are saved as wall clock times, as monotonic times do not survive
+    a restart. Runs missed while the monitor was down are skipped, keeping
+    each job's phase, so a restart does not trigger a burst of checks.
+
+    The file is replaced atomically, so a monitor killed while saving leaves
+    the previous state intact.
+
+    Parameters:
+        path(str): The state file. Need not exist yet.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable state file {self.path}: {e}")
+            return {}
+        if state.get("version") != STATE_VERSION:
+            logger.warning(f"Ignoring state file {self.path} of another version")
+            return {}
+        info(f"Resuming from {self.path}, saved at {time.ctime(state['saved_at'])}")
+        return state
+
+    def get(self, name, default=None):
+        """
+        Returns:
+            A value saved along with the jobs, e.g. the results location.
+        """
+        return self.state.get(name, default)
+
+    def job(self, key):
+        """
+        Returns:
+            The saved state of a job, as passed to `save`, or `None`.
+        """
+        return self.state.get("jobs", {}).get(str(key))
+
+    def resume(self, key):
+        """
+        Returns:
+            The `(offset, interval)` to reschedule a job with, in seconds, or
+            `None` if the job was not saved.
+        """
+        job = self.job(key)
+        if job is None:
+            return None
+        interval = job["interval"]
+        offset = job["next_run"] - time.time()
+        if offset < 0:
+            offset %= interval  # Skip the missed runs
+        return min(offset, interval), interval
+
+    def save(self, jobs, **values):
+        """
+        Writes the state file.
+
+        Parameters:
+            jobs(dict): By job key, a dict with at least the job's `next_run`
+                (wall clock time) and `interval`.
+            values: Other values to save, read back with `get`.
+        """
+        state = dict(values)
+        state["version"] = STATE_VERSION
+        state["saved_at"] = time.time()
+        state["jobs"] = {str(key): job for key, job in jobs.items()}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.state = state
@@ -0,0 +1,757 @@
+import asyncio
+import ipaddress
+import logging
+import socket
+import threading
+import time
+from collections import Counter
+from functools import partial
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import aiohttp
+import aiohttp.abc
+import dns.exception
+import dns.resolver
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+logger = logging.getLogger("http_client")
+info, debug, error = logger.info, logger.debug, logger.error
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_HOSTS = 1000
+DEFAULT_IDLE_TIMEOUT = 600
+DEFAULT_DNS_TIMEOUT = 5
+DEFAULT_DNS_TTL = 300
+DEFAULT_CIRCUIT_THRESHOLD = 5
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def host_key(url):
+    """
+    Returns:
+        The `(scheme, host, port)` tuple identifying the connection pool for a URL.
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    return scheme, (parts.hostname or "").lower(), parts.port or DEFAULT_PORTS.get(scheme)
+
+
+def resolve(host, port):
+    """
+    Returns:
+        The IP addresses of a host, in resolver order.
+    """
+    addresses = []
+    for _, _, _, _, sockaddr in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        if sockaddr[0] not in addresses:
+            addresses.append(sockaddr[0])
+    return addresses
+
+
+class DNSCache:
+    """
+    In-process DNS cache, shared by all checks of a monitor. Lookups go to
+    the configured nameservers directly, with a bounded `timeout`, and
+    answers are kept for their record TTL (clamped to `min_ttl`..`max_ttl`).
+    Names the nameservers do not know (e.g. from the hosts file) fall back
+    to the system resolver, and are kept for `default_ttl`.
+
+    If a lookup fails, an expired entry is served instead, if there is one,
+    so that a resolver hiccup does not fail the checks. Otherwise the failure
+    is cached for `negative_ttl`.
+
+    Parameters:
+        timeout(float): Maximum time in seconds for a lookup.
+        default_ttl(float): TTL for answers of the system resolver.
+        min_ttl(float): Minimum TTL.
+        max_ttl(float): Maximum TTL.
+        negative_ttl(float): TTL for failed lookups.
+    """
+
+    def __init__(
+        self,
+        timeout=DEFAULT_DNS_TIMEOUT,
+        default_ttl=DEFAULT_DNS_TTL,
+        min_ttl=5,
+        max_ttl=3600,
+        negative_ttl=30,
+    ):
+        self.resolver = dns.resolver.Resolver()
+        self.resolver.lifetime = timeout
+        self.default_ttl = default_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.entries = {}  # host -> (addresses or `None` if failed, expiry time)
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """
+        Same as the module level `resolve`, from the cache.
+
+        Raises:
+            socket.gaierror: if the lookup failed.
+        """
+        try:
+            ipaddress.ip_address(host)
+            return [host]
+        except ValueError:
+            pass
+
+        now = time.monotonic()
+        with self.lock:
+            addresses, expires = self.entries.get(host, (None, None))
+            if expires is not None and expires > now:
+                self.counters["hits"] += 1
+                if addresses is None:
+                    raise socket.gaierror(f"Lookup of {host} failed recently")
+                return addresses
+            self.counters["misses"] += 1
+
+        try:
+            addresses, ttl = self._lookup(host, port)
+        except (dns.exception.DNSException, socket.gaierror) as e:
+            with self.lock:
+                if addresses is not None:
+                    self.counters["stale"] += 1
+                    logger.warning(f"Lookup of {host} failed, using stale addresses: {e}")
+                    return addresses
+                self.counters["errors"] += 1
+                self.entries[host] = (None, now + self.negative_ttl)
+            raise socket.gaierror(f"Lookup of {host} failed: {e}")
+
+        ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+        with self.lock:
+            self.entries[host] = (addresses, now + ttl)
+        return addresses
+
+    def _lookup(self, host, port):
+        """
+        Returns:
+            The addresses of a host, and their TTL.
+        """
+        try:
+            answer = self.resolver.query(host, "A")
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            return resolve(host, port), self.default_ttl
+        return [record.address for record in answer], answer.rrset.ttl
+
+    def stats(self):
+        """
+        Returns:
+            A dict with the numbers of cache hits, misses, stale answers served
+            and failed lookups so far, and the number of cached hosts.
+        """
+        with self.lock:
+            stats = {
+                name: self.counters[name]
+                for name in ("hits", "misses", "stale", "errors")
+            }
+            stats["hosts"] = len(self.entries)
+        return stats
+
+
+class CachedResolver(aiohttp.abc.AbstractResolver):
+    """
+    aiohttp resolver looking up hosts through a `DNSCache`.
+    """
+
+    def __init__(self, dns_cache):
+        self.dns_cache = dns_cache
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        loop = asyncio.get_event_loop()
+        addresses = await loop.run_in_executor(None, self.dns_cache.resolve, host, port)
+        return [
+            {
+                "hostname": host,
+                "host": address,
+                "port": port,
+                "family": socket.AF_INET6 if ":" in address else socket.AF_INET,
+                "proto": 0,
+                "flags": socket.AI_NUMERICHOST,
+            }
+            for address in addresses
+        ]
+
+    async def close(self):
+        pass
+
+
+class DNSResolutionError(NewConnectionError):
+    """
+    Raised when the host of a URL could not be resolved.
+    """
+
+
+def is_dns_error(exc):
+    """
+    Returns:
+        Whether a `requests` or `aiohttp` connection error was caused by a
+        failed DNS lookup.
+    """
+    if isinstance(exc, aiohttp.ClientConnectorError):
+        return isinstance(exc.os_error, socket.gaierror)
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return isinstance(reason, DNSResolutionError)
+
+
+class TimedConnectionMixin:
+    """
+    Times the phases of opening a connection: DNS lookup, TCP connect and,
+    for HTTPS, the TLS handshake. The durations (in seconds) are `None` for
+    phases that did not take place.
+
+    Hosts are looked up with `resolver`, set by the connection pool.
+    """
+
+    dns_duration = None
+    connect_duration = None
+    tls_duration = None
+    resolver = staticmethod(resolve)
+
+    def _new_conn(self):
+        host = self._dns_host
+        start = time.perf_counter()
+        try:
+            addresses = self.resolver(host, self.port)
+        except socket.gaierror as e:
+            raise DNSResolutionError(self, f"Failed to resolve {host}: {e}")
+        resolved = time.perf_counter()
+
+        # Connect to the resolved addresses, so DNS is not timed again
+        try:
+            for address in addresses:
+                self._dns_host = address
+                try:
+                    sock = super()._new_conn()
+                    break
+                except ConnectTimeoutError:  # Also covers NewConnectionError
+                    if address == addresses[-1]:
+                        raise
+        finally:
+            self._dns_host = host
+
+        self.dns_duration = resolved - start
+        self.connect_duration = time.perf_counter() - resolved
+        return sock
+
+    def pop_timings(self):
+        """
+        Returns:
+            The phase durations of the last connection opened, as a dict. Later
+            calls return `None` durations until a new connection is opened, as
+            for a reused connection.
+        """
+        timings = {
+            "dns_duration": self.dns_duration,
+            "connect_duration": self.connect_duration,
+            "tls_duration": self.tls_duration,
+        }
+        self.dns_duration = self.connect_duration = self.tls_duration = None
+        return timings
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        self.tls_duration = (
+            time.perf_counter() - start - self.dns_duration - self.connect_duration
+        )
+
+
+class TimedPoolMixin:
+    """
+    Connection pool handing its `resolver` to the connections it opens.
+    """
+
+    def __init__(self, *args, resolver=resolve, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.resolver = resolver
+
+    def _new_conn(self):
+        conn = super()._new_conn()
+        conn.resolver = self.resolver
+        return conn
+
+
+class TimedHTTPConnectionPool(TimedPoolMixin, HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(TimedPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    `HTTPAdapter` that sets `timings` on each response: a dict with the
+    durations of the DNS lookup, TCP connect and TLS handshake (`None` when
+    the connection was reused), and the time to first byte - from sending the
+    request, to having received the response headers.
+
+    Parameters:
+        resolver(callable): Looks up hosts, with the signature of `resolve`.
+        (the others as for `HTTPAdapter`)
+    """
+
+    def __init__(self, *args, resolver=resolve, **kwargs):
+        self.resolver = resolver
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": partial(TimedHTTPConnectionPool, resolver=self.resolver),
+            "https": partial(TimedHTTPSConnectionPool, resolver=self.resolver),
+        }
+
+    def send(self, request, *args, **kwargs):
+        start = time.perf_counter()
+        response = super().send(request, *args, **kwargs)
+        headers_received = time.perf_counter()
+        connection = getattr(response.raw, "_connection", None)
+        if isinstance(connection, TimedConnectionMixin):
+            timings = connection.pop_timings()
+        else:
+            timings = {"dns_duration": None, "connect_duration": None, "tls_duration": None}
+        setup = sum(d for d in timings.values() if d is not None)
+        timings["ttfb"] = headers_received - start - setup
+        response.timings = timings
+        return response
+
+
+def timing_trace_config():
+    """
+    Returns:
+        An `aiohttp.TraceConfig` that fills in the `trace_request_ctx` dict of
+        a request with the durations of its DNS lookup, connection setup (TCP
+        connect and TLS handshake together, as aiohttp does not tell them
+        apart) and time to first byte. Phases that did not take place, e.g.
+        for a reused connection, are left as `None`.
+    """
+    trace_config = aiohttp.TraceConfig()
+
+    def on(event, action):
+        async def handler(session, context, params):
+            action(context.trace_request_ctx, asyncio.get_event_loop().time())
+
+        getattr(trace_config, event).append(handler)
+
+    def start(ctx, now):
+        ctx.update(
+            dns_duration=None,
+            connect_duration=None,
+            tls_duration=None,
+            ttfb=None,
+            start=now,
+        )
+
+    def mark(name):
+        def action(ctx, now):
+            ctx[name] = now
+
+        return action
+
+    def dns_end(ctx, now):
+        ctx["dns_duration"] = now - ctx["dns_start"]
+
+    def connect_end(ctx, now):
+        # The DNS lookup happens while creating the connection
+        ctx["connect_duration"] = now - ctx["connect_start"] - (ctx["dns_duration"] or 0)
+
+    def end(ctx, now):
+        setup = (ctx["dns_duration"] or 0) + (ctx["connect_duration"] or 0)
+        ctx["ttfb"] = now - ctx["start"] - setup
+
+    on("on_request_start", start)
+    on("on_connection_create_start", mark("connect_start"))
+    on("on_dns_resolvehost_start", mark("dns_start"))
+    on("on_dns_resolvehost_end", dns_end)
+    on("on_connection_create_end", connect_end)
+    on("on_request_end", end)
+    return trace_config
+
+
+def politeness_key(url):
+    """
+    Returns:
+        The host name of a URL, to which politeness limits apply.
+    """
+    return (urlsplit(url).hostname or "").lower()
+
+
+class TokenBucket:
+    """
+    Refills `rate` tokens per second, up to `burst`. Tokens are taken ahead
+    of time: `take` always succeeds, and returns how long to wait before the
+    token may be used, so waiters are served in order. Not thread-safe.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """
+        Returns:
+            The delay in seconds before the taken token may be used.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0, -self.tokens / self.rate)
+
+
+class HostLimiter:
+    """
+    Politeness budget per host: at most `max_in_flight` requests in flight to
+    a host, and at most `rate` requests per second. Requests over budget
+    wait for their turn, they are not dropped.
+
+    Parameters:
+        max_in_flight(int): Maximum concurrent requests per host, or `None`.
+        rate(float): Maximum requests per second per host, or `None`.
+    """
+
+    def __init__(self, max_in_flight=None, rate=None):
+        self.max_in_flight = max_in_flight
+        self.rate = rate
+        self.hosts = {}  # host -> (semaphore or `None`, bucket or `None`)
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def _host(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = (
+                    self.new_semaphore() if self.max_in_flight else None,
+                    TokenBucket(self.rate) if self.rate else None,
+                )
+            return self.hosts[host]
+
+    def new_semaphore(self):
+        return threading.BoundedSemaphore(self.max_in_flight)
+
+    def _record_wait(self, waited):
+        with self.lock:
+            self.counters["requests"] += 1
+            if waited > 0.001:
+                self.counters["delayed"] += 1
+                self.counters["wait_seconds"] += waited
+
+    def acquire(self, host):
+        """
+        Blocks until a request to the host is within budget.
+        """
+        semaphore, bucket = self._host(host)
+        start = time.monotonic()
+        if semaphore is not None:
+            semaphore.acquire()
+        if bucket is not None:
+            with self.lock:
+                delay = bucket.take()
+            time.sleep(delay)
+        self._record_wait(time.monotonic() - start)
+
+    def release(self, host):
+        """
+        Frees the in-flight slot taken by `acquire`.
+        """
+        semaphore, _ = self.hosts[host]
+        if semaphore is not None:
+            semaphore.release()
+
+    def stats(self):
+        """
+        Returns:
+            A dict with the numbers of requests and of requests delayed so far,
+            the total delay in seconds, and the number of hosts.
+        """
+        with self.lock:
+            stats = {
+                "requests": self.counters["requests"],
+                "delayed": self.counters["delayed"],
+                "wait_seconds": round(self.counters["wait_seconds"], 1),
+            }
+            stats["hosts"] = len(self.hosts)
+        return stats
+
+
+class AsyncHostLimiter(HostLimiter):
+    """
+    `HostLimiter` for use from an event loop: `acquire` is a coroutine.
+    """
+
+    def new_semaphore(self):
+        return asyncio.Semaphore(self.max_in_flight)
+
+    async def acquire(self, host):
+        semaphore, bucket = self._host(host)
+        start = time.monotonic()
+        if semaphore is not None:
+            await semaphore.acquire()
+        if bucket is not None:
+            try:
+                await asyncio.sleep(bucket.take())
+            except asyncio.CancelledError:
+                if semaphore is not None:
+                    semaphore.release()
+                raise
+        self._record_wait(time.monotonic() - start)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    Raised instead of requesting a URL whose host's circuit is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker. After `threshold` consecutive failed requests
+    (timeouts, connection or DNS errors) to a host, its circuit opens: its
+    URL's fail fast, without a request, so checks do not wait out the timeout
+    while a host is down. Every `probe_interval` seconds one request is let
+    through as a probe, which closes the circuit if it gets a response, or
+    keeps it open if not.
+
+    Hosts are told apart by scheme and port as well (see `host_key`), so that
+    a server down on one port does not fail the checks of another.
+
+    Parameters:
+        threshold(int): Consecutive failures that open a host's circuit.
+        probe_interval(float): Seconds between probes of an open circuit.
+    """
+
+    def __init__(self, threshold=DEFAULT_CIRCUIT_THRESHOLD, probe_interval=60):
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.hosts = {}  # host key -> [consecutive failures, next probe time]
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def allow(self, url):
+        """
+        Returns:
+            Whether a request to the URL's host may be sent - `False` if its
+            circuit is open, unless a probe is due.
+        """
+        now = time.monotonic()
+        with self.lock:
+            state = self.hosts.get(host_key(url))
+            if state is None or state[0] < self.threshold:
+                return True
+            if now >= state[1]:
+                state[1] = now + self.probe_interval
+                self.counters["probes"] += 1
+                return True
+            self.counters["fast_failed"] += 1
+            return False
+
+    def record(self, url, failed):
+        """
+        Records the outcome of a request to the URL's host.
+        """
+        key = host_key(url)
+        host = "{}://{}:{}".format(*key)
+        with self.lock:
+            if not failed:
+                if self.hosts.pop(key, [0])[0] >= self.threshold:
+                    self.counters["closed"] += 1
+                    info(f"Circuit closed for {host}")
+                return
+            state = self.hosts.setdefault(key, [0, None])
+            state[0] += 1
+            if state[0] == self.threshold:
+                self.counters["opened"] += 1
+                logger.warning(f"Circuit opened for {host}")
+            if state[0] >= self.threshold:
+                state[1] = time.monotonic() + self.probe_interval
+
+    def stats(self):
+        """
+        Returns:
+            A dict with the numbers of circuits opened and closed, probes and
+            fast-failed requests so far, and the number of hosts whose circuit
+            is open.
+        """
+        with self.lock:
+            stats = {
+                name: self.counters[name]
+                for name in ("opened", "closed", "probes", "fast_failed")
+            }
+            stats["open"] = sum(
+                1 for failures, _ in self.hosts.values() if failures >= self.threshold
+            )
+        return stats
+
+
+class HTTPClient:
+    """
+    HTTP client shared by the monitoring checks. Connections are kept alive
+    and reused across checks, from one connection pool per host. Pools of
+    hosts that have not been requested for `idle_timeout` seconds are closed.
+
+    Cookies are not kept between requests, so every check starts clean. The
+    session's cookie policy accepts none, but requests carries the cookies
+    set along a redirect chain in the request's own jar, so they are still
+    sent to the next hops of that chain, like `requests.get` does.
+
+    Responses carry the durations of the request phases as `timings` (see
+    `TimedHTTPAdapter`).
+
+    Requests can be limited per host (see `HostLimiter`). Requests over
+    budget block until their turn; their wait is not part of the response's
+    `elapsed` time. Streamed responses keep their in-flight slot until closed.
+
+    With a `CircuitBreaker`, requests to hosts that keep failing raise
+    `CircuitOpenError` instead of being sent.
+
+    Parameters:
+        pool_size(int): Number of connections kept alive per host.
+        max_hosts(int): Number of hosts to keep connection pools for - the
+            least recently used pools are closed beyond it.
+        idle_timeout(float): Seconds after which an unused pool is closed.
+        dns_cache(DNSCache): Cache to look up hosts through - if `None`, hosts
+            are looked up with the system resolver for every new connection.
+        max_per_host(int): Maximum concurrent requests per host.
+        rate_per_host(float): Maximum requests per second per host.
+        circuit_breaker(CircuitBreaker): If set, fail fast for hosts that are
+            down.
+    """
+
+    def __init__(
+        self,
+        pool_size=DEFAULT_POOL_SIZE,
+        max_hosts=DEFAULT_MAX_HOSTS,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT,
+        dns_cache=None,
+        max_per_host=None,
+        rate_per_host=None,
+        circuit_breaker=None,
+    ):
+        self.idle_timeout = idle_timeout
+        self.circuit_breaker = circuit_breaker
+        self.limiter = None
+        if max_per_host or rate_per_host:
+            self.limiter = HostLimiter(max_per_host, rate_per_host)
+        self.dns_cache = dns_cache
+        self.adapter = TimedHTTPAdapter(
+            pool_connections=max_hosts,
+            pool_maxsize=pool_size,
+            resolver=resolve if dns_cache is None else dns_cache.resolve,
+        )
+        self.session = requests.Session()
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.session.hooks["response"].append(self._on_response)
+        self.last_used = {}
+        self.last_eviction = time.monotonic()
+        self.lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        """
+        Issues a GET request through the shared session. Accepts the same
+        arguments as `requests.get`.
+        """
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        """
+        Issues a HEAD request through the shared session. Accepts the same
+        arguments as `requests.head`.
+        """
+        return self.request("HEAD", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """
+        Issues a request through the shared session, subject to the per-host
+        limits and circuit breaker. Accepts the same arguments as
+        `requests.request`.
+        """
+        self.evict_idle()
+        self._touch(url)
+        host = politeness_key(url)
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow(url):
+            raise CircuitOpenError(f"Circuit open for {host}, not requesting {url}")
+        if self.limiter is not None:
+            self.limiter.acquire(host)
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except Exception as e:
+            if self.limiter is not None:
+                self.limiter.release(host)
+            if self.circuit_breaker is not None and isinstance(
+                e, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)
+            ):
+                self.circuit_breaker.record(url, failed=True)
+            raise
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(url, failed=False)
+        if self.limiter is None:
+            return response
+        if not kwargs.get("stream"):
+            self.limiter.release(host)
+            return response
+
+        close = response.close
+
+        def close_and_release():
+            nonlocal close
+            if close is not None:
+                close, close_once = None, close
+                close_once()
+                self.limiter.release(host)
+
+        response.close = close_and_release
+        return response
+
+    def _touch(self, url):
+        with self.lock:
+            self.last_used[host_key(url)] = time.monotonic()
+
+    def _on_response(self, response, *args, **kwargs):
+        # Also called for each redirect, so pools of redirect targets are tracked
+        self._touch(response.url)
+
+    def evict_idle(self):
+        """
+        Closes the connection pools of hosts that have not been requested for
+        `idle_timeout` seconds. Sweeps at most every `idle_timeout / 2` seconds.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_eviction < self.idle_timeout / 2:
+                return
+            self.last_eviction = now
+            cutoff = now - self.idle_timeout
+            idle = {key for key, used in self.last_used.items() if used < cutoff}
+            for key in idle:
+                del self.last_used[key]
+
+        pools = self.adapter.poolmanager.pools
+        for pool_key in list(pools.keys()):
+            key = (pool_key.key_scheme, pool_key.key_host, pool_key.key_port)
+            if key in idle:
+                debug(f"Closing idle connection pool for {key[1]}:{key[2]}")
+                try:
+                    del pools[pool_key]  # Closes the pool
+                except KeyError:
+                    pass
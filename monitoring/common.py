@@ -1,14 +1,57 @@
+import asyncio
 import csv
 import logging
+import os
+import random
+import signal
+import tempfile
 from functools import partial
 import threading
+import aiohttp
 import attr
-from monitoring.scheduler import ThreadedScheduler, run_threaded_job
+from monitoring.client import (
+    DEFAULT_DNS_TIMEOUT,
+    DEFAULT_IDLE_TIMEOUT,
+    DEFAULT_POOL_SIZE,
+    AsyncHostLimiter,
+    CachedResolver,
+    CircuitBreaker,
+    DNSCache,
+    HTTPClient,
+    politeness_key,
+    timing_trace_config,
+)
+from monitoring.checkpoint import (
+    DEFAULT_CHECKPOINT_INTERVAL,
+    Checkpoint,
+    monotonic_to_wall,
+)
+from monitoring.sinks import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_FLUSH_INTERVAL,
+    OUTPUT_CSV,
+    make_sink,
+)
+from monitoring.scheduler import (
+    DEFAULT_MAX_QUEUE,
+    OVERFLOW_SKIP,
+    PHASE_EVEN,
+    PHASE_NONE,
+    BoundedJobRunner,
+    HeapScheduler,
+    LagStats,
+    hash_offset,
+    phase_offsets,
+    run_threaded_job,
+)
+from monitoring.sharding import select_shard
 
 logger = logging.getLogger("monitor")
 info, debug, error = logger.info, logger.debug, logger.error
 
 DEFAULT_CHECK_INTERVAL = 60
+DEFAULT_CONCURRENCY = 500
+DEFAULT_RELOAD_INTERVAL = 60
 
 
 @attr.s
@@ -41,6 +84,107 @@ class HTTPCheckResult:
     connection_error = attr.ib(
         validator=attr.validators.instance_of(bool), default=False
     )
+    # Request phase durations, `None` for phases that did not take place
+    # (e.g. DNS, connect and TLS on a reused connection)
+    dns_duration = attr.ib(
+        validator=attr.validators.optional(attr.validators.instance_of(float)),
+        default=None,
+    )
+    connect_duration = attr.ib(
+        validator=attr.validators.optional(attr.validators.instance_of(float)),
+        default=None,
+    )
+    tls_duration = attr.ib(
+        validator=attr.validators.optional(attr.validators.instance_of(float)),
+        default=None,
+    )
+    ttfb = attr.ib(
+        validator=attr.validators.optional(attr.validators.instance_of(float)),
+        default=None,
+    )
+    # A connection error, as the host could not be looked up
+    dns_error = attr.ib(validator=attr.validators.instance_of(bool), default=False)
+    # Not requested, as the host's circuit was open (see `CircuitBreaker`)
+    circuit_open = attr.ib(validator=attr.validators.instance_of(bool), default=False)
+
+
+class AdaptiveInterval:
+    """
+    Adapts the check interval of each URL to its latest results:
+     - after `backoff_after` consecutive timeouts, connection or DNS errors, the
+       interval doubles with each further failure, up to `max_interval`.
+     - when the outcome changes (a different status code, or an error instead
+       of a response and vice versa), the next `densify_checks` checks run at
+       `base_interval / densify_factor`, to pin down flapping quickly.
+     - otherwise the interval is `base_interval`.
+
+    Parameters:
+        base_interval(float): The normal check interval in seconds.
+        max_interval(float): The longest interval to back off to, in seconds.
+        backoff_after(int): Consecutive failures before backing off.
+        densify_factor(float): How much shorter the interval is after a change.
+        densify_checks(int): How many checks run at the shorter interval.
+    """
+
+    def __init__(
+        self,
+        base_interval,
+        max_interval,
+        backoff_after=3,
+        densify_factor=2,
+        densify_checks=3,
+    ):
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.backoff_after = backoff_after
+        self.densify_factor = densify_factor
+        self.densify_checks = densify_checks
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def next_interval(self, key, result):
+        """
+        Records a check result.
+
+        Parameters:
+            key: Identifies the checked URL.
+            result(HTTPCheckResult): The check's result.
+
+        Returns:
+            The interval in seconds until the URL's next check.
+        """
+        if result.timeout:
+            outcome = "timeout"
+        elif result.dns_error:
+            outcome = "dns_error"
+        elif result.connection_error:
+            outcome = "connection_error"
+        else:
+            outcome = result.status_code
+        failed = result.timeout or result.connection_error
+
+        with self.lock:
+            previous, failures, dense_left = self.states.get(key, (outcome, 0, 0))
+            failures = failures + 1 if failed else 0
+            if outcome != previous:
+                dense_left = self.densify_checks
+            if failures >= self.backoff_after:
+                exponent = failures - self.backoff_after + 1
+                interval = min(self.base_interval * 2 ** exponent, self.max_interval)
+            elif dense_left:
+                dense_left -= 1
+                interval = self.base_interval / self.densify_factor
+            else:
+                interval = self.base_interval
+            self.states[key] = (outcome, failures, dense_left)
+        return interval
+
+    def forget(self, key):
+        """
+        Drops the state of a URL that is no longer checked.
+        """
+        with self.lock:
+            self.states.pop(key, None)
 
 
 def get_service_urls(csv_path, col_no):
@@ -49,6 +193,79 @@ def get_service_urls(csv_path, col_no):
         return [r[col_no] for r in reader]
 
 
+def read_url_ids(urls_path):
+    """
+    Returns:
+        The URL id's kept in the `<output_path>.urls` file of a monitor
+        reloading its URL list (see `Monitor`), by URL.
+    """
+    with open(urls_path) as f:
+        return {url: int(url_id) for url_id, url in csv.reader(f, delimiter="\t")}
+
+
+def assign_url_ids(urls, url_ids):
+    """
+    Assigns an id to each new URL, after the highest assigned yet. URL's
+    seen before keep theirs, even if they were removed in between.
+
+    Parameters:
+        urls(list): The URL's, in the order of the list they are read from.
+        url_ids(dict): The id's assigned yet, by URL. Updated in place.
+
+    Returns:
+        `url_ids`.
+    """
+    next_url_id = max(url_ids.values(), default=-1) + 1
+    for url in urls:
+        if url not in url_ids:
+            url_ids[url] = next_url_id
+            next_url_id += 1
+    return url_ids
+
+
+class TargetsWatcher:
+    """
+    Watches a targets CSV file for changes, by polling its modification time
+    and size.
+
+    Parameters:
+        csv_path(str): The file to watch.
+        read_func(callable): Reads the targets from the file, given its path.
+        interval(float): How often to poll the file, in seconds.
+    """
+
+    def __init__(self, csv_path, read_func, interval=DEFAULT_RELOAD_INTERVAL):
+        self.csv_path = csv_path
+        self.read_func = read_func
+        self.interval = interval
+        self.signature = self._signature()
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.csv_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def poll(self):
+        """
+        Returns:
+            The targets read from the file if it changed since the last poll,
+            otherwise `None`. A file that is missing or cannot be read is
+            treated as unchanged, so the current targets stay checked.
+        """
+        signature = self._signature()
+        if signature is None or signature == self.signature:
+            return None
+        try:
+            targets = self.read_func(self.csv_path)
+        except (OSError, IndexError, ValueError, TypeError):
+            logger.exception(f"Could not reload {self.csv_path}: ")
+            return None
+        self.signature = signature
+        return targets
+
+
 class Monitor:
     """
     Monitors a list of URL's using the provided check function.
@@ -57,44 +274,332 @@ class Monitor:
 
     Parameters:
         service_urls(list): URL's to monitor
-        output_path(str): The path of the CSV file to append the results to.
+        output_path(str): The path of the CSV file to append the results to,
+            or of the directory to write Parquet files to.
         check_interval(float): Interval in seconds when each URL is to be checked.
         timeout(float): The timeout in seconds for the GET requests - if `None`,
             defaults to `DEFAULT_CHECK_INTERVAL`.
+        output_format(str): One of `OUTPUT_FORMATS` (see `monitoring.sinks`).
+        batch_size(int): Number of results written to file at once.
+        flush_interval(float): Maximum delay in seconds before a result is
+            written to file.
+        pool_size(int): Number of connections kept alive per host.
+        idle_timeout(float): Seconds after which unused connections are closed.
+        dns_cache(bool): Look up hosts through an in-process `DNSCache`,
+            instead of the system resolver on every new connection.
+        dns_timeout(float): Maximum time in seconds for a DNS lookup, with
+            `dns_cache`.
+        max_per_host(int): Maximum concurrent checks per host.
+        rate_per_host(float): Maximum checks per second per host. Checks over
+            either budget wait for their turn (see `HostLimiter`).
+        circuit_threshold(int): If set, after this many consecutive failed
+            checks of a host, its URL's fail fast, with one probe per check
+            interval (see `CircuitBreaker`).
+        phase(str): How to spread the checks over the interval, one of
+            `PHASE_MODES` (see `phase_offsets`).
+        jitter(float): Maximum random shift in seconds of each check.
+        max_check_interval(float): If set, each URL's interval adapts to its
+            results, backing off up to this many seconds for dead endpoints
+            (see `AdaptiveInterval`).
+        max_workers(int): If set, checks run on a fixed pool of this many
+            threads instead of a new thread each (see `BoundedJobRunner`).
+        max_queue(int): Maximum number of checks waiting for a worker.
+        overflow(str): What to do with checks once the queue is full.
+        shard(tuple): If set, only the URL's of this `(index, count)` shard are
+            monitored (see `monitoring.sharding`). URL id's stay those of the
+            full list.
+        watcher(TargetsWatcher): If set, the URL list is reloaded whenever
+            the watched file changes. Only added and removed URL's are
+            (un)scheduled; URL id's are kept in `<output_path>.urls`, so they
+            stay the same across reloads and restarts.
+        state_path(str): If set, the schedule is saved to this file every
+            `checkpoint_interval` seconds and on close, and resumed from it on
+            startup (see `Checkpoint`). A saved `output_path` takes precedence,
+            so a restarted monitor keeps appending to the same results.
+        checkpoint_interval(float): How often to save the schedule, in seconds.
     """
 
     def __init__(
-        self, service_urls, check_func, output_path, check_interval, timeout=None
+        self,
+        service_urls,
+        check_func,
+        output_path,
+        check_interval,
+        timeout=None,
+        output_format=OUTPUT_CSV,
+        batch_size=DEFAULT_BATCH_SIZE,
+        flush_interval=DEFAULT_FLUSH_INTERVAL,
+        pool_size=DEFAULT_POOL_SIZE,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT,
+        dns_cache=False,
+        dns_timeout=DEFAULT_DNS_TIMEOUT,
+        max_per_host=None,
+        rate_per_host=None,
+        circuit_threshold=None,
+        phase=PHASE_EVEN,
+        jitter=0,
+        max_check_interval=None,
+        max_workers=None,
+        max_queue=DEFAULT_MAX_QUEUE,
+        overflow=OVERFLOW_SKIP,
+        shard=None,
+        watcher=None,
+        state_path=None,
+        checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
     ):
-        self.urls = service_urls
+        self.checkpoint = Checkpoint(state_path) if state_path else None
+        self.checkpoint_interval = checkpoint_interval
+        if self.checkpoint is not None:
+            output_path = self.checkpoint.get("output_path", output_path)
+        self.shard = shard
+        self.watcher = watcher
+        self.url_ids = {}
+        self.urls_path = f"{output_path}.urls" if watcher is not None else None
+        if self.urls_path is not None and os.path.exists(self.urls_path):
+            self.url_ids = read_url_ids(self.urls_path)
+        self.targets = self.select_targets(service_urls)
         self.check_func = check_func
         self.output_path = output_path
         self.check_interval = check_interval
         self.timeout = timeout or DEFAULT_CHECK_INTERVAL
-        self.scheduler = ThreadedScheduler()
-        self.csv_write_lock = threading.Lock()
+        self.phase = phase
+        self.jitter = jitter
+        self.scheduler = HeapScheduler(jitter=jitter)
+        self.lag_stats = self.scheduler.lag_stats
+        self.running_checks = 0
+        self.closing = False
+        self.checks_done = threading.Condition()
+        self.sink = make_sink(output_format, output_path, batch_size, flush_interval)
+        self.idle_timeout = idle_timeout
+        self.dns_cache = DNSCache(timeout=dns_timeout) if dns_cache else None
+        self.circuit_breaker = (
+            CircuitBreaker(circuit_threshold, probe_interval=check_interval)
+            if circuit_threshold
+            else None
+        )
+        self.init_client(pool_size, max_per_host, rate_per_host)
+        self.init_runner(max_workers, max_queue, overflow)
+        self.adaptive_interval = (
+            AdaptiveInterval(check_interval, max_check_interval)
+            if max_check_interval
+            else None
+        )
+
+    def init_client(self, pool_size, max_per_host, rate_per_host):
+        """
+        Sets up the HTTP client shared by the checks, and its per-host limits.
+        """
+        self.client = HTTPClient(
+            pool_size=pool_size,
+            idle_timeout=self.idle_timeout,
+            dns_cache=self.dns_cache,
+            max_per_host=max_per_host,
+            rate_per_host=rate_per_host,
+            circuit_breaker=self.circuit_breaker,
+        )
+        self.host_limiter = self.client.limiter
+
+    def init_runner(self, max_workers, max_queue, overflow):
+        """
+        Sets up the worker pool the checks run on, if enabled.
+        """
+        self.runner = (
+            BoundedJobRunner(max_workers, max_queue, overflow, self.lag_stats)
+            if max_workers
+            else None
+        )
+
+    def save_url_ids(self):
+        """
+        Replaces the URL id's file atomically. The shards of a monitor may
+        share it, so each writes its own temporary file.
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.urls_path)), suffix=".tmp"
+        )
+        try:
+            with open(fd, "w") as f:
+                writer = csv.writer(f, delimiter="\t")
+                writer.writerows((url_id, url) for url, url_id in self.url_ids.items())
+            os.replace(tmp_path, self.urls_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def select_targets(self, urls):
+        """
+        Assigns an id to each new URL (see `assign_url_ids`).
+
+        Returns:
+            A dict of the URL's of this monitor's shard, by URL id.
+        """
+        assign_url_ids(urls, self.url_ids)
+        targets = select_shard(
+            ((self.url_ids[url], url) for url in dict.fromkeys(urls)),
+            self.shard,
+            key=lambda target: target[1],
+        )
+        return dict(targets)
+
+    def initial_schedule(self):
+        """
+        Returns:
+            By URL id, the offset of the first check and the interval. Checks
+            saved in the checkpoint resume their schedule, the others are
+            spread according to `phase`.
+        """
+        offsets = phase_offsets(
+            list(self.targets.values()), self.check_interval, self.phase
+        )
+        schedule = {}
+        for url_id, offset in zip(self.targets, offsets):
+            resumed = None
+            if self.checkpoint is not None:
+                resumed = self.checkpoint.resume(url_id)
+            schedule[url_id] = resumed or (offset, self.check_interval)
+        return schedule
 
     def schedule_jobs(self):
         """
         Schedules a job for each service URL.
         """
-        for url_id, url in enumerate(self.urls):
-            info(f"Scheduling check for {url} every {self.check_interval} seconds")
-            self.scheduler.every(self.check_interval).seconds.do(
-                run_threaded_job,
-                partial(
-                    self.check_func,
-                    url=url,
-                    url_id=url_id,
-                    output_path=self.output_path,
-                    csv_write_lock=self.csv_write_lock,
-                    timeout=self.timeout,
-                ),
+        schedule = self.initial_schedule()
+        for url_id, url in self.targets.items():
+            self.start_check(url_id, url, *schedule[url_id])
+        if self.checkpoint is not None:
+            self.scheduler.add("checkpoint", self.checkpoint_interval, self.save_state)
+        if self.watcher is not None:
+            self.save_url_ids()
+            self.scheduler.add("reload", self.watcher.interval, self.reload_targets)
+        if self.runner is not None:
+            self.scheduler.add(
+                "runner_stats", self.check_interval, self.log_runner_stats
+            )
+        if self.dns_cache is not None:
+            self.scheduler.add("dns_stats", self.check_interval, self.log_dns_stats)
+        if self.host_limiter is not None:
+            self.scheduler.add(
+                "host_limiter_stats", self.check_interval, self.log_host_limiter_stats
+            )
+        if self.circuit_breaker is not None:
+            self.scheduler.add(
+                "circuit_stats", self.check_interval, self.log_circuit_stats
+            )
+
+    def start_check(self, url_id, url, offset, interval=None):
+        interval = interval or self.check_interval
+        info(f"Scheduling check for {url} every {interval} seconds")
+        job = partial(self.run_check, url_id, url)
+        if self.runner is None:
+            self.scheduler.add(url_id, interval, run_threaded_job, job, offset=offset)
+        else:
+            self.scheduler.add(
+                url_id,
+                interval,
+                self.runner.submit,
+                url,
+                job,
+                offset=offset,
+                records_lag=True,
+            )
+
+    def snapshot(self):
+        """
+        Returns:
+            The schedule of the checks, as saved by `save_state`.
+        """
+        return self.scheduler.snapshot(list(self.targets))
+
+    def save_state(self):
+        """
+        Saves the schedule of the checks and the results location to the
+        state file.
+        """
+        self.checkpoint.save(self.snapshot(), output_path=self.output_path)
+
+    def stop_check(self, url_id, url):
+        info(f"Unscheduling check for {url}")
+        self.scheduler.remove(url_id)
+
+    def reload_targets(self):
+        """
+        Reloads the URL list if the watched file changed, and (un)schedules
+        the added and removed URL's. New URL's get an offset derived from their
+        hash, so they do not all run at once.
+        """
+        urls = self.watcher.poll()
+        if urls is None:
+            return
+        targets = self.select_targets(urls)
+        removed = [url_id for url_id in self.targets if url_id not in targets]
+        added = [url_id for url_id in targets if url_id not in self.targets]
+        for url_id in removed:
+            self.stop_check(url_id, self.targets[url_id])
+            if self.adaptive_interval is not None:
+                self.adaptive_interval.forget(url_id)
+        for url_id in added:
+            url = targets[url_id]
+            offset = None
+            if self.phase != PHASE_NONE:
+                offset = hash_offset(url, self.check_interval)
+            self.start_check(url_id, url, offset)
+        self.targets = targets
+        self.save_url_ids()
+        info(
+            f"Reloaded {self.watcher.csv_path}: {len(added)} added, "
+            f"{len(removed)} removed, {len(targets)} checked"
+        )
+
+    def run_check(self, url_id, url):
+        """
+        Runs the check function for a URL, then adapts the URL's interval
+        to the result, if enabled.
+        """
+        job = self.scheduler.jobs.get(url_id)
+        if job is None:  # Removed by a reload since
+            return
+        with self.checks_done:
+            if self.closing:
+                return
+            self.running_checks += 1
+        try:
+            result = self.check_func(
+                url=url,
+                url_id=url_id,
+                sink=self.sink,
+                timeout=self.timeout,
+                client=self.client,
+                check_interval=job.interval,
+            )
+        finally:
+            with self.checks_done:
+                self.running_checks -= 1
+                self.checks_done.notify_all()
+        if self.adaptive_interval is not None and url_id in self.targets:
+            self.scheduler.set_interval(
+                url_id, self.adaptive_interval.next_interval(url_id, result)
             )
 
+    def log_runner_stats(self):
+        stats = ", ".join(f"{k}={v}" for k, v in self.runner.stats().items())
+        info(f"Worker pool: {stats}")
+
+    def log_dns_stats(self):
+        stats = ", ".join(f"{k}={v}" for k, v in self.dns_cache.stats().items())
+        info(f"DNS cache: {stats}")
+
+    def log_host_limiter_stats(self):
+        stats = ", ".join(f"{k}={v}" for k, v in self.host_limiter.stats().items())
+        info(f"Per-host limits: {stats}")
+
+    def log_circuit_stats(self):
+        stats = ", ".join(f"{k}={v}" for k, v in self.circuit_breaker.stats().items())
+        info(f"Circuit breaker: {stats}")
+
     def run(self, interval=1):
         """
-        Schedules the jobs and runs the scheduler continuously, on default delay of 1 second.
+        Schedules the jobs and runs the scheduler continuously. The poison pill
+        is checked at least every `interval` seconds.
 
         Returns:
             The scheduler loop's thread poison pill (a `threading.Event` instance).
@@ -102,3 +607,218 @@ class Monitor:
         self.schedule_jobs()
         info("Starting scheduler")
         return self.scheduler.run_continuously(interval)
+
+    def close(self, drain_timeout=None):
+        """
+        Waits for the running checks, then writes out the pending results,
+        and saves the state if enabled. Checks due meanwhile are not started.
+        Call once the monitor has been stopped.
+
+        Parameters:
+            drain_timeout(float): How long to wait for the running checks, in
+                seconds - if `None`, the check timeout. The results of checks
+                still running after it are lost, and logged.
+        """
+        with self.checks_done:
+            self.closing = True
+            self.checks_done.wait_for(
+                lambda: not self.running_checks,
+                self.timeout if drain_timeout is None else drain_timeout,
+            )
+            if self.running_checks:
+                logger.warning(
+                    f"Closing with {self.running_checks} checks still running, "
+                    "their results are lost"
+                )
+        self.sink.close()
+        if self.checkpoint is not None:
+            self.save_state()
+
+
+class AsyncMonitor(Monitor):
+    """
+    Monitors a list of URL's from a single event loop, using non-blocking
+    HTTP requests instead of a thread per check. At most `concurrency` checks
+    are in flight at any time, the rest wait for a free slot.
+
+    The check function must be a coroutine function, accepting the same
+    arguments as for `Monitor`, plus the shared `aiohttp.ClientSession` as
+    `session` and the monitor's `CircuitBreaker` (or `None`) as
+    `circuit_breaker`.
+
+    Parameters:
+        concurrency(int): Maximum number of checks in flight.
+        (the others as for `Monitor`, except for `pool_size` and the worker
+        pool options)
+    """
+
+    def __init__(self, *args, concurrency=DEFAULT_CONCURRENCY, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.concurrency = concurrency
+        self.lag_stats = LagStats()
+        self.schedule = {}  # url_id -> [last run, next run, interval], loop times
+
+    def init_client(self, pool_size, max_per_host, rate_per_host):
+        # Checks use the event loop's session instead (see `run_jobs`)
+        self.client = None
+        self.host_limiter = None
+        if max_per_host or rate_per_host:
+            self.host_limiter = AsyncHostLimiter(max_per_host, rate_per_host)
+
+    def init_runner(self, max_workers, max_queue, overflow):
+        self.runner = None  # Checks run as tasks of the event loop
+
+    async def run_job(self, session, semaphore, url_id, url, offset, interval):
+        """
+        Checks a URL every `interval` seconds (or as adapted), until
+        cancelled. Runs that are missed because a check overran are skipped,
+        not caught up on.
+        """
+        loop = asyncio.get_event_loop()
+        next_run = loop.time() + (interval if offset is None else offset)
+        schedule = self.schedule[url_id] = [None, next_run, interval]
+        while True:
+            run_at = next_run
+            if self.jitter:
+                run_at += random.uniform(-self.jitter, self.jitter)
+            await asyncio.sleep(max(0, run_at - loop.time()))
+            schedule[0] = loop.time()
+            # The host's budget is waited for first, so that checks of a
+            # throttled host do not hold up the others' concurrency slots
+            if self.host_limiter is not None:
+                await self.host_limiter.acquire(politeness_key(url))
+            try:
+                async with semaphore:
+                    self.lag_stats.record(loop.time() - run_at)
+                    try:
+                        result = await self.check_func(
+                            session=session,
+                            circuit_breaker=self.circuit_breaker,
+                            url=url,
+                            url_id=url_id,
+                            sink=self.sink,
+                            timeout=self.timeout,
+                            check_interval=interval,
+                        )
+                        if self.adaptive_interval is not None:
+                            interval = self.adaptive_interval.next_interval(
+                                url_id, result
+                            )
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception:
+                        logger.exception("Scheduled job exception: ")
+            finally:
+                if self.host_limiter is not None:
+                    self.host_limiter.release(politeness_key(url))
+            next_run += interval
+            lag = loop.time() - next_run
+            if lag > 0:
+                next_run += (lag // interval + 1) * interval
+            schedule[1:] = next_run, interval
+
+    async def run_jobs(self, stop, interval):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        if self.dns_cache is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency, keepalive_timeout=self.idle_timeout
+            )
+        else:
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency,
+                keepalive_timeout=self.idle_timeout,
+                resolver=CachedResolver(self.dns_cache),
+                use_dns_cache=False,
+            )
+        async with aiohttp.ClientSession(
+            connector=connector, trace_configs=[timing_trace_config()]
+        ) as session:
+            self.session = session
+            self.semaphore = semaphore
+            self.tasks = {}
+            schedule = self.initial_schedule()
+            for url_id, url in self.targets.items():
+                self.start_check(url_id, url, *schedule[url_id])
+            loop = asyncio.get_event_loop()
+            if self.watcher is not None:
+                self.save_url_ids()
+                reload_at = loop.time() + self.watcher.interval
+            checkpoint_at = loop.time() + self.checkpoint_interval
+            while not stop.is_set():
+                await asyncio.sleep(interval)
+                if self.watcher is not None and loop.time() >= reload_at:
+                    self.reload_targets()
+                    reload_at += self.watcher.interval
+                if self.checkpoint is not None and loop.time() >= checkpoint_at:
+                    self.save_state()
+                    checkpoint_at += self.checkpoint_interval
+            tasks = list(self.tasks.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def start_check(self, url_id, url, offset, interval=None):
+        interval = interval or self.check_interval
+        info(f"Scheduling check for {url} every {interval} seconds")
+        self.tasks[url_id] = asyncio.ensure_future(
+            self.run_job(self.session, self.semaphore, url_id, url, offset, interval)
+        )
+
+    def stop_check(self, url_id, url):
+        info(f"Unscheduling check for {url}")
+        self.tasks.pop(url_id).cancel()
+        self.schedule.pop(url_id, None)
+
+    def snapshot(self):
+        # Event loop times are `time.monotonic()` values
+        return {
+            url_id: {
+                "last_run": monotonic_to_wall(last_run),
+                "next_run": monotonic_to_wall(next_run),
+                "interval": interval,
+            }
+            for url_id, (last_run, next_run, interval) in list(self.schedule.items())
+        }
+
+    def run_loop(self, stop, interval):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.run_jobs(stop, interval))
+        finally:
+            loop.close()
+
+    def run(self, interval=1):
+        """
+        Runs the event loop in its own thread. The poison pill is checked every
+        `interval` seconds.
+
+        Returns:
+            The event loop thread's poison pill (a `threading.Event` instance).
+        """
+        info("Starting event loop")
+        stop = threading.Event()
+        self.loop_thread = threading.Thread(target=self.run_loop, args=(stop, interval))
+        self.loop_thread.start()
+        return stop
+
+    def close(self):
+        """
+        Waits for the event loop to wind down, then writes out the pending
+        results. Call once the monitor has been stopped.
+        """
+        self.loop_thread.join()
+        super().close()
+
+
+def wait_for_shutdown(stop):
+    """
+    Blocks until SIGTERM or SIGINT is received, then sets the poison pill.
+
+    Parameters:
+        stop(threading.Event): The poison pill returned by a monitor's `run`.
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    while not stop.wait(1):
+        pass
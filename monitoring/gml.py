@@ -0,0 +1,318 @@
+import difflib
+import hashlib
+import logging
+from functools import partial
+
+from lxml import etree
+
+logger = logging.getLogger("gml")
+info, debug, error = logger.info, logger.debug, logger.error
+
+CHUNK_SIZE = 64 * 1024
+
+DIFF_TEXT = "text"
+DIFF_FEATURES = "features"
+DIFF_MODES = (DIFF_TEXT, DIFF_FEATURES)
+
+# Local names of the elements grouping features, which have a gml:id too
+COLLECTION_NAMES = ("FeatureCollection", "SpatialDataSet")
+
+
+class CanonicalHasher:
+    """
+    Parser target hashing an XML document's canonical form as it is parsed,
+    without building its tree: only the elements, their attributes (in any
+    order) and their text (without surrounding whitespace) count, so
+    re-indenting the document, or changing its namespace prefixes or its
+    comments, does not change the hash.
+    """
+
+    batch_size = 10000  # Parts hashed at a time
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.parts = []
+        self.text = []
+
+    def flush_text(self):
+        if self.text:
+            text = "".join(self.text).strip()
+            if text:
+                self.parts.append(f"T{text}\0")
+            self.text = []
+
+    def flush(self):
+        self.md5.update("".join(self.parts).encode("utf-8"))
+        self.parts = []
+
+    def start(self, tag, attrib):
+        self.flush_text()
+        self.parts.append(f"<{tag}\0")
+        if attrib:
+            self.parts.extend(f"@{k}={v}\0" for k, v in sorted(attrib.items()))
+        if len(self.parts) > self.batch_size:
+            self.flush()
+
+    def end(self, tag):
+        self.flush_text()
+        self.parts.append(f">{tag}\0")
+
+    def data(self, data):
+        self.text.append(data)
+
+    def close(self):
+        self.flush()
+        return self.md5.hexdigest()
+
+
+def canonical_fingerprint(f):
+    """
+    Hashes an XML document chunk by chunk, see `CanonicalHasher`.
+
+    Parameters:
+        f: The binary file object to read the document from.
+
+    Returns:
+        The MD5 fingerprint of the document.
+
+    Raises:
+        etree.ParseError: The document is not valid XML.
+    """
+    parser = etree.XMLParser(target=CanonicalHasher())
+    for chunk in iter(partial(f.read, CHUNK_SIZE), b""):
+        parser.feed(chunk)
+    return parser.close()
+
+
+def is_gml_id(name):
+    """
+    Returns:
+        Whether an attribute name, in Clark notation, is `gml:id`, of any GML
+        version.
+    """
+    return name.endswith("}id") and name.startswith("{http://www.opengis.net/gml")
+
+
+def local_name(tag):
+    """
+    Returns:
+        The name of an element without its namespace, e.g. `member` for
+        `{http://www.opengis.net/wfs/2.0}member`.
+    """
+    return tag.rpartition("}")[2]
+
+
+def is_feature(tag, attrib, ancestors):
+    """
+    Returns:
+        Whether an element outside of any feature is a feature: it has a
+        `gml:id`, is not a collection, and is a child of the root or of a
+        member element (`wfs:member`, `gml:featureMember(s)`, `base:member`).
+    """
+    if not ancestors or not any(is_gml_id(k) for k in attrib):
+        return False
+    if local_name(tag).endswith(COLLECTION_NAMES):
+        return False
+    parent = local_name(ancestors[-1]).lower()
+    return len(ancestors) == 1 or parent.endswith(("member", "members"))
+
+
+class FeatureHasher:
+    """
+    Parser target hashing each feature of a GML document as it is parsed,
+    without building its tree. A feature is an element with a `gml:id`
+    directly in a member element or the root, outside of any other feature,
+    e.g. a `ps:ProtectedSite` inside a `wfs:member` (see `is_feature`): the
+    root and the collections, which have a `gml:id` too, are not. Its key is the text of its first `localId` element (the
+    INSPIRE `base:localId` of its `inspireId`), else its `gml:id`, which
+    some services generate anew for each request. Features are hashed in
+    canonical form, like `CanonicalHasher` does for whole documents.
+    """
+
+    def __init__(self):
+        self.features = {}
+        self.ancestors = []  # Tags of the open elements, outside of features
+        self.parts = None  # Of the current feature, if any
+        self.text = []
+        self.depth = 0
+        self.gml_id = None
+        self.local_id = None
+        self.local_id_text = None
+
+    def flush_text(self):
+        text = "".join(self.text).strip()
+        if text:
+            self.parts.append(f"T{text}\0")
+        self.text = []
+
+    def start(self, tag, attrib):
+        if self.parts is None:
+            if not is_feature(tag, attrib, self.ancestors):
+                self.ancestors.append(tag)
+                return
+            self.parts = []
+            self.gml_id = next(v for k, v in attrib.items() if is_gml_id(k))
+            self.local_id = None
+        elif self.text:
+            self.flush_text()
+        self.depth += 1
+        self.parts.append(f"<{tag}\0")
+        if attrib:
+            self.parts.extend(f"@{k}={v}\0" for k, v in sorted(attrib.items()))
+        if self.local_id is None and tag.endswith("}localId"):
+            self.local_id_text = []
+
+    def data(self, data):
+        if self.parts is not None:
+            self.text.append(data)
+            if self.local_id_text is not None:
+                self.local_id_text.append(data)
+
+    def end(self, tag):
+        if self.parts is None:
+            self.ancestors.pop()
+            return
+        if self.text:
+            self.flush_text()
+        self.parts.append(f">{tag}\0")
+        if self.local_id_text is not None:
+            self.local_id = "".join(self.local_id_text).strip()
+            self.local_id_text = None
+        self.depth -= 1
+        if self.depth == 0:
+            key = self.local_id or self.gml_id
+            if key in self.features:
+                key = f"{key} ({self.gml_id})"
+            digest = hashlib.md5("".join(self.parts).encode("utf-8")).hexdigest()
+            self.features[key] = digest
+            self.parts = None
+
+    def close(self):
+        return self.features
+
+
+def feature_hashes(f):
+    """
+    Hashes each feature of a GML document, chunk by chunk, see
+    `FeatureHasher`.
+
+    Parameters:
+        f: The binary file object to read the document from.
+
+    Returns:
+        The MD5 hash of each feature, by key.
+
+    Raises:
+        etree.ParseError: The document is not valid XML.
+    """
+    parser = etree.XMLParser(target=FeatureHasher())
+    for chunk in iter(partial(f.read, CHUNK_SIZE), b""):
+        parser.feed(chunk)
+    return parser.close()
+
+
+def diff_features(previous, new):
+    """
+    Parameters:
+        previous(dict): The feature hashes of the previous document, by key.
+        new(dict): The feature hashes of the new document, by key.
+
+    Returns:
+        The sorted keys of the added, removed and modified features.
+    """
+    added = sorted(key for key in new if key not in previous)
+    removed = sorted(key for key in previous if key not in new)
+    modified = sorted(
+        key for key in new if key in previous and new[key] != previous[key]
+    )
+    return added, removed, modified
+
+
+def feature_diff_lines(previous, new, previous_name, new_name):
+    """
+    Compares two GML documents feature by feature, streaming them.
+
+    Parameters:
+        previous: The previous document, as a binary file object.
+        new: The new document, as a binary file object.
+        previous_name(str): The name of the previous document, in the header.
+        new_name(str): The name of the new document, in the header.
+
+    Returns:
+        The lines of the diff: a header and a count of the features, then a
+        line per added (`+`), removed (`-`) or modified (`~`) feature, or
+        `None` if neither document has features.
+
+    Raises:
+        etree.ParseError: A document is not valid XML.
+    """
+    previous_features = feature_hashes(previous)
+    new_features = feature_hashes(new)
+    if not previous_features and not new_features:
+        return None
+    added, removed, modified = diff_features(previous_features, new_features)
+    lines = [
+        f"--- {previous_name}",
+        f"+++ {new_name}",
+        f"Features: {len(previous_features)} -> {len(new_features)}, "
+        f"{len(added)} added, {len(removed)} removed, {len(modified)} modified",
+    ]
+    lines.extend(f"+ {key}" for key in added)
+    lines.extend(f"- {key}" for key in removed)
+    lines.extend(f"~ {key}" for key in modified)
+    return [line.encode("utf-8") for line in lines]
+
+
+def text_diff_lines(previous, new, previous_name, new_name):
+    """
+    Returns:
+        The lines of the unified diff of two documents, given as binary file
+        objects.
+    """
+    return list(
+        difflib.diff_bytes(
+            difflib.unified_diff,
+            previous.read().splitlines(),
+            new.read().splitlines(),
+            previous_name.encode("utf-8"),
+            new_name.encode("utf-8"),
+        )
+    )
+
+
+def diff_lines(open_previous, open_new, previous_name, new_name, mode=DIFF_TEXT):
+    """
+    Diffs two XML documents.
+
+    Parameters:
+        open_previous(callable): Opens the previous document, as a binary
+            file object.
+        open_new(callable): Opens the new document, as a binary file object.
+        previous_name(str): The name of the previous document, in the header.
+        new_name(str): The name of the new document, in the header.
+        mode(str): One of `DIFF_MODES`. With `features`, documents without
+            features, or not valid XML, get a text diff.
+
+    Returns:
+        The lines of the diff, as bytes.
+    """
+    lines = None
+    if mode == DIFF_FEATURES:
+        try:
+            with open_previous() as previous, open_new() as new:
+                lines = feature_diff_lines(previous, new, previous_name, new_name)
+        except etree.ParseError as e:
+            debug(f"No feature diff, falling back to text: {e}")
+    if lines is None:
+        with open_previous() as previous, open_new() as new:
+            lines = text_diff_lines(previous, new, previous_name, new_name)
+    return lines
+
+
+def write_diff(path, open_previous, open_new, previous_name, new_name, mode=DIFF_TEXT):
+    """
+    Writes the diff of two XML documents to a file, see `diff_lines`.
+    """
+    lines = diff_lines(open_previous, open_new, previous_name, new_name, mode)
+    with open(path, "wb") as f:
+        f.writelines(b"%b\n" % line for line in lines)
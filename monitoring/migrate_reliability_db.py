@@ -0,0 +1,58 @@
+import logging
+from pathlib import Path
+
+from monitoring.reliability import ReliabilityDB
+
+logger = logging.getLogger("migrate_reliability_db")
+info, debug, error = logger.info, logger.debug, logger.error
+
+
+def migrate_output_dir(output_dir, force=False):
+    """
+    Migrates the TinyDB `data.json` file of each service under a reliability
+    monitor's output directory to SQLite.
+
+    Parameters:
+        output_dir(str): The reliability monitor's output directory.
+        force(bool): Whether to migrate services already having an SQLite
+            database, replacing its content.
+
+    Returns:
+        The number of services migrated.
+    """
+    migrated = 0
+    for json_path in sorted(Path(output_dir).rglob(ReliabilityDB.legacy_file_name)):
+        db = ReliabilityDB(json_path.parent)
+        try:
+            if db.url is not None and not force:
+                info(f"Skipping {json_path.parent}, already migrated")
+                continue
+            db.migrate_json()
+            migrated += 1
+        except (OSError, ValueError) as e:
+            error(f"Could not migrate {json_path}: {e}")
+        finally:
+            db.close()
+    return migrated
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Migrate the results of the reliability monitor from TinyDB "
+        "data.json files to SQLite databases. The data.json files are left in place."
+    )
+    parser.add_argument(
+        "output_dirs", nargs="+", help="Output directories of the reliability monitor"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Migrate again the services already having an SQLite database",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    count = sum(migrate_output_dir(d, args.force) for d in args.output_dirs)
+    info(f"Migrated {count} services")
@@ -8,12 +8,26 @@ import attr
 from jinja2 import Environment, FileSystemLoader
 import pytz
 import pandas
+import pyarrow.parquet
 import pdfkit
 import pycountry
 
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mtick
 
+from monitoring.common import assign_url_ids, read_url_ids
+
+
+# Columns needed for the report, read from Parquet results
+REPORT_COLUMNS = [
+    "ts",
+    "url_id",
+    "status_code",
+    "timed_out",
+    "connection_error",
+    "check_interval",
+    "dns_error",
+]
 
 SERVICE_TYPES = {
     "GDSM": "Get Download Service Metadata",
@@ -25,18 +39,20 @@ SERVICE_TYPES = {
 def to_int(value):
     try:
         return int(value)
-    except ValueError:
+    except (TypeError, ValueError):
         return None
 
 
 def to_float(value):
     try:
         return float(value)
-    except ValueError:
+    except (TypeError, ValueError):
         return None
 
 
 def to_str(value):
+    if value is None:
+        return None
     try:
         return str(value)
     except ValueError:
@@ -46,17 +62,24 @@ def to_str(value):
 def to_bool(value):
     try:
         return bool(int(value))
-    except ValueError:
+    except (TypeError, ValueError):
         return None
 
 
 def to_date(value):
-    try:
-        return datetime.strptime(value[:26], "%Y-%m-%dT%H:%M:%S.%f").replace(
-            tzinfo=pytz.UTC
-        )
-    except ValueError:
-        return None
+    """
+    Returns:
+        A UTC datetime from a datetime or an ISO 8601 string, with or without
+        microseconds and offset (naive ones being UTC), or `None`.
+    """
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=pytz.UTC)
+    return value.astimezone(pytz.UTC)
 
 
 @attr.s
@@ -70,33 +93,112 @@ class AvailabilityCheck:
     last_modified = attr.ib(converter=to_str)
     timed_out = attr.ib(converter=to_bool)
     connection_error = attr.ib(converter=to_bool)
-
-
-def get_services(csv_path):
+    # Missing from results recorded before adaptive intervals
+    check_interval = attr.ib(converter=to_float, default=None)
+    # Missing from results recorded before request phase timings
+    dns_duration = attr.ib(converter=to_float, default=None)
+    connect_duration = attr.ib(converter=to_float, default=None)
+    tls_duration = attr.ib(converter=to_float, default=None)
+    ttfb = attr.ib(converter=to_float, default=None)
+    # Missing from results recorded before DNS errors were told apart
+    dns_error = attr.ib(converter=to_bool, default=None)
+    # Missing from results recorded before the circuit breaker
+    circuit_open = attr.ib(converter=to_bool, default=None)
+
+
+def get_services(csv_path, urls_path=None):
+    """
+    Reads the services CSV file, and the URL id's the monitor gave them.
+
+    Parameters:
+        csv_path(str): The services CSV file.
+        urls_path(str): The `<output>.urls` file of a monitor reloading its
+            URL list, if any. Without it, id's are assigned the way the
+            monitor does on startup.
+
+    Returns:
+        The services' URL's by country code and service type, and their
+        URL id's, by URL.
+    """
     data = defaultdict(lambda: defaultdict(list))
-    indexed_data = {}
-    index = 0
+    urls = []
     with open(csv_path) as csv_file:
         reader = csv.reader(csv_file, delimiter="\t")
         for r in reader:
             data[r[0]][r[1]].append(r[2])
-            indexed_data[r[2]] = index
-            index += 1
-    return data, indexed_data
-
+            urls.append(r[2])
+    url_ids = read_url_ids(urls_path) if urls_path is not None else {}
+    return data, assign_url_ids(urls, url_ids)
+
+
+def load_data(results_path, columns=None, start=None, end=None):
+    """
+    Loads availability results, from a CSV file or a directory of Parquet
+    files written by the monitor.
+
+    Parameters:
+        results_path(str): Path to the CSV file or Parquet directory.
+        columns(list): Only read these `AvailabilityCheck` fields from Parquet
+            files, leaving the others `None` - if `None`, reads all of them.
+        start(date): Only load results from this day on.
+        end(date): Only load results up to and including this day.
+
+    Returns:
+        The `AvailabilityCheck` instances, keyed by URL id. Results with an
+        unreadable timestamp are skipped.
+    """
+    if Path(results_path).is_dir():
+        checks = load_parquet(results_path, columns, start, end)
+    else:
+        with open(results_path) as f:
+            checks = [AvailabilityCheck(*r) for r in csv.reader(f, delimiter="\t")]
 
-def load_data(csv_path):
     data = defaultdict(list)
-    with open(csv_path) as f:
-        reader = csv.reader(f, delimiter="\t")
-        for r in reader:
-            data[int(r[1])].append(AvailabilityCheck(*r))
+    skipped = 0
+    for check in checks:
+        if check.ts is None:
+            skipped += 1
+            continue
+        day = check.ts.date()
+        if (start is None or day >= start) and (end is None or day <= end):
+            data[check.url_id].append(check)
+    if skipped:
+        print(f"Skipped {skipped} results with an unreadable timestamp")
     return data
 
 
+def load_parquet(root_dir, columns, start, end):
+    """
+    Reads the day partitions in range, and only the requested columns.
+    """
+    fields = [f.name for f in attr.fields(AvailabilityCheck)]
+    for partition in sorted(Path(root_dir).glob("date=*")):
+        day = datetime.strptime(partition.name[len("date="):], "%Y-%m-%d").date()
+        if (start is not None and day < start) or (end is not None and day > end):
+            continue
+        for path in sorted(partition.glob("*.parquet")):
+            table = pyarrow.parquet.read_table(str(path), columns=columns)
+            values = table.to_pydict()
+            for i in range(table.num_rows):
+                yield AvailabilityCheck(
+                    **{name: values[name][i] if name in values else None for name in fields}
+                )
+
+
+def to_day(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
 def stats(observations):
-    oks = len([o for o in observations if o.status_code == 200])
-    return float(oks) / len(observations)
+    """
+    Returns:
+        The share of time a service was available. Each check is weighted by
+        the check interval it was recorded with, so that checks spaced out
+        while a service was down count for the time they cover.
+    """
+    weights = [o.check_interval or 1.0 for o in observations]
+    oks = sum(w for o, w in zip(observations, weights) if o.status_code == 200)
+    return oks / sum(weights)
 
 
 def plot_availability(observations, suffix, root_dir):
@@ -105,11 +207,13 @@ def plot_availability(observations, suffix, root_dir):
     raw["available"] = [1 if o.status_code == 200 else 0 for o in observations]
     raw["time_out"] = [o.timed_out for o in observations]
     raw["conn_error"] = [o.connection_error for o in observations]
+    raw["dns_error"] = [bool(o.dns_error) for o in observations]
 
     hourly = pandas.DataFrame()
     hourly["available"] = raw.available.resample("H").mean()
     hourly["time_out"] = raw.time_out.resample("H").mean()
     hourly["conn_error"] = raw.conn_error.resample("H").mean()
+    hourly["dns_error"] = raw.dns_error.resample("H").mean()
 
     fig, ax1 = plt.subplots()
 
@@ -120,6 +224,7 @@ def plot_availability(observations, suffix, root_dir):
     plot_avail, = ax1.plot(hourly.index, hourly.available, color="green", label="available")
     plot_time_out, = ax1.plot(hourly.index, hourly.time_out, color="pink", label="time out")
     plot_conn_err, = ax1.plot(hourly.index, hourly.conn_error, color="red", label="connection error")
+    plot_dns_err, = ax1.plot(hourly.index, hourly.dns_error, color="purple", label="DNS error")
 
     axes = plt.gca()
     axes.set_ylim([0, 1.1])
@@ -128,10 +233,11 @@ def plot_availability(observations, suffix, root_dir):
         handles=[
             plot_avail, 
             plot_time_out, 
-            plot_conn_err
+            plot_conn_err,
+            plot_dns_err
         ],
         bbox_to_anchor=(0., 1.02, 1., .102), loc=3,
-        ncol=3, mode="expand", borderaxespad=0.
+        ncol=4, mode="expand", borderaxespad=0.
         )
 
     ax1.fill_between(hourly.index, hourly.available, color="green", alpha=.1)
@@ -143,7 +249,16 @@ def plot_availability(observations, suffix, root_dir):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("Availability report builder")
     parser.add_argument("-s", "--services-csv")
-    parser.add_argument("-r", "--results-csv")
+    parser.add_argument(
+        "-r", "--results-csv", help="Results CSV file, or directory of Parquet files"
+    )
+    parser.add_argument(
+        "--urls",
+        help="URL id's file of a monitor run with --reload-interval, by default "
+        "<results>.urls if it exists",
+    )
+    parser.add_argument("--since", type=to_day, help="First day to report, YYYY-MM-DD")
+    parser.add_argument("--until", type=to_day, help="Last day to report, YYYY-MM-DD")
     parser.add_argument("-g", "--make-graphs", action="store_true", default=False)
     args = parser.parse_args()
 
@@ -153,16 +268,20 @@ if __name__ == "__main__":
     if args.make_graphs:
         graphs_dir.mkdir(exist_ok=True)
 
-    data = load_data(args.results_csv)
-    stats = []
+    data = load_data(
+        args.results_csv, columns=REPORT_COLUMNS, start=args.since, end=args.until
+    )
+    availabilities = {}
 
     for url_id in sorted(data.keys()):
         if args.make_graphs:                    
             plot_availability(data[url_id], suffix=url_id, root_dir=str(graphs_dir))
-        availability = len([o for o in data[url_id] if o.status_code == 200]) / float(len(data[url_id]))
-        stats.append(availability)
+        availabilities[url_id] = stats(data[url_id])
 
-    country_services, indexed_services = get_services(args.services_csv)
+    urls_path = args.urls
+    if urls_path is None and Path(f"{Path(args.results_csv)}.urls").exists():
+        urls_path = f"{Path(args.results_csv)}.urls"
+    country_services, indexed_services = get_services(args.services_csv, urls_path)
 
     countries = {}
     for country_code in country_services:
@@ -176,7 +295,7 @@ if __name__ == "__main__":
         "countries": countries,
         "country_services": country_services,
         "indexed_services": indexed_services,
-        "stats": stats,
+        "stats": availabilities,
         "service_types": SERVICE_TYPES,
     }
     template_path = Path("availability_template.html")
@@ -1,11 +1,13 @@
 import csv
-import difflib
 import hashlib
-import io
+import json
 import logging
 import re
+import sqlite3
 import threading
+import time
 import zipfile
+from contextlib import contextmanager
 from datetime import datetime
 from functools import partial
 from pathlib import Path
@@ -15,15 +17,72 @@ import attr
 from lxml import etree
 import pytz
 import requests
-from tinydb import Query, TinyDB, where
 
-from monitoring.common import HTTPCheckResult
-from monitoring.scheduler import ThreadedScheduler, run_threaded_job
+from monitoring.blobstore import (
+    BLOBS_DIR_NAME,
+    DIFF_FILE_NAME,
+    BlobStore,
+    open_snapshot_file,
+    read_manifest,
+    write_manifest,
+)
+from monitoring.client import (
+    DEFAULT_DNS_TIMEOUT,
+    DEFAULT_IDLE_TIMEOUT,
+    DEFAULT_POOL_SIZE,
+    CircuitBreaker,
+    CircuitOpenError,
+    DNSCache,
+    HTTPClient,
+    is_dns_error,
+)
+from monitoring.checkpoint import DEFAULT_CHECKPOINT_INTERVAL, Checkpoint
+from monitoring.gml import (
+    DIFF_MODES,
+    DIFF_TEXT,
+    canonical_fingerprint,
+    diff_lines,
+    write_diff,
+)
+from monitoring.common import HTTPCheckResult, TargetsWatcher, wait_for_shutdown
+from monitoring.scheduler import (
+    DEFAULT_MAX_QUEUE,
+    OVERFLOW_POLICIES,
+    OVERFLOW_SKIP,
+    PHASE_EVEN,
+    PHASE_MODES,
+    PHASE_NONE,
+    BoundedJobRunner,
+    HeapScheduler,
+    hash_offset,
+    phase_offsets,
+    run_threaded_job,
+)
+from monitoring.sharding import (
+    parse_shard,
+    run_shards,
+    select_shard,
+    shard_output_path,
+)
 
 logger = logging.getLogger("reliability_check")
 info, debug, error = logger.info, logger.debug, logger.error
 
 DEFAULT_TIMEOUT = 30
+DEFAULT_DOWNLOAD_RETRIES = 2
+RETRY_DELAY = 2  # Seconds before resuming a download, times the attempt number
+CHUNK_SIZE = 64 * 1024  # Bytes read and written at a time when downloading
+
+FINGERPRINT_CANONICAL = "canonical"
+FINGERPRINT_PRETTY = "pretty"
+FINGERPRINT_METHODS = (FINGERPRINT_CANONICAL, FINGERPRINT_PRETTY)
+
+# Response headers of the latest download kept in the metadata, by metadata key
+VALIDATOR_HEADERS = {
+    "etag": "ETag",
+    "last_modified": "Last-Modified",
+    "content_length": "Content-Length",
+}
 
 
 @attr.s
@@ -48,6 +107,389 @@ class ServiceMetadata:
         validator=attr.validators.optional(attr.validators.instance_of(str)),
         default=None,
     )
+    fingerprint = attr.ib(
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+        default=None,
+    )
+    etag = attr.ib(
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+        default=None,
+    )
+    last_modified = attr.ib(
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+        default=None,
+    )
+    content_length = attr.ib(
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+        default=None,
+    )
+
+
+def iter_chunks(f, chunk_size=CHUNK_SIZE):
+    """
+    Yields the content of a binary file object, `chunk_size` bytes at a time.
+    """
+    return iter(partial(f.read, chunk_size), b"")
+
+
+class HashedWriter:
+    """
+    Binary file object wrapper, hashing the bytes written through it.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.f.write(data)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+def write_hashed(chunks, path):
+    """
+    Writes chunks of bytes to a file, hashing them on the way.
+
+    Returns:
+        The MD5 checksum of the chunks.
+    """
+    with open(path, "wb") as f:
+        writer = HashedWriter(f)
+        for chunk in chunks:
+            writer.write(chunk)
+    return writer.hexdigest()
+
+
+def resume_validator(response):
+    """
+    Returns:
+        The `If-Range` validator to resume the download of a response with:
+        its strong `ETag`, else its `Last-Modified` - or `None` if it cannot
+        be resumed.
+    """
+    if response.headers.get("Accept-Ranges", "").lower() != "bytes":
+        return None
+    if response.headers.get("Content-Encoding", "identity").lower() != "identity":
+        return None  # Ranges would be of the encoded content
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+def expected_size(response):
+    """
+    Returns:
+        The size of the whole content of a response, from its `Content-Range`
+        or `Content-Length`, or `None` if unknown.
+    """
+    if response.headers.get("Content-Encoding", "identity").lower() != "identity":
+        return None
+    content_range = re.match(
+        r"bytes (\d+)-\d+/(\d+)", response.headers.get("Content-Range", "")
+    )
+    if content_range:
+        return int(content_range.group(2))
+    length = response.headers.get("Content-Length", "")
+    return int(length) if length.isdigit() else None
+
+
+def download(client, url, response, path, timeout, retries=DEFAULT_DOWNLOAD_RETRIES):
+    """
+    Writes the body of a streamed response to a file, hashing it on the way.
+    When the transfer breaks, it is resumed where it stopped with a `Range`
+    request, up to `retries` times, if the server accepts ranges. Its
+    `If-Range` header makes the server send the whole content instead if it
+    changed meanwhile, so two versions are never stitched together.
+
+    A broken response is closed before it is resumed, `response` included,
+    freeing its per-host slot for the new request.
+
+    Returns:
+        The MD5 checksum of the body, and the `VALIDATOR_HEADERS` of the
+        version downloaded, by header name.
+
+    Raises:
+        requests.exceptions.ConnectionError: The transfer broke, and could not
+            be resumed.
+        requests.exceptions.ChunkedEncodingError: Idem.
+    """
+    validator = resume_validator(response)
+    size = expected_size(response)
+    attempts = 0
+    current = response
+    with open(path, "wb") as f:
+        writer = HashedWriter(f)
+        while True:
+            try:
+                if current is None:
+                    time.sleep(RETRY_DELAY * attempts)
+                    offset = f.tell()
+                    headers = {}
+                    if offset:
+                        headers = {"Range": f"bytes={offset}-", "If-Range": validator}
+                    current = client.get(
+                        url,
+                        headers=headers,
+                        timeout=timeout,
+                        stream=True,
+                        allow_redirects=True,
+                    )
+                    start = re.match(
+                        r"bytes (\d+)-", current.headers.get("Content-Range", "")
+                    )
+                    if current.status_code == 200:
+                        if offset:
+                            info(f"{url} changed since its download started, starting over")
+                        f.seek(0)
+                        f.truncate()
+                        writer = HashedWriter(f)
+                        validator = resume_validator(current)
+                    elif not (
+                        current.status_code == 206
+                        and start
+                        and int(start.group(1)) == offset
+                    ):
+                        raise requests.exceptions.ConnectionError(
+                            f"Could not resume the download of {url}: "
+                            f"status {current.status_code}"
+                        )
+                    size = expected_size(current)
+                for chunk in current.iter_content(CHUNK_SIZE):
+                    writer.write(chunk)
+                if size is not None and f.tell() < size:
+                    raise requests.exceptions.ChunkedEncodingError(
+                        f"Incomplete download of {url}: {f.tell()} of {size} bytes"
+                    )
+                validators = {h: current.headers.get(h) for h in VALIDATOR_HEADERS.values()}
+                if current.status_code == 206:
+                    validators["Content-Length"] = str(size)  # Not of the range
+                return writer.hexdigest(), validators
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+            ) as e:
+                attempts += 1
+                if validator is None or attempts > retries:
+                    raise
+                info(f"Download of {url} broke after {f.tell()} bytes, resuming: {e}")
+                if current is not None:
+                    current.close()  # Frees its per-host slot for the retry
+            finally:
+                if current is not None and current is not response:
+                    current.close()
+            current = None
+
+
+def write_pretty_xml(f, path):
+    """
+    Writes an XML document pretty-printed to a file, hashing it on the way.
+
+    Parameters:
+        f: The binary file object to read the document from.
+        path(Path): The file to write.
+
+    Returns:
+        The MD5 checksum of the pretty-printed document.
+
+    Raises:
+        etree.ParseError: The document is not valid XML.
+    """
+    doc = etree.parse(f)
+    with open(path, "wb") as out:
+        writer = HashedWriter(out)
+        doc.write(writer, encoding="utf8", pretty_print=True)
+    return writer.hexdigest()
+
+
+def xml_checksum(open_content, fingerprint, pretty_path):
+    """
+    Parameters:
+        open_content(callable): Opens the XML document, as a binary file object.
+        fingerprint(str): One of `FINGERPRINT_METHODS`.
+        pretty_path(Path): The file to pretty-print the document to, with the
+            `pretty` method.
+
+    Returns:
+        The checksum of the document, computed with `fingerprint`.
+
+    Raises:
+        etree.ParseError: The document is not valid XML.
+    """
+    with open_content() as f:
+        if fingerprint == FINGERPRINT_PRETTY:
+            return write_pretty_xml(f, pretty_path)
+        return canonical_fingerprint(f)
+
+
+@contextmanager
+def open_zip_member(zip_path, member):
+    """
+    Opens a member of a ZIP archive on disk, for reading, decompressed as it
+    is read.
+    """
+    with zipfile.ZipFile(str(zip_path)) as z, z.open(member) as f:
+        yield f
+
+
+def member_checksums(zip_path, members, fingerprint, work_path):
+    """
+    Hashes each member of a ZIP archive on disk, streaming it: XML members
+    with `xml_checksum`, others as they are.
+
+    Returns:
+        The `(checksum, is_xml)` tuple of each member, by name.
+    """
+    checksums = {}
+    for member in members:
+        open_member = partial(open_zip_member, zip_path, member)
+        try:
+            checksums[member.filename] = (
+                xml_checksum(open_member, fingerprint, work_path),
+                True,
+            )
+        except etree.ParseError:
+            md5 = hashlib.md5()
+            with open_member() as f:
+                for chunk in iter_chunks(f):
+                    md5.update(chunk)
+            checksums[member.filename] = (md5.hexdigest(), False)
+    return checksums
+
+
+def combined_checksum(checksums):
+    """
+    Returns:
+        The checksum of a ZIP archive, from the checksums of its members as
+        returned by `member_checksums`.
+    """
+    md5 = hashlib.md5()
+    for name in sorted(checksums):
+        md5.update(f"{name}\0{checksums[name][0]}\0".encode("utf-8"))
+    return md5.hexdigest()
+
+
+def snapshot_members(
+    zip_path,
+    members,
+    checksums,
+    previous_dir,
+    previous_file_name,
+    ts,
+    blobs,
+    work_path,
+    diff,
+):
+    """
+    Stores the members of a ZIP archive which changed since the previous
+    snapshot, pretty-printed if XML, and diffs them. Unchanged members refer
+    to the blobs of the previous snapshot - including members whose checksum
+    changed only because it was computed with another fingerprint method,
+    their stored content being the same.
+
+    Parameters:
+        zip_path(Path): The ZIP archive.
+        members(list): The `ZipInfo` of the archive's files.
+        checksums(dict): The members' checksums, from `member_checksums`.
+        previous_dir(Path): The previous snapshot's directory, or `None`.
+        previous_file_name(str): The previous snapshot's file name, to find it
+            in the snapshots of previous versions, which have no manifest.
+        ts(str): The new snapshot's timestamp.
+        blobs(BlobStore): The store of the snapshots' content.
+        work_path(Path): A work file.
+        diff(str): How to diff the changed XML members, one of `DIFF_MODES`.
+
+    Returns:
+        The manifest entries of the new snapshot, and the lines of its diff,
+        as bytes.
+    """
+    previous = {}
+    if previous_dir is not None:
+        previous = read_manifest(previous_dir)
+        if previous is None:
+            previous = {previous_file_name: {"name": previous_file_name}}
+    entries = []
+    added, modified, diffs = [], [], []
+    for member in members:
+        name = member.filename
+        checksum, is_xml = checksums[name]
+        entry = previous.get(name)
+        if entry is not None and entry.get("checksum") == checksum:
+            entries.append(entry)
+            continue
+        with open_zip_member(zip_path, member) as f:
+            if is_xml:
+                write_pretty_xml(f, work_path)
+            else:
+                write_hashed(iter_chunks(f), work_path)
+        blob = blobs.put(work_path)
+        if entry is not None and entry.get("blob") == blob:
+            entries.append(dict(entry, checksum=checksum))
+            continue
+        entries.append({"name": name, "blob": blob, "checksum": checksum, "xml": is_xml})
+        if entry is None:
+            added.append(name)
+            continue
+        modified.append(name)
+        if is_xml and entry.get("xml", True):
+            diffs.extend(
+                diff_lines(
+                    partial(open_snapshot_file, previous_dir, name, blobs),
+                    partial(open, str(work_path), "rb"),
+                    f"{previous_dir.name}/{name}",
+                    f"{ts}/{name}",
+                    diff,
+                )
+            )
+    removed = sorted(set(previous) - set(checksums))
+    lines = [
+        f"Members: {len(previous)} -> {len(members)}, {len(added)} added, "
+        f"{len(removed)} removed, {len(modified)} modified".encode("utf-8")
+    ]
+    lines.extend(f"+ {name}".encode("utf-8") for name in added)
+    lines.extend(f"- {name}".encode("utf-8") for name in removed)
+    lines.extend(f"~ {name}".encode("utf-8") for name in modified)
+    return entries, lines + diffs
+
+
+def conditional_headers(validators):
+    """
+    Returns:
+        The request headers making a GET conditional on the content having
+        changed since the latest download, given its `validators`.
+    """
+    headers = {}
+    if validators.get("ETag"):
+        headers["If-None-Match"] = validators["ETag"]
+    if validators.get("Last-Modified"):
+        headers["If-Modified-Since"] = validators["Last-Modified"]
+    return headers
+
+
+def unchanged_by_head(client, url, timeout, validators):
+    """
+    Compares the headers of a HEAD request with the `validators` of the
+    latest download, for servers ignoring conditional requests.
+
+    Returns:
+        The status of the HEAD response if the content is known not to have
+        changed: the `ETag` or `Last-Modified` header, and the `Content-Length`
+        if any, are the same - else `None`.
+    """
+    if not (validators.get("ETag") or validators.get("Last-Modified")):
+        return None
+    with client.head(url, timeout=timeout, allow_redirects=True) as r:
+        if r.status_code != 200:
+            return None
+        compared = [h for h in validators if validators[h] and r.headers.get(h)]
+        if "ETag" not in compared and "Last-Modified" not in compared:
+            return None
+        if all(r.headers[h] == validators[h] for h in compared):
+            return r.status_code
+        return None
 
 
 def get_filename(content_disposition):
@@ -75,17 +517,109 @@ class ReliabilityMonitor:
         check_interval(float): Interval in seconds when each URL is to be checked.
         timeout(float): The timeout in seconds for the GET requests - if `None`,
             defaults to `DEFAULT_TIMEOUT`.
+        pool_size(int): Number of connections kept alive per host.
+        idle_timeout(float): Seconds after which unused connections are closed.
+        dns_cache(bool): Look up hosts through an in-process `DNSCache`,
+            instead of the system resolver on every new connection.
+        dns_timeout(float): Maximum time in seconds for a DNS lookup, with
+            `dns_cache`.
+        max_per_host(int): Maximum concurrent checks per host.
+        rate_per_host(float): Maximum checks per second per host. Checks over
+            either budget wait for their turn (see `HostLimiter`).
+        circuit_threshold(int): If set, after this many consecutive failed
+            checks of a host, its services fail fast, with one probe per check
+            interval (see `CircuitBreaker`).
+        phase(str): How to spread the checks over the interval, one of
+            `PHASE_MODES` (see `phase_offsets`). Unless `none`, the first
+            checks are spread over the interval too, instead of all running
+            at startup. Does not apply to services resumed from `state_path`.
+        jitter(float): Maximum random shift in seconds of each check.
+        max_workers(int): If set, checks run on a fixed pool of this many
+            threads instead of a new thread each (see `BoundedJobRunner`).
+        max_queue(int): Maximum number of checks waiting for a worker.
+        overflow(str): What to do with checks once the queue is full.
+        shard(tuple): If set, only the services of this `(index, count)` shard
+            are monitored (see `monitoring.sharding`).
+        reload_interval(float): If set, the services CSV is reloaded whenever
+            it changes, checking it this often in seconds. Only added and
+            removed services are (un)scheduled.
+        state_path(str): If set, the schedule and results directory of each
+            service are saved to this file every `checkpoint_interval` seconds
+            and on close, and resumed from it on startup (see `Checkpoint`). A
+            saved `output_dir` takes precedence.
+        checkpoint_interval(float): How often to save the schedule, in seconds.
     """
 
     def __init__(
-        self, services_csv, check_func, output_dir, check_interval, timeout=None
+        self,
+        services_csv,
+        check_func,
+        output_dir,
+        check_interval,
+        timeout=None,
+        pool_size=DEFAULT_POOL_SIZE,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT,
+        dns_cache=False,
+        dns_timeout=DEFAULT_DNS_TIMEOUT,
+        max_per_host=None,
+        rate_per_host=None,
+        circuit_threshold=None,
+        phase=PHASE_EVEN,
+        jitter=0,
+        max_workers=None,
+        max_queue=DEFAULT_MAX_QUEUE,
+        overflow=OVERFLOW_SKIP,
+        shard=None,
+        reload_interval=None,
+        state_path=None,
+        checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
     ):
-        self.services = self.services_from_csv(services_csv)
+        self.shard = shard
+        self.services = self.select_services(self.services_from_csv(services_csv))
+        self.checkpoint = Checkpoint(state_path) if state_path else None
+        self.checkpoint_interval = checkpoint_interval
+        if self.checkpoint is not None:
+            output_dir = self.checkpoint.get("output_dir", output_dir)
+            for url, service in self.services.items():
+                job = self.checkpoint.job(url)
+                if job is not None:
+                    self.services[url] = attr.evolve(
+                        service, results_dir=job["results_dir"]
+                    )
+        self.watcher = None
+        if reload_interval:
+            self.watcher = TargetsWatcher(
+                services_csv, self.services_from_csv, reload_interval
+            )
         self.check_func = check_func
         self.output_dir = output_dir
+        self.blobs = BlobStore(Path(output_dir) / BLOBS_DIR_NAME)
         self.check_interval = check_interval
         self.timeout = timeout or DEFAULT_TIMEOUT
-        self.scheduler = ThreadedScheduler()
+        self.dns_cache = DNSCache(timeout=dns_timeout) if dns_cache else None
+        self.client = HTTPClient(
+            pool_size=pool_size,
+            idle_timeout=idle_timeout,
+            dns_cache=self.dns_cache,
+            max_per_host=max_per_host,
+            rate_per_host=rate_per_host,
+            circuit_breaker=(
+                CircuitBreaker(circuit_threshold, probe_interval=check_interval)
+                if circuit_threshold
+                else None
+            ),
+        )
+        self.phase = phase
+        self.scheduler = HeapScheduler(jitter=jitter)
+        self.lag_stats = self.scheduler.lag_stats
+        self.runner = (
+            BoundedJobRunner(max_workers, max_queue, overflow, self.lag_stats)
+            if max_workers
+            else None
+        )
+        self.running_checks = 0
+        self.closing = False
+        self.checks_done = threading.Condition()
         self.init_result_dirs()
 
     @staticmethod
@@ -100,43 +634,202 @@ class ReliabilityMonitor:
             )
         return services
 
+    def select_services(self, services):
+        """
+        Returns:
+            The services of this monitor's shard, by URL.
+        """
+        services = select_shard(services, self.shard, key=lambda svc: svc.url)
+        return {service.url: service for service in services}
+
     def init_result_dirs(self):
-        for svc in self.services:
-            _ = ReliabilityDB.from_service(svc, self.output_dir)
+        for svc in self.services.values():
+            ReliabilityDB.from_service(svc, self.output_dir).close()
 
     def schedule_jobs(self):
         """
         Schedules a job for each service URL.
         """
-        for service in self.services:
-            info(
-                f"Scheduling check for {service.url} every {self.check_interval} seconds"
+        if self.phase == PHASE_NONE:
+            offsets = [0] * len(self.services)  # All run at startup
+        else:
+            offsets = phase_offsets(
+                list(self.services), self.check_interval, self.phase
+            )
+        for service, offset in zip(self.services.values(), offsets):
+            resumed = None
+            if self.checkpoint is not None:
+                resumed = self.checkpoint.resume(service.url)
+            self.schedule_check(service, *(resumed or (offset, self.check_interval)))
+        if self.checkpoint is not None:
+            self.scheduler.add("checkpoint", self.checkpoint_interval, self.save_state)
+        if self.watcher is not None:
+            self.scheduler.add("reload", self.watcher.interval, self.reload_services)
+        if self.runner is not None:
+            self.scheduler.add(
+                "runner_stats", self.check_interval, self.log_runner_stats
             )
-            self.scheduler.every(self.check_interval).seconds.do(
-                run_threaded_job,
-                partial(
-                    self.check_func,
-                    service=service,
-                    output_dir=Path(self.output_dir)
-                    / service.country_code
-                    / service.results_dir,
-                    timeout=self.timeout,
-                ),
+        if self.dns_cache is not None:
+            self.scheduler.add("dns_stats", self.check_interval, self.log_dns_stats)
+        if self.client.limiter is not None:
+            self.scheduler.add(
+                "host_limiter_stats", self.check_interval, self.log_host_limiter_stats
             )
+        if self.client.circuit_breaker is not None:
+            self.scheduler.add(
+                "circuit_stats", self.check_interval, self.log_circuit_stats
+            )
+
+    def schedule_check(self, service, offset, interval=None):
+        interval = interval or self.check_interval
+        info(f"Scheduling check for {service.url} every {interval} seconds")
+        job = partial(
+            self.run_check,
+            partial(
+                self.check_func,
+                service=service,
+                output_dir=Path(self.output_dir)
+                / service.country_code
+                / service.results_dir,
+                timeout=self.timeout,
+                client=self.client,
+                blobs=self.blobs,
+            ),
+        )
+        if self.runner is None:
+            self.scheduler.add(
+                service.url, interval, run_threaded_job, job, offset=offset
+            )
+        else:
+            self.scheduler.add(
+                service.url,
+                interval,
+                self.runner.submit,
+                service.url,
+                job,
+                offset=offset,
+                records_lag=True,
+            )
+
+    def run_check(self, check):
+        """
+        Runs a service's check, unless the monitor is closing, keeping count
+        of the running checks for `close`.
+        """
+        with self.checks_done:
+            if self.closing:
+                return
+            self.running_checks += 1
+        try:
+            check()
+        finally:
+            with self.checks_done:
+                self.running_checks -= 1
+                self.checks_done.notify_all()
+
+    def reload_services(self):
+        """
+        Reloads the services if the CSV file changed. Added services get a
+        results directory and are scheduled with an offset derived from their
+        URL's hash; removed ones are unscheduled, their results are kept.
+        """
+        services = self.watcher.poll()
+        if services is None:
+            return
+        services = self.select_services(services)
+        removed = [url for url in self.services if url not in services]
+        added = [services[url] for url in services if url not in self.services]
+        for url in removed:
+            info(f"Unscheduling check for {url}")
+            self.scheduler.remove(url)
+            del self.services[url]
+        for service in added:
+            ReliabilityDB.from_service(service, self.output_dir).close()
+            offset = None
+            if self.phase != PHASE_NONE:
+                offset = hash_offset(service.url, self.check_interval)
+            self.schedule_check(service, offset)
+            self.services[service.url] = service
+        info(
+            f"Reloaded {self.watcher.csv_path}: {len(added)} added, "
+            f"{len(removed)} removed, {len(self.services)} checked"
+        )
+
+    def log_runner_stats(self):
+        stats = ", ".join(f"{k}={v}" for k, v in self.runner.stats().items())
+        info(f"Worker pool: {stats}")
+
+    def log_dns_stats(self):
+        stats = ", ".join(f"{k}={v}" for k, v in self.dns_cache.stats().items())
+        info(f"DNS cache: {stats}")
+
+    def log_host_limiter_stats(self):
+        stats = ", ".join(f"{k}={v}" for k, v in self.client.limiter.stats().items())
+        info(f"Per-host limits: {stats}")
+
+    def log_circuit_stats(self):
+        stats = ", ".join(
+            f"{k}={v}" for k, v in self.client.circuit_breaker.stats().items()
+        )
+        info(f"Circuit breaker: {stats}")
 
     def run(self, interval=1):
         """
-        Schedules the jobs and runs the scheduler continuously, on default delay of 1 second.
+        Schedules the jobs and runs the scheduler continuously. The poison pill
+        is checked at least every `interval` seconds.
 
         Returns:
             The scheduler loop's thread poison pill (a `threading.Event` instance).
         """
         self.schedule_jobs()
         info("Starting scheduler")
-        return self.scheduler.run_continuously(interval=interval, run_all_first=True)
+        return self.scheduler.run_continuously(interval=interval)
+
+    def save_state(self):
+        """
+        Saves the schedule and results directory of each service, and the
+        output directory, to the state file.
+        """
+        jobs = self.scheduler.snapshot(list(self.services))
+        for url, job in jobs.items():
+            job["results_dir"] = self.services[url].results_dir
+        self.checkpoint.save(jobs, output_dir=self.output_dir)
+
+    def close(self, drain_timeout=None):
+        """
+        Waits for the running checks, then saves the state if enabled. Checks
+        due meanwhile are not started. Call once the monitor has been stopped.
+
+        Parameters:
+            drain_timeout(float): How long to wait for the running checks, in
+                seconds - if `None`, the check timeout. Checks still running
+                after it are logged, and the state is saved without them.
+        """
+        with self.checks_done:
+            self.closing = True
+            self.checks_done.wait_for(
+                lambda: not self.running_checks,
+                self.timeout if drain_timeout is None else drain_timeout,
+            )
+            if self.running_checks:
+                logger.warning(
+                    f"Closing with {self.running_checks} checks still running"
+                )
+        if self.checkpoint is not None:
+            self.save_state()
 
 
-def check_reliability(service, output_dir, timeout):
+def check_reliability(
+    service,
+    output_dir,
+    timeout,
+    client,
+    blobs=None,
+    fingerprint=FINGERPRINT_CANONICAL,
+    diff=DIFF_TEXT,
+    head_check=False,
+    download_retries=DEFAULT_DOWNLOAD_RETRIES,
+):
     """
     Checks the reliability of a URL, and appends the result to a CSV file.
 
@@ -145,19 +838,67 @@ def check_reliability(service, output_dir, timeout):
           output_path(str): The path of the CSV file to append the results to.
           timeout(float): The timeout in seconds for the GET requests - if `None`,
             defaults to `DEFAULT_CHECK_INTERVAL`.
+          client(HTTPClient): The shared HTTP client.
+          blobs(BlobStore): Where to store the content of the snapshots taken
+            when the download changes, the snapshot directories only holding a
+            manifest - if `None`, a store in `output_dir`.
+          fingerprint(str): How XML documents are hashed to detect changes,
+            one of `FINGERPRINT_METHODS`. With `canonical`, the document is
+            only pretty-printed for the snapshot, when it changed.
+          diff(str): How to diff a changed document against the previous
+            version, one of `DIFF_MODES`.
+          head_check(bool): Whether to send a HEAD request first, and skip the
+            download if its headers show the content is unchanged. The GET
+            request is conditional in any case, and a 304 response is recorded
+            as an unchanged check. Checks not downloading the content are
+            recorded with the status of the response, and `not_downloaded`.
+          download_retries(int): How many times to resume a broken download,
+            see `download`.
     """
 
     info(f"Checking {service.url}")
     ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
     db = ReliabilityDB(output_dir)
+    if blobs is None:
+        blobs = BlobStore(output_dir / BLOBS_DIR_NAME)
     checksum = None
     note = None
     diff_impossible = False
+    # Work files, removed once the check is done
+    download_path = output_dir / f".{ts}.download"
+    content_path = output_dir / f".{ts}.content"
     try:
+        validators = db.validators if db.latest_checksum is not None else {}
+        head_status = None
+        if head_check:
+            head_status = unchanged_by_head(client, service.url, timeout, validators)
+        if head_status is not None:
+            db.add_check(
+                ts,
+                checksum=db.latest_checksum,
+                status=head_status,
+                not_downloaded=True,
+                note="Not downloaded: unchanged according to a HEAD request",
+            )
+            return
 
-        with requests.get(
-            service.url, timeout=timeout, stream=True, allow_redirects=True
+        with client.get(
+            service.url,
+            headers=conditional_headers(validators),
+            timeout=timeout,
+            stream=True,
+            allow_redirects=True,
         ) as r:
+            if r.status_code == 304:
+                db.add_check(
+                    ts,
+                    checksum=db.latest_checksum,
+                    status=304,
+                    not_downloaded=True,
+                    note="Not modified",
+                )
+                return
+
             # Best effort file name
             header_file_name = get_filename(r.headers.get("content-disposition"))
             last_segment = service.url.split("/")[-1]
@@ -172,139 +913,333 @@ def check_reliability(service, output_dir, timeout):
             else:
                 file_name = "download"
 
-            content = r.content
+            checksum, validators = download(
+                client, service.url, r, download_path, timeout, download_retries
+            )
+            path = download_path
+            member = None
+            open_content = partial(open, str(download_path), "rb")
 
-            # Accept single file ZIP responses
+            # Read ZIP responses from the downloaded archive: a single file
+            # response is handled as that file, others member by member
+            members = None
             if last_segment.endswith("zip"):
-                with zipfile.ZipFile(io.BytesIO(content)) as z:
-                    files_info = z.infolist()
-                    if len(files_info) == 1:
-                        first_info = files_info[0]
-                        with z.open(first_info) as f:
-                            file_name = first_info.filename
-                            content = f.read()
-                    else:
-                        diff_impossible = True
-                        note = (
-                            "Could not perform diff: response is multi-file ZIP."
-                        )
-                        if not file_name.lower().endswith("zip"):
-                            file_name += ".zip"
+                with zipfile.ZipFile(str(download_path)) as z:
+                    files_info = [i for i in z.infolist() if not i.is_dir()]
+                if len(files_info) == 1:
+                    member = files_info[0]
+                    file_name = member.filename
+                    open_content = partial(open_zip_member, download_path, member)
+                else:
+                    members = files_info
+                    if not file_name.lower().endswith("zip"):
+                        file_name += ".zip"
 
-            if not diff_impossible:
-                # Attempt pretty-formatting to reduce diffs for compacted XML
+            latest_checksum = db.latest_checksum
+            previous_fingerprint = db.fingerprint or FINGERPRINT_PRETTY
+            pretty = False
+            if members is not None:
+                archive_checksum = checksum
+                checksums = member_checksums(
+                    download_path, members, fingerprint, content_path
+                )
+                checksum = combined_checksum(checksums)
+                if latest_checksum == archive_checksum:
+                    # Previous versions hashed multi-file archives as a whole
+                    latest_checksum = checksum
+                elif previous_fingerprint != fingerprint and latest_checksum:
+                    previous_checksum = combined_checksum(
+                        member_checksums(
+                            download_path, members, previous_fingerprint, content_path
+                        )
+                    )
+                    if previous_checksum == latest_checksum:
+                        latest_checksum = checksum
+            else:
                 try:
-                    doc = etree.parse(io.BytesIO(content))
-                    content = etree.tostring(doc, encoding="utf8", pretty_print=True)
+                    checksum = xml_checksum(open_content, fingerprint, content_path)
+                    pretty = fingerprint == FINGERPRINT_PRETTY
+                    if previous_fingerprint != fingerprint and latest_checksum:
+                        # Compare with the latest checksum the way it was computed
+                        previous_checksum = xml_checksum(
+                            open_content, previous_fingerprint, content_path
+                        )
+                        pretty = pretty or previous_fingerprint == FINGERPRINT_PRETTY
+                        if previous_checksum == latest_checksum:
+                            latest_checksum = checksum
                 except etree.ParseError:
                     diff_impossible = True
                     note = "Could not perform diff: invalid XML."
+                    if member is not None:
+                        with open_content() as f:
+                            checksum = write_hashed(iter_chunks(f), content_path)
+                        path = content_path
 
-            checksum = hashlib.md5(content).hexdigest()
             db.add_check(ts, checksum=checksum, status=r.status_code, note=note)
 
-            if checksum != db.latest_checksum:
+            if checksum != latest_checksum:
                 download_dir = output_dir / ts
                 download_dir.mkdir()
-                with open(download_dir / file_name, "wb") as f:
-                    f.write(content)
+                previous_dir = None
                 if db.latest_changed_ts is not None:
-                    if diff_impossible:
-                        diff_msg = note
-                    else:
-                        new_lines = content.splitlines()
-                        with open(
-                            output_dir / db.latest_changed_ts / db.latest_changed_file_name, "rb"
-                        ) as f:
-                            previous_lines = f.read().splitlines()
-                        diff = difflib.diff_bytes(
-                            difflib.unified_diff,
-                            previous_lines,
-                            new_lines,
-                            db.latest_changed_ts.encode("utf-8"),
-                            ts.encode("utf-8"),
-                        )
-                        diff_msg = [l for l in diff]
-
-                    with open(download_dir / "diff", "wb") as f:
-                        f.writelines(b"%b\n" % l for l in diff_msg)
+                    previous_dir = output_dir / db.latest_changed_ts
+                if members is not None:
+                    entries, lines = snapshot_members(
+                        download_path,
+                        members,
+                        checksums,
+                        previous_dir,
+                        db.latest_changed_file_name,
+                        ts,
+                        blobs,
+                        content_path,
+                        diff,
+                    )
+                    write_manifest(download_dir, entries)
+                    if previous_dir is not None:
+                        with open(download_dir / DIFF_FILE_NAME, "wb") as f:
+                            f.writelines(b"%b\n" % line for line in lines)
+                else:
+                    if not diff_impossible:
+                        # Stored pretty-printed, to reduce diffs of compacted XML
+                        if not pretty:
+                            with open_content() as f:
+                                write_pretty_xml(f, content_path)
+                        path = content_path
+                    entry = {
+                        "name": file_name,
+                        "blob": blobs.put(path),
+                        "checksum": checksum,
+                        "xml": not diff_impossible,
+                    }
+                    write_manifest(download_dir, [entry])
+                    if previous_dir is not None:
+                        if diff_impossible:
+                            with open(download_dir / DIFF_FILE_NAME, "w") as f:
+                                f.write(f"{note}\n")
+                        else:
+                            previous_name = db.latest_changed_file_name
+                            if file_name in (read_manifest(previous_dir) or {}):
+                                # E.g. the member left of an archive of several
+                                previous_name = file_name
+                            try:
+                                write_diff(
+                                    download_dir / DIFF_FILE_NAME,
+                                    partial(
+                                        open_snapshot_file,
+                                        previous_dir,
+                                        previous_name,
+                                        blobs,
+                                    ),
+                                    partial(open, str(path), "rb"),
+                                    db.latest_changed_ts,
+                                    ts,
+                                    diff,
+                                )
+                            except (KeyError, FileNotFoundError) as e:
+                                error(f"Could not diff {service.url}: {e}")
+                                with open(download_dir / DIFF_FILE_NAME, "w") as f:
+                                    f.write(
+                                        "Could not perform diff: no previous "
+                                        f"version of {file_name}.\n"
+                                    )
 
                 db.latest_changed_ts = ts
                 db.latest_changed_file_name = file_name
 
             db.latest_checksum = checksum
+            db.validators = validators if r.status_code == 200 else {}
+            if db.fingerprint != fingerprint:
+                db.fingerprint = fingerprint
 
     except requests.exceptions.Timeout:
         db.add_check(ts, timeout=True, note=note)
-    except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+    except CircuitOpenError:
+        db.add_check(
+            ts,
+            conn_error=True,
+            circuit_open=True,
+            note="Not requested: the host's circuit is open",
+        )
+    except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+        if is_dns_error(e):
+            note = "DNS lookup failed"
         db.add_check(ts, conn_error=True, note=note)
     except zipfile.BadZipFile:
         db.add_check(ts, content_error=True, note="Bad Zip file")
+    finally:
+        db.close()
+        for path in (download_path, content_path):
+            if path.exists():
+                path.unlink()
 
 
 class ReliabilityDB:
+    """
+    The checks and latest state of a service, in an SQLite database in the
+    service's results directory. Checks are indexed by timestamp, and the
+    latest state is kept as key/value metadata, so recording a check takes
+    the same time however long the history is.
+
+    The database is in WAL mode, so reports can read it while the monitor
+    writes to it.
+
+    Parameters:
+        root_dir(Path): The service's results directory.
+    """
+
+    file_name = "data.sqlite"
+    legacy_file_name = "data.json"
+    check_fields = (
+        "ts",
+        "checksum",
+        "status",
+        "timeout",
+        "conn_error",
+        "content_error",
+        "circuit_open",
+        "not_downloaded",
+        "note",
+    )
+    check_defaults = {
+        "timeout": False,
+        "conn_error": False,
+        "content_error": False,
+        "circuit_open": False,
+        "not_downloaded": False,
+    }
+
     def __init__(self, root_dir):
         self.root_dir = root_dir
-        self.meta_path = Path(root_dir) / "data.json"
-        self.db = TinyDB(self.meta_path)
+        self.db_path = Path(root_dir) / self.file_name
+        self.db = sqlite3.connect(str(self.db_path), timeout=30)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self.db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS checks (
+                    id INTEGER PRIMARY KEY,
+                    ts TEXT NOT NULL,
+                    checksum TEXT,
+                    status INTEGER,
+                    timeout INTEGER NOT NULL DEFAULT 0,
+                    conn_error INTEGER NOT NULL DEFAULT 0,
+                    content_error INTEGER NOT NULL DEFAULT 0,
+                    circuit_open INTEGER NOT NULL DEFAULT 0,
+                    not_downloaded INTEGER NOT NULL DEFAULT 0,
+                    note TEXT
+                )
+                """
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS checks_ts ON checks (ts)")
+            columns = {row["name"] for row in self.db.execute("PRAGMA table_info(checks)")}
+            if "not_downloaded" not in columns:
+                # Databases of previous versions
+                self.db.execute(
+                    "ALTER TABLE checks "
+                    "ADD COLUMN not_downloaded INTEGER NOT NULL DEFAULT 0"
+                )
 
     @classmethod
     def from_service(cls, service, root_dir):
+        """
+        Opens the database of a service, creating its results directory and
+        metadata if need be. A TinyDB `data.json` file left by a previous
+        version is migrated first.
+        """
         results_dir = Path(root_dir) / service.country_code / service.results_dir
-        results_dir.mkdir(parents=True)
+        results_dir.mkdir(parents=True, exist_ok=True)
         instance = cls(results_dir)
-        metadata = {"type": "metadata"}
-        metadata.update(attr.asdict(service))
-        instance.db.insert(metadata)
+        if instance.url is None:
+            if (results_dir / cls.legacy_file_name).exists():
+                instance.migrate_json()
+            if instance.url is None:
+                instance.set_metadata(**attr.asdict(service))
         return instance
 
+    def close(self):
+        self.db.close()
+
+    def get_metadata(self, key):
+        row = self.db.execute(
+            "SELECT value FROM metadata WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else row["value"]
+
+    def set_metadata(self, **values):
+        with self.db:
+            self._set_metadata(values)
+
+    def _set_metadata(self, values):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
+            values.items(),
+        )
+
     @property
     def metadata(self):
-        q = Query()
-        data = self.db.get(q.type == "metadata")
-        del data["type"]  # Drop type to match ServiceMetadata attrs
-        return ServiceMetadata(**data)
+        rows = self.db.execute("SELECT key, value FROM metadata")
+        return ServiceMetadata(**{row["key"]: row["value"] for row in rows})
 
     @property
     def url(self):
-        return self.metadata.url
+        return self.get_metadata("url")
 
     @property
     def latest_check_ts(self):
-        return self.metadata.latest_check_ts
+        return self.get_metadata("latest_check_ts")
 
     @latest_check_ts.setter
     def latest_check_ts(self, timestamp):
-        q = Query()
-        self.db.upsert({"latest_check_ts": timestamp}, q.type == "metadata")
+        self.set_metadata(latest_check_ts=timestamp)
 
     @property
     def latest_checksum(self):
-        return self.metadata.latest_checksum
+        return self.get_metadata("latest_checksum")
 
     @latest_checksum.setter
     def latest_checksum(self, checksum):
-        q = Query()
-        self.db.upsert({"latest_checksum": checksum}, q.type == "metadata")
+        self.set_metadata(latest_checksum=checksum)
 
     @property
     def latest_changed_ts(self):
-        return self.metadata.latest_changed_ts
+        return self.get_metadata("latest_changed_ts")
 
     @latest_changed_ts.setter
     def latest_changed_ts(self, timestamp):
-        q = Query()
-        self.db.upsert({"latest_changed_ts": timestamp}, q.type == "metadata")
+        self.set_metadata(latest_changed_ts=timestamp)
 
     @property
     def latest_changed_file_name(self):
-        return self.metadata.latest_changed_file_name
+        return self.get_metadata("latest_changed_file_name")
 
     @latest_changed_file_name.setter
     def latest_changed_file_name(self, file_name):
-        q = Query()
-        self.db.upsert({"latest_changed_file_name": file_name}, q.type == "metadata")
+        self.set_metadata(latest_changed_file_name=file_name)
 
+    @property
+    def validators(self):
+        """
+        The `VALIDATOR_HEADERS` of the latest download, by header name.
+        """
+        return {h: self.get_metadata(k) for k, h in VALIDATOR_HEADERS.items()}
+
+    @validators.setter
+    def validators(self, headers):
+        self.set_metadata(**{k: headers.get(h) for k, h in VALIDATOR_HEADERS.items()})
+
+    @property
+    def fingerprint(self):
+        return self.get_metadata("fingerprint")
+
+    @fingerprint.setter
+    def fingerprint(self, fingerprint):
+        self.set_metadata(fingerprint=fingerprint)
 
     def add_check(
         self,
@@ -314,30 +1249,136 @@ class ReliabilityDB:
         timeout=False,
         conn_error=False,
         content_error=False,
+        circuit_open=False,
+        not_downloaded=False,
         note=None,
     ):
         info(f"Saving check at {ts}")
-        self.db.insert(
-            {
-                "type": "check",
-                "ts": ts,
-                "checksum": checksum,
-                "status": status,
-                "timeout": timeout,
-                "conn_error": conn_error,
-                "content_error": content_error,
-                "note": note,
-            }
+        self.add_checks(
+            [
+                {
+                    "ts": ts,
+                    "checksum": checksum,
+                    "status": status,
+                    "timeout": timeout,
+                    "conn_error": conn_error,
+                    "content_error": content_error,
+                    "circuit_open": circuit_open,
+                    "not_downloaded": not_downloaded,
+                    "note": note,
+                }
+            ]
+        )
+
+    def add_checks(self, checks):
+        """
+        Records checks and sets the latest check timestamp, in one transaction.
+
+        Parameters:
+            checks(list): The checks, as dicts of `check_fields`, in time order.
+        """
+        with self.db:
+            self._insert_checks(checks)
+
+    def _insert_checks(self, checks):
+        columns = ", ".join(self.check_fields)
+        placeholders = ", ".join("?" * len(self.check_fields))
+        defaults = self.check_defaults
+        rows = [
+            [check.get(field, defaults.get(field)) for field in self.check_fields]
+            for check in checks
+        ]
+        if not rows:
+            return
+        self.db.executemany(
+            f"INSERT INTO checks ({columns}) VALUES ({placeholders})", rows
         )
-        self.latest_check_ts = ts
+        self._set_metadata({"latest_check_ts": rows[-1][0]})
 
     def get_check(self, ts):
-        q = Query()
-        self.db.get(q.type == "check", q.timestamp == ts)
+        """
+        Returns:
+            The check made at `ts`, as a dict, or `None`.
+        """
+        columns = ", ".join(self.check_fields)
+        row = self.db.execute(
+            f"SELECT {columns} FROM checks WHERE ts = ? ORDER BY id DESC LIMIT 1",
+            (ts,),
+        ).fetchone()
+        if row is None:
+            return None
+        check = dict(row)
+        for field in self.check_defaults:
+            check[field] = bool(check[field])
+        return check
 
     def get_latest_check(self):
         return self.get_check(self.latest_check_ts)
 
+    def migrate_json(self):
+        """
+        Replaces the content of the database with the metadata and checks of
+        the TinyDB `data.json` file of previous versions, in one transaction.
+        The JSON file is read as plain JSON, and left in place.
+
+        Returns:
+            The number of checks migrated.
+        """
+        with open(Path(self.root_dir) / self.legacy_file_name) as f:
+            documents = json.load(f).get("_default", {})
+        documents = [documents[doc_id] for doc_id in sorted(documents, key=int)]
+        metadata = next((d for d in documents if d.get("type") == "metadata"), {})
+        checks = [d for d in documents if d.get("type") == "check"]
+        fields = attr.fields_dict(ServiceMetadata)
+        with self.db:
+            self.db.execute("DELETE FROM checks")
+            self.db.execute("DELETE FROM metadata")
+            self._insert_checks(checks)
+            self._set_metadata({k: v for k, v in metadata.items() if k in fields})
+        info(f"Migrated {len(checks)} checks to {self.db_path}")
+        return len(checks)
+
+
+def run_monitor(args, shard=None):
+    """
+    Runs the monitor configured by the command line arguments until SIGTERM
+    or SIGINT, checking only the services of `shard` if set. Each shard has
+    its own state file.
+    """
+    state_path = args.state
+    if state_path and shard is not None:
+        state_path = shard_output_path(state_path, shard)
+    monitor = ReliabilityMonitor(
+        services_csv=args.endpoints_csv,
+        check_func=partial(
+            check_reliability,
+            fingerprint=args.fingerprint,
+            diff=args.diff,
+            head_check=args.head_check,
+            download_retries=args.download_retries,
+        ),
+        output_dir=args.output,
+        check_interval=args.check_interval,
+        pool_size=args.pool_size,
+        idle_timeout=args.idle_timeout,
+        dns_cache=args.dns_cache,
+        dns_timeout=args.dns_timeout,
+        max_per_host=args.max_per_host,
+        rate_per_host=args.rate_per_host,
+        circuit_threshold=args.circuit_threshold,
+        phase=args.phase,
+        jitter=args.jitter,
+        max_workers=args.max_workers,
+        max_queue=args.max_queue,
+        overflow=args.overflow,
+        shard=shard,
+        reload_interval=args.reload_interval,
+        state_path=state_path,
+        checkpoint_interval=args.checkpoint_interval,
+    )
+    wait_for_shutdown(monitor.run())
+    monitor.close()
+
 
 if __name__ == "__main__":
     import argparse
@@ -350,22 +1391,141 @@ if __name__ == "__main__":
 
     parser.add_argument("--endpoints-csv", help="Path to services CSV")
     parser.add_argument("--output", help="Path to results dir")
+    parser.add_argument(
+        "--reload-interval",
+        type=float,
+        help="Reload the endpoints CSV when changed, checking it this often, in seconds",
+    )
+    parser.add_argument(
+        "--state",
+        help="Save the schedule to this file, and resume from it when restarted",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        default=DEFAULT_CHECKPOINT_INTERVAL,
+        type=float,
+        help="How often to save the schedule, in seconds, with --state",
+    )
     parser.add_argument(
         "--check-interval",
         default=43200,
-        type=int,
+        type=float,
         help="Interval to check every endpoint at, in seconds. Defaults to 12h.",
     )
+    parser.add_argument(
+        "--pool-size",
+        default=DEFAULT_POOL_SIZE,
+        type=int,
+        help="Number of connections kept alive per host",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        default=DEFAULT_IDLE_TIMEOUT,
+        type=float,
+        help="Close connections to hosts not requested for this long, in seconds",
+    )
+    parser.add_argument(
+        "--dns-cache",
+        action="store_true",
+        default=False,
+        help="Cache DNS lookups in-process, for their TTL",
+    )
+    parser.add_argument(
+        "--dns-timeout",
+        default=DEFAULT_DNS_TIMEOUT,
+        type=float,
+        help="Maximum time for a DNS lookup, in seconds, with --dns-cache",
+    )
+    parser.add_argument(
+        "--max-per-host",
+        type=int,
+        help="Maximum number of concurrent checks per host",
+    )
+    parser.add_argument(
+        "--rate-per-host",
+        type=float,
+        help="Maximum number of checks per second per host",
+    )
+    parser.add_argument(
+        "--circuit-threshold",
+        type=int,
+        help="Fail fast for a host after this many consecutive failed checks, "
+        "probing it once per check interval until it responds again",
+    )
+    parser.add_argument(
+        "--phase",
+        default=PHASE_EVEN,
+        choices=PHASE_MODES,
+        help="How to spread the checks over the interval: evenly, by URL hash, or not at all",
+    )
+    parser.add_argument(
+        "--fingerprint",
+        default=FINGERPRINT_CANONICAL,
+        choices=FINGERPRINT_METHODS,
+        help="How to hash XML downloads to detect changes: streaming their canonical "
+        "form, or parsing and pretty-printing them whole as previous versions did",
+    )
+    parser.add_argument(
+        "--diff",
+        default=DIFF_TEXT,
+        choices=DIFF_MODES,
+        help="How to diff changed downloads: line by line, or GML feature by feature, "
+        "by their base:localId or gml:id",
+    )
+    parser.add_argument(
+        "--head-check",
+        action="store_true",
+        help="Skip the download when the ETag or Last-Modified, and Content-Length "
+        "headers of a HEAD request are those of the latest download",
+    )
+    parser.add_argument(
+        "--download-retries",
+        default=DEFAULT_DOWNLOAD_RETRIES,
+        type=int,
+        help="How many times to resume a broken download, if the server accepts "
+        "range requests",
+    )
+    parser.add_argument(
+        "--jitter",
+        default=0,
+        type=float,
+        help="Maximum random shift of each check, in seconds",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        help="Run checks on a fixed pool of this many threads, instead of a thread per check",
+    )
+    parser.add_argument(
+        "--max-queue",
+        default=DEFAULT_MAX_QUEUE,
+        type=int,
+        help="Maximum number of checks waiting for a worker, with --max-workers",
+    )
+    parser.add_argument(
+        "--overflow",
+        default=OVERFLOW_SKIP,
+        choices=OVERFLOW_POLICIES,
+        help="What to do with new checks once the queue is full, with --max-workers",
+    )
+    sharding = parser.add_mutually_exclusive_group()
+    sharding.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="Only check the services of shard i out of N (from 0), given as i/N",
+    )
+    sharding.add_argument(
+        "--processes",
+        default=1,
+        type=int,
+        help="Split the services across this many processes",
+    )
 
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO, format="%(message)s")
     logging.getLogger("schedule").setLevel(logging.WARNING)
 
-    monitor = ReliabilityMonitor(
-        services_csv=args.endpoints_csv,
-        check_func=check_reliability,
-        output_dir=args.output,
-        check_interval=args.check_interval,
-    )
-
-    monitor.run()
+    if args.processes > 1:
+        run_shards(args.processes, run_monitor, args)
+    else:
+        run_monitor(args, args.shard)
@@ -1,59 +1,432 @@
 import time
+import hashlib
+import heapq
+import itertools
 import logging
-import datetime
+import random
 import threading
-import schedule
+from collections import Counter, deque
 
 
 logger = logging.getLogger("schedule")
 
+OVERFLOW_SKIP = "skip"
+OVERFLOW_DROP_OLDEST = "drop-oldest"
+OVERFLOW_POLICIES = (OVERFLOW_SKIP, OVERFLOW_DROP_OLDEST)
+DEFAULT_MAX_QUEUE = 1000
+DEFAULT_LAG_WINDOW = 10000
 
-class ThreadedScheduler(schedule.Scheduler):
+PHASE_NONE = "none"
+PHASE_EVEN = "even"
+PHASE_HASH = "hash"
+PHASE_MODES = (PHASE_NONE, PHASE_EVEN, PHASE_HASH)
+
+
+def phase_offsets(keys, interval, mode):
+    """
+    Spreads the first run of a list of jobs over their interval.
+
+    Parameters:
+        keys(list): The job keys (e.g. URL's).
+        interval(float): The jobs' interval in seconds.
+        mode(str): One of `PHASE_MODES`:
+         - `none`: no offsets, all jobs first run after one interval.
+         - `even`: offsets evenly spaced over the interval, in list order.
+         - `hash`: offsets derived from a hash of the key, so they stay the
+           same when the list changes.
+
+    Returns:
+        A list with the start offset in seconds of each job, or `None` for no offset.
+    """
+    if mode == PHASE_NONE:
+        return [None] * len(keys)
+    if mode == PHASE_EVEN:
+        return [interval * i / len(keys) for i in range(len(keys))]
+    if mode == PHASE_HASH:
+        return [hash_offset(key, interval) for key in keys]
+    raise ValueError(f"Unknown phase mode: {mode}")
+
+
+def hash_offset(key, interval):
+    digest = hashlib.md5(key.encode("utf-8")).digest()
+    return interval * int.from_bytes(digest[:8], "big") / 2 ** 64
+
+
+class LagStats:
+    """
+    Keeps track of how late jobs start, compared to their scheduled time,
+    and how many scheduled runs never started. Percentiles are computed over
+    the latest `window` runs.
+    """
+
+    def __init__(self, window=DEFAULT_LAG_WINDOW):
+        self.lags = deque(maxlen=window)
+        self.count = 0
+        self.missed = 0
+        self.lock = threading.Lock()
+
+    def record(self, lag):
+        with self.lock:
+            self.lags.append(max(0, lag))
+            self.count += 1
+
+    def record_missed(self):
+        with self.lock:
+            self.missed += 1
+
+    def reset(self):
+        with self.lock:
+            self.lags.clear()
+            self.count = 0
+            self.missed = 0
+
+    def stats(self):
+        """
+        Returns:
+            A dict with the number of runs so far, the number of runs missed,
+            and the median, 95th percentile and maximum lag in seconds of the
+            latest runs.
+        """
+        with self.lock:
+            lags = sorted(self.lags)
+            count = self.count
+            missed = self.missed
+        if not lags:
+            return {"runs": count, "missed": missed, "p50": None, "p95": None, "max": None}
+        return {
+            "runs": count,
+            "missed": missed,
+            "p50": lags[(len(lags) - 1) // 2],
+            "p95": lags[int((len(lags) - 1) * 0.95)],
+            "max": lags[-1],
+        }
+
+
+class Job:
+    """
+    A job run every `interval` seconds by a `HeapScheduler`.
+    Run times are `time.monotonic()` values.
     """
-    Custom `Scheduler` that:
-     - executed the scheduler loop in its own thread (accepts poison pill).
-     - catches job exceptions, as per https://gist.github.com/mplewis/8483f1c24f2d6259aef6
+
+    def __init__(self, key, interval, job_func, args, kwargs, records_lag=False):
+        self.key = key
+        self.interval = interval
+        self.job_func = job_func
+        self.args = args
+        self.kwargs = kwargs
+        self.records_lag = records_lag
+        self.next_run = None  # Nominal, without jitter
+        self.run_at = None  # With jitter
+        self.last_run = None
+        self.version = 0  # Heap entries of older versions are stale
+        self.cancelled = False
+
+    def __repr__(self):
+        return f"Job(key={self.key!r}, interval={self.interval})"
+
+
+class HeapScheduler:
     """
+    Runs jobs at a fixed interval each, in its own thread (accepts poison pill).
+
+    Jobs are kept in a priority queue ordered by their next run time. The
+    scheduler thread sleeps until the earliest job is due, so each wakeup costs
+    O(log n) whatever the number of jobs, and jobs fire on time to within the
+    sleep precision instead of on the next polling tick.
+
+    Jobs run in the scheduler thread, so they should only hand off the actual
+    work - e.g. to `run_threaded_job` or `BoundedJobRunner.submit`. Job
+    exceptions are logged, and the job stays scheduled.
+
+    Runs missed because the scheduler fell behind are skipped, not caught up on.
+    How late jobs start is tracked in `lag_stats` (see `LagStats`).
 
-    def __init__(self, reschedule_on_failure=True):
+    Parameters:
+        jitter(float): Each run is shifted by a random delay of up to this many
+            seconds, either way. Does not accumulate over runs.
+    """
+
+    def __init__(self, jitter=0):
+        self.jitter = jitter
+        self.jobs = {}
+        self.heap = []
+        self.counter = itertools.count()  # Tie breaker for equal run times
+        self.condition = threading.Condition()
+        self.lag_stats = LagStats()
+
+    def add(self, key, interval, job_func, *args, offset=None, records_lag=False, **kwargs):
         """
-        If reschedule_on_failure is True, jobs will be rescheduled for their
-        next run as if they had completed successfully. If False, they'll run
-        on the next run_pending() tick.
+        Schedules `job_func(*args, **kwargs)` every `interval` seconds, with
+        its first run after `offset` seconds - or after one interval, if `None`.
+        A job already scheduled under the same key is replaced.
+
+        With `records_lag`, the job only hands the work off, and records the
+        lag itself when the work starts: it is called with the scheduled
+        `run_at` time as an extra keyword argument, e.g. for
+        `BoundedJobRunner.submit`.
+
+        Returns:
+            The `Job` instance.
         """
-        self.reschedule_on_failure = reschedule_on_failure
-        super().__init__()
+        job = Job(key, interval, job_func, args, kwargs, records_lag)
+        with self.condition:
+            if key in self.jobs:
+                logger.warning(f"Replacing scheduled job {key}")
+                self.jobs[key].cancelled = True
+            self.jobs[key] = job
+            job.next_run = time.monotonic() + (interval if offset is None else offset)
+            self._push(job)
+        return job
+
+    def remove(self, key):
+        """
+        Unschedules the job with the given key, if any.
+        """
+        with self.condition:
+            job = self.jobs.pop(key, None)
+            if job is not None:
+                job.cancelled = True
+
+    def set_interval(self, key, interval):
+        """
+        Changes the interval of a scheduled job. Its next run is moved to one
+        new interval after its last run, or now if that has passed.
+        """
+        with self.condition:
+            job = self.jobs.get(key)
+            if job is None or job.interval == interval:
+                return
+            job.interval = interval
+            now = time.monotonic()
+            job.next_run = max(now, (job.last_run or now) + interval)
+            self._push(job)
+
+    def snapshot(self, keys):
+        """
+        Returns:
+            By key, the `last_run` and `next_run` times of the scheduled jobs
+            with the given keys, as `time.time()` values, and their `interval`.
+        """
+        offset = time.time() - time.monotonic()
+        with self.condition:
+            return {
+                key: {
+                    "last_run": None if job.last_run is None else job.last_run + offset,
+                    "next_run": job.next_run + offset,
+                    "interval": job.interval,
+                }
+                for key, job in ((key, self.jobs.get(key)) for key in keys)
+                if job is not None
+            }
+
+    def _push(self, job):
+        job.version += 1
+        run_at = job.next_run
+        if self.jitter:
+            run_at += random.uniform(-self.jitter, self.jitter)
+        job.run_at = run_at
+        heapq.heappush(self.heap, (run_at, next(self.counter), job.version, job))
+        self.condition.notify()
+
+    def _pop_due(self, now):
+        """
+        Returns:
+            The jobs due at `now`, and the time of the next run after them.
+        """
+        due = []
+        while self.heap:
+            run_at, _, version, job = self.heap[0]
+            if job.cancelled or version != job.version:
+                heapq.heappop(self.heap)
+            elif run_at <= now:
+                heapq.heappop(self.heap)
+                due.append(job)
+            else:
+                return due, run_at
+        return due, None
 
     def _run_job(self, job):
+        job.last_run = time.monotonic()
+        kwargs = job.kwargs
+        if job.records_lag:
+            kwargs = dict(kwargs, run_at=job.run_at)
+        else:
+            self.lag_stats.record(job.last_run - job.run_at)
         try:
-            super()._run_job(job)
+            job.job_func(*job.args, **kwargs)
         except Exception:
             logger.exception("Scheduled job exception: ")
-            job.last_run = datetime.datetime.now()
-            job._schedule_next_run()
+        with self.condition:
+            if job.cancelled:
+                return
+            job.next_run += job.interval
+            lag = time.monotonic() - job.next_run
+            if lag > 0:
+                job.next_run += (lag // job.interval + 1) * job.interval
+            self._push(job)
+
+    def run_all(self):
+        """
+        Runs all jobs now, then reschedules them one interval later.
+        """
+        with self.condition:
+            jobs = list(self.jobs.values())
+            now = time.monotonic()
+            for job in jobs:
+                job.next_run = job.run_at = now
+        for job in jobs:
+            self._run_job(job)
 
     def run_continuously(self, interval=1, run_all_first=False):
-        stop_continuous_run = threading.Event()
+        """
+        Runs the scheduler loop in its own thread.
 
-        class ScheduleThread(threading.Thread):
-            @classmethod
-            def run(cls):
-                if run_all_first: 
-                    self.run_all()
-                while not stop_continuous_run.is_set():
-                    self.run_pending()
-                    time.sleep(interval)
-
-        scheduler_thread = ScheduleThread()
-        scheduler_thread.start()
-        return stop_continuous_run
+        Parameters:
+            interval(float): Maximum delay in seconds before the poison pill
+                is noticed.
+            run_all_first(bool): Run all jobs once when starting.
 
+        Returns:
+            The scheduler loop's thread poison pill (a `threading.Event` instance).
+        """
+        stop_continuous_run = threading.Event()
 
-threaded_scheduler = ThreadedScheduler()
-jobs = threaded_scheduler.jobs
+        def run():
+            if run_all_first:
+                self.run_all()
+            while not stop_continuous_run.is_set():
+                with self.condition:
+                    due, next_run_at = self._pop_due(time.monotonic())
+                    if not due:
+                        timeout = interval
+                        if next_run_at is not None:
+                            timeout = min(interval, next_run_at - time.monotonic())
+                        self.condition.wait(max(0, timeout))
+                for job in due:
+                    self._run_job(job)
+
+        threading.Thread(target=run).start()
+        return stop_continuous_run
 
 
 def run_threaded_job(job):
     job_thread = threading.Thread(target=job)
     job_thread.start()
     return job_thread
+
+
+class BoundedJobRunner:
+    """
+    Runs jobs on a fixed number of worker threads, fed from a bounded queue.
+
+    Every job has a key (e.g. the URL it checks). A job whose key is still
+    queued or running is skipped, so a slow URL never has more than one check
+    in flight. When the queue is full, the overflow policy applies:
+     - `skip`: the new job is skipped.
+     - `drop-oldest`: the oldest queued job is dropped to make room.
+
+    Jobs submitted with their scheduled `run_at` time have their lag recorded
+    in `lag_stats` when a worker starts them, time spent in the queue
+    included, and count as missed runs if skipped or dropped.
+
+    Parameters:
+        max_workers(int): Number of worker threads.
+        max_queue(int): Maximum number of jobs waiting for a worker.
+        overflow(str): One of `OVERFLOW_POLICIES`.
+        lag_stats(LagStats): Where to record the lag of the jobs - if `None`,
+            a new one.
+    """
+
+    def __init__(
+        self,
+        max_workers,
+        max_queue=DEFAULT_MAX_QUEUE,
+        overflow=OVERFLOW_SKIP,
+        lag_stats=None,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.lag_stats = lag_stats if lag_stats is not None else LagStats()
+        self.queue = deque()
+        self.in_flight = set()
+        self.counters = Counter()
+        self.condition = threading.Condition()
+        for _ in range(max_workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def submit(self, key, job, run_at=None):
+        """
+        Queues a job, unless the overflow policy rejects it.
+
+        Parameters:
+            key: The job's key.
+            job(callable): The job.
+            run_at(float): The `time.monotonic()` time the job was scheduled
+                at, to record its lag - if `None`, it is not recorded.
+
+        Returns:
+            `True` if the job was queued.
+        """
+        with self.condition:
+            if key in self.in_flight:
+                self.counters["skipped"] += 1
+                self._record_missed(run_at)
+                logger.warning(f"Skipping {key}: previous run still in flight")
+                return False
+            if len(self.queue) >= self.max_queue:
+                if self.overflow == OVERFLOW_SKIP:
+                    self.counters["skipped"] += 1
+                    self._record_missed(run_at)
+                    logger.warning(f"Skipping {key}: job queue is full")
+                    return False
+                dropped_key, _, dropped_run_at = self.queue.popleft()
+                self.in_flight.discard(dropped_key)
+                self.counters["dropped"] += 1
+                self._record_missed(dropped_run_at)
+                logger.warning(f"Dropping {dropped_key}: job queue is full")
+            self.queue.append((key, job, run_at))
+            self.in_flight.add(key)
+            self.counters["queued"] += 1
+            self.condition.notify()
+            return True
+
+    def _record_missed(self, run_at):
+        if run_at is not None:
+            self.lag_stats.record_missed()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                key, job, run_at = self.queue.popleft()
+            if run_at is not None:
+                self.lag_stats.record(time.monotonic() - run_at)
+            outcome = "completed"
+            try:
+                job()
+            except Exception:
+                outcome = "failed"
+                logger.exception("Scheduled job exception: ")
+            finally:
+                with self.condition:
+                    self.in_flight.discard(key)
+                    self.counters[outcome] += 1
+
+    def stats(self):
+        """
+        Returns:
+            A dict with the number of jobs queued, skipped, dropped, completed
+            and failed (failed jobs are not counted as completed) so far, and
+            the number currently pending and running.
+        """
+        with self.condition:
+            stats = {
+                name: self.counters[name]
+                for name in ("queued", "skipped", "dropped", "completed", "failed")
+            }
+            stats["pending"] = len(self.queue)
+            stats["running"] = len(self.in_flight) - len(self.queue)
+        return stats
@@ -0,0 +1,170 @@
+import argparse
+import bisect
+import csv
+import hashlib
+import heapq
+import logging
+import multiprocessing
+import signal
+import threading
+from pathlib import Path
+
+logger = logging.getLogger("sharding")
+info, debug, error = logger.info, logger.debug, logger.error
+
+DEFAULT_REPLICAS = 100
+DEFAULT_MERGE_WINDOW = 10000
+
+
+def stable_hash(key):
+    """
+    Returns:
+        A 64 bit hash of a string, the same across processes and restarts.
+    """
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+def parse_shard(value):
+    """
+    Parses a shard specification like `2/8` (shard 2 out of 8, from 0), as
+    an argparse `type`.
+
+    Returns:
+        The `(index, count)` tuple.
+
+    Raises:
+        argparse.ArgumentTypeError: The specification is invalid, argparse
+            showing the message.
+    """
+    try:
+        index, count = (int(n) for n in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Invalid shard: {value}, expected <index>/<count>"
+        )
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            f"Invalid shard: {value}, index must be in 0..{count - 1}"
+        )
+    return index, count
+
+
+class HashRing:
+    """
+    Consistent hash ring assigning keys (e.g. URL's) to shards. Each shard
+    owns `replicas` points on the ring, and a key belongs to the shard owning
+    the next point after the key's hash. Going from N to N+1 shards only
+    moves about 1/(N+1) of the keys, all to the new shard.
+
+    Parameters:
+        count(int): Number of shards.
+        replicas(int): Ring points per shard - more spread the keys more evenly.
+    """
+
+    def __init__(self, count, replicas=DEFAULT_REPLICAS):
+        self.points = sorted(
+            (stable_hash(f"shard-{shard}-{replica}"), shard)
+            for shard in range(count)
+            for replica in range(replicas)
+        )
+        self.hashes = [h for h, _ in self.points]
+
+    def shard_for(self, key):
+        i = bisect.bisect(self.hashes, stable_hash(key)) % len(self.points)
+        return self.points[i][1]
+
+
+def select_shard(items, shard, key=str):
+    """
+    Parameters:
+        items(list): The items to split across shards.
+        shard(tuple): The `(index, count)` shard to select, or `None` for all.
+        key(callable): Returns the key hashed to assign an item to a shard.
+
+    Returns:
+        The items belonging to the shard.
+    """
+    if shard is None:
+        return list(items)
+    index, count = shard
+    ring = HashRing(count)
+    return [item for item in items if ring.shard_for(key(item)) == index]
+
+
+def shard_output_path(output_path, shard):
+    """
+    Returns:
+        The results file of a shard, e.g. `availability.shard-2-of-8.csv`.
+    """
+    path = Path(output_path)
+    index, count = shard
+    return str(path.with_name(f"{path.stem}.shard-{index}-of-{count}{path.suffix}"))
+
+
+def run_shards(count, target, *args):
+    """
+    Runs `target(*args, shard=(index, count))` in a process per shard, until
+    SIGTERM or SIGINT is received, which is passed on to the processes.
+    """
+    processes = [
+        multiprocessing.Process(
+            target=target, args=args, kwargs={"shard": (index, count)}
+        )
+        for index in range(count)
+    ]
+    for process in processes:
+        process.start()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    while not stop.wait(1):
+        if not any(process.is_alive() for process in processes):
+            break
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+def read_sorted(csv_path, window=DEFAULT_MERGE_WINDOW):
+    """
+    Yields the rows of a results CSV file ordered by timestamp. Rows are
+    written as checks complete, so may be slightly out of order - by at most
+    `window` rows.
+    """
+    buffer = []
+    with open(csv_path) as f:
+        for i, row in enumerate(csv.reader(f, delimiter="\t")):
+            heapq.heappush(buffer, (row[0], i, row))
+            if len(buffer) > window:
+                yield heapq.heappop(buffer)[2]
+    while buffer:
+        yield heapq.heappop(buffer)[2]
+
+
+def merge_results(csv_paths, output_path, window=DEFAULT_MERGE_WINDOW):
+    """
+    Merges the results CSV files of several shards into one, ordered by
+    timestamp. Streams the rows, so the files can be of any size.
+    """
+    rows = heapq.merge(*(read_sorted(p, window) for p in csv_paths), key=lambda r: r[0])
+    with open(output_path, "w") as f:
+        csv.writer(f, delimiter="\t").writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Merge the availability results CSV files of several shards. "
+        "Parquet results need no merging, all shards can write to the same directory."
+    )
+    parser.add_argument("results_csv", nargs="+", help="Per-shard results CSV files")
+    parser.add_argument("--output", required=True, help="Path to the merged CSV file")
+    parser.add_argument(
+        "--window",
+        default=DEFAULT_MERGE_WINDOW,
+        type=int,
+        help="Maximum number of rows a result may be out of order by, in a shard's file",
+    )
+    args = parser.parse_args()
+    merge_results(args.results_csv, args.output, args.window)
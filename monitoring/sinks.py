@@ -0,0 +1,231 @@
+import csv
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from uuid import uuid4
+
+import pyarrow
+import pyarrow.parquet
+
+logger = logging.getLogger("sink")
+info, debug, error = logger.info, logger.debug, logger.error
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 5
+
+OUTPUT_CSV = "csv"
+OUTPUT_PARQUET = "parquet"
+OUTPUT_FORMATS = (OUTPUT_CSV, OUTPUT_PARQUET)
+
+# Availability result columns, in row order
+RESULT_SCHEMA = pyarrow.schema(
+    [
+        ("ts", pyarrow.timestamp("us", tz="UTC")),
+        ("url_id", pyarrow.int32()),
+        ("status_code", pyarrow.int16()),
+        ("content_length", pyarrow.int64()),
+        ("content_type", pyarrow.string()),
+        ("duration", pyarrow.float64()),
+        ("last_modified", pyarrow.string()),
+        ("timed_out", pyarrow.bool_()),
+        ("connection_error", pyarrow.bool_()),
+        ("check_interval", pyarrow.float64()),
+        ("dns_duration", pyarrow.float64()),
+        ("connect_duration", pyarrow.float64()),
+        ("tls_duration", pyarrow.float64()),
+        ("ttfb", pyarrow.float64()),
+        ("dns_error", pyarrow.bool_()),
+        ("circuit_open", pyarrow.bool_()),
+    ]
+)
+
+
+class ResultSink:
+    """
+    Writes result rows from a dedicated writer thread. Checks only queue
+    their rows; the writer writes them in batches, once `batch_size` rows are
+    pending or every `flush_interval` seconds, whichever comes first.
+
+    Subclasses implement `open`, `write_batch` and `finish`, all called from
+    the writer thread. A batch that fails to be written is logged and
+    dropped, and the writer carries on with the next one.
+
+    Parameters:
+        output_path(str): Where to write the results to.
+        batch_size(int): Number of pending rows that triggers a write.
+        flush_interval(float): Maximum delay in seconds before a queued row is
+            written.
+    """
+
+    _close = object()
+
+    def __init__(
+        self,
+        output_path,
+        batch_size=DEFAULT_BATCH_SIZE,
+        flush_interval=DEFAULT_FLUSH_INTERVAL,
+    ):
+        self.output_path = output_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.closed = False
+        self.writer_thread = threading.Thread(target=self._write, daemon=True)
+        self.writer_thread.start()
+
+    def put(self, row):
+        """
+        Queues a row for writing. Does not block. Rows put once the sink is
+        closed are not written, and logged instead.
+        """
+        if self.closed:
+            logger.warning(f"Result sink closed, dropping row: {row}")
+            return
+        self.queue.put(row)
+
+    def close(self):
+        """
+        Writes the pending rows, fsyncs the output and stops the writer thread.
+        """
+        self.closed = True
+        self.queue.put(self._close)
+        self.writer_thread.join()
+
+    def open(self):
+        raise NotImplementedError
+
+    def write_batch(self, rows):
+        raise NotImplementedError
+
+    def finish(self):
+        raise NotImplementedError
+
+    def _write(self):
+        self.open()
+        try:
+            batch = []
+            closing = False
+            flush_at = time.monotonic() + self.flush_interval
+            while not closing:
+                try:
+                    row = self.queue.get(timeout=max(0, flush_at - time.monotonic()))
+                    if row is self._close:
+                        closing = True
+                    else:
+                        batch.append(row)
+                except queue.Empty:
+                    pass
+                if (
+                    closing
+                    or len(batch) >= self.batch_size
+                    or time.monotonic() >= flush_at
+                ):
+                    if batch:
+                        try:
+                            self.write_batch(batch)
+                        except Exception:
+                            logger.exception(f"Could not write {len(batch)} results: ")
+                    batch = []
+                    flush_at = time.monotonic() + self.flush_interval
+        finally:
+            self.finish()
+
+
+class CSVResultSink(ResultSink):
+    """
+    Appends result rows to a tab-separated CSV file, kept open in between
+    batches. Timestamps are written in ISO 8601 format.
+    """
+
+    def open(self):
+        self.file = open(self.output_path, "a")
+        self.writer = csv.writer(self.file, delimiter="\t")
+
+    def write_batch(self, rows):
+        self.writer.writerows(
+            [v.isoformat() if isinstance(v, datetime) else v for v in row]
+            for row in rows
+        )
+        self.file.flush()
+
+    def finish(self):
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
+class ParquetResultSink(ResultSink):
+    """
+    Writes result rows to compressed Parquet files with typed columns (see
+    `RESULT_SCHEMA`), partitioned by day: `<output_path>/date=<YYYY-MM-DD>/`.
+
+    Each batch is written as a row group. A Parquet file can only be read
+    once closed, so files are rotated every hour - at most the last hour of
+    results is lost if the monitor is killed without closing the sink. The
+    file being written has a `.parquet.tmp` name, and only gets its
+    `.parquet` one once closed, so readers never see it.
+    Every writer uses its own file names, so several monitors can write to
+    the same directory.
+    """
+
+    def open(self):
+        Path(self.output_path).mkdir(parents=True, exist_ok=True)
+        self.writer = None
+        self.writer_hour = None
+
+    def write_batch(self, rows):
+        for hour in sorted({row[0].strftime("%Y-%m-%d %H") for row in rows}):
+            hour_rows = [
+                row for row in rows if row[0].strftime("%Y-%m-%d %H") == hour
+            ]
+            self._writer_for(hour).write_table(self._to_table(hour_rows))
+
+    def _writer_for(self, hour):
+        if hour != self.writer_hour:
+            self._close_writer()
+            day, hour_no = hour.split()
+            partition = Path(self.output_path) / f"date={day}"
+            partition.mkdir(exist_ok=True)
+            self.writer_path = partition / f"part-{hour_no}-{uuid4().hex}.parquet"
+            self.writer = pyarrow.parquet.ParquetWriter(
+                f"{self.writer_path}.tmp", RESULT_SCHEMA, compression="snappy"
+            )
+            self.writer_hour = hour
+        return self.writer
+
+    def _close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            with open(f"{self.writer_path}.tmp", "rb") as f:
+                os.fsync(f.fileno())
+            os.replace(f"{self.writer_path}.tmp", str(self.writer_path))
+            self.writer = None
+            self.writer_hour = None
+
+    @staticmethod
+    def _to_table(rows):
+        arrays = []
+        for field, values in zip(RESULT_SCHEMA, zip(*rows)):
+            if pyarrow.types.is_boolean(field.type):
+                values = [None if v is None else bool(v) for v in values]
+            arrays.append(pyarrow.array(values, type=field.type))
+        return pyarrow.Table.from_arrays(arrays, schema=RESULT_SCHEMA)
+
+    def finish(self):
+        self._close_writer()
+
+
+def make_sink(output_format, output_path, batch_size, flush_interval):
+    """
+    Returns:
+        The result sink for an output format, one of `OUTPUT_FORMATS`.
+    """
+    sinks = {OUTPUT_CSV: CSVResultSink, OUTPUT_PARQUET: ParquetResultSink}
+    try:
+        sink_cls = sinks[output_format]
+    except KeyError:
+        raise ValueError(f"Unknown output format: {output_format}")
+    return sink_cls(output_path, batch_size, flush_interval)
@@ -0,0 +1,21 @@
+from monitoring.blobstore import BlobStore, extract_snapshot, write_manifest
+
+
+def test_extract_snapshot(tmp_path):
+    blobs = BlobStore(tmp_path / "blobs")
+    (tmp_path / "content").write_bytes(b"<a/>")
+    snapshot_dir = tmp_path / "20260101_000000"
+    snapshot_dir.mkdir()
+    write_manifest(snapshot_dir, [{"name": "a.xml", "blob": blobs.put(tmp_path / "content")}])
+    assert extract_snapshot(snapshot_dir, blobs, tmp_path / "out") == 1
+    assert (tmp_path / "out" / "a.xml").read_bytes() == b"<a/>"
+
+
+def test_extract_snapshot_of_plain_copies(tmp_path):
+    snapshot_dir = tmp_path / "20200101_000000"
+    snapshot_dir.mkdir()
+    (snapshot_dir / "download").write_bytes(b"<a/>")
+    (snapshot_dir / "diff").write_bytes(b"")
+    blobs = BlobStore(tmp_path / "blobs")
+    assert extract_snapshot(snapshot_dir, blobs, tmp_path / "out") == 1
+    assert [p.name for p in (tmp_path / "out").iterdir()] == ["download"]
@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+from monitoring.checkpoint import Checkpoint
+from monitoring.common import Monitor
+
+
+def test_resume_restores_next_runs_and_skips_missed_runs(tmp_path, monkeypatch):
+    state_path = str(tmp_path / "state.json")
+    now = time.time()
+    Checkpoint(state_path).save(
+        {
+            "due": {"next_run": now + 30, "interval": 60},
+            "overdue": {"next_run": now - 150, "interval": 60},
+            "rescheduled": {"next_run": now + 300, "interval": 60},
+        },
+        output_path="results.csv",
+    )
+    monkeypatch.setattr(time, "time", lambda: now)
+    checkpoint = Checkpoint(state_path)
+    assert checkpoint.get("output_path") == "results.csv"
+    assert checkpoint.resume("due") == (30, 60)
+    assert checkpoint.resume("overdue") == (30, 60)  # Keeps the phase
+    assert checkpoint.resume("rescheduled") == (60, 60)
+    assert checkpoint.resume("new") is None
+
+
+def test_unreadable_state_is_ignored(tmp_path):
+    state_path = tmp_path / "state.json"
+    state_path.write_text("{")
+    assert Checkpoint(str(state_path)).resume("a") is None
+    state_path.write_text('{"version": 0, "jobs": {"a": {}}}')
+    assert Checkpoint(str(state_path)).resume("a") is None
+
+
+def test_monitor_resumes_its_schedule(tmp_path, monkeypatch):
+    state_path = str(tmp_path / "state.json")
+    urls = ["http://a", "http://b"]
+
+    def check(**kwargs):
+        pass
+
+    monitor = Monitor(
+        urls, check, str(tmp_path / "results.csv"), 60, state_path=state_path
+    )
+    monitor.schedule_jobs()
+    monitor.scheduler.set_interval(1, 120)
+    saved = monitor.snapshot()
+    monitor.close()
+
+    restarted_at = saved[0]["next_run"] + 70
+    monkeypatch.setattr(time, "time", lambda: restarted_at)
+    monitor = Monitor(
+        urls, check, str(tmp_path / "other.csv"), 60, state_path=state_path
+    )
+    try:
+        assert monitor.output_path == str(tmp_path / "results.csv")
+        schedule = monitor.initial_schedule()
+    finally:
+        monitor.close()
+    # The first check was due at startup, the other moved to 120s later
+    assert schedule == {
+        0: (pytest.approx(50, abs=1), 60),
+        1: (pytest.approx(50, abs=1), 120),
+    }
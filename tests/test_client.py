@@ -0,0 +1,169 @@
+import http.server
+import socket
+import socketserver
+import threading
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from monitoring import client as client_module
+from monitoring.availability import check_availability
+from monitoring.client import CircuitBreaker, CircuitOpenError, DNSCache, HTTPClient
+
+
+class CookieHandler(http.server.BaseHTTPRequestHandler):
+    """
+    `/login` sets a session cookie and redirects to `/data`, which returns
+    the cookies it got.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/login":
+            self.send_response(302)
+            self.send_header("Set-Cookie", "session=1; Path=/")
+            self.send_header("Location", "/data")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = (self.headers.get("Cookie") or "").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def base_url():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), CookieHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://localhost:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_cookies_kept_along_redirects_only(base_url):
+    client = HTTPClient()
+    assert client.get(f"{base_url}/login").text == "session=1"
+    assert client.get(f"{base_url}/data").text == ""
+
+
+class Lookups:
+    """
+    Stands in for `DNSCache._lookup`, answering with `answers`, in turn, and
+    counting the calls. An answer of `None` fails the lookup.
+    """
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.calls = 0
+
+    def __call__(self, host, port):
+        self.calls += 1
+        answer = self.answers.pop(0)
+        if answer is None:
+            raise socket.gaierror("Name or service not known")
+        return answer
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(client_module.time, "monotonic", lambda: clock[0])
+    return clock
+
+
+def test_dns_cache_keeps_answers_for_their_ttl(clock):
+    cache = DNSCache(min_ttl=5, max_ttl=60)
+    cache._lookup = Lookups((["10.0.0.1"], 30), (["10.0.0.2"], 1), (["10.0.0.3"], 600))
+    assert cache.resolve("example.test", 80) == ["10.0.0.1"]
+    clock[0] += 29
+    assert cache.resolve("example.test", 80) == ["10.0.0.1"]
+    clock[0] += 2
+    assert cache.resolve("example.test", 80) == ["10.0.0.2"]
+    clock[0] += 4  # The TTL of 1s is raised to `min_ttl`
+    assert cache.resolve("example.test", 80) == ["10.0.0.2"]
+    clock[0] += 2
+    assert cache.resolve("example.test", 80) == ["10.0.0.3"]
+    clock[0] += 61  # The TTL of 600s is lowered to `max_ttl`
+    cache._lookup.answers.append((["10.0.0.4"], 30))
+    assert cache.resolve("example.test", 80) == ["10.0.0.4"]
+    assert cache.resolve("10.0.0.5", 80) == ["10.0.0.5"]
+    assert cache._lookup.calls == 4
+    assert cache.stats() == {"hits": 2, "misses": 4, "stale": 0, "errors": 0, "hosts": 1}
+
+
+def test_dns_cache_serves_stale_answers_on_failure(clock):
+    cache = DNSCache()
+    cache._lookup = Lookups((["10.0.0.1"], 30), None, (["10.0.0.2"], 30))
+    assert cache.resolve("example.test", 80) == ["10.0.0.1"]
+    clock[0] += 31
+    assert cache.resolve("example.test", 80) == ["10.0.0.1"]
+    assert cache.resolve("example.test", 80) == ["10.0.0.2"]
+    assert cache.stats()["stale"] == 1
+
+
+def test_dns_cache_caches_failures(clock):
+    cache = DNSCache(negative_ttl=30)
+    cache._lookup = Lookups(None, (["10.0.0.1"], 30))
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            cache.resolve("example.test", 80)
+    assert cache._lookup.calls == 1
+    clock[0] += 31
+    assert cache.resolve("example.test", 80) == ["10.0.0.1"]
+    assert cache.stats()["errors"] == 1
+
+
+def test_dns_failure_is_a_connection_error(clock):
+    cache = DNSCache()
+    cache._lookup = Lookups(None)
+    rows = []
+    result = check_availability(
+        "http://example.test/", 0, SimpleNamespace(put=rows.append), 5,
+        HTTPClient(dns_cache=cache), 60,
+    )
+    assert result.connection_error and result.dns_error
+    assert len(rows) == 1
+
+
+def test_circuit_opens_then_probes_then_closes(clock):
+    breaker = CircuitBreaker(threshold=2, probe_interval=60)
+    url = "http://example.test/a"
+    for _ in range(2):
+        assert breaker.allow(url)
+        breaker.record(url, failed=True)
+    assert not breaker.allow("http://example.test/b")
+    assert breaker.stats()["open"] == 1
+    clock[0] += 60
+    assert breaker.allow(url)  # The probe
+    assert not breaker.allow(url)
+    breaker.record(url, failed=True)
+    clock[0] += 59
+    assert not breaker.allow(url)
+    clock[0] += 1
+    assert breaker.allow(url)
+    breaker.record(url, failed=False)
+    assert breaker.allow(url)
+    assert breaker.stats() == {
+        "opened": 1, "closed": 1, "probes": 2, "fast_failed": 3, "open": 0
+    }
+
+
+def test_circuits_are_per_scheme_host_and_port(base_url):
+    breaker = CircuitBreaker(threshold=1, probe_interval=60)
+    client = HTTPClient(circuit_breaker=breaker)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        down_url = f"http://localhost:{s.getsockname()[1]}/data"
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.ConnectionError) as e:
+            client.get(down_url, timeout=5)
+    assert isinstance(e.value, CircuitOpenError)
+    assert client.get(f"{base_url}/data", timeout=5).status_code == 200
+    assert not breaker.allow(down_url)
+    assert breaker.allow(down_url.replace("http:", "https:"))
@@ -0,0 +1,197 @@
+import http.server
+import socketserver
+import threading
+import time
+from functools import partial
+
+from monitoring.availability import check_availability_async
+from monitoring.client import AsyncHostLimiter
+from monitoring.common import (
+    AdaptiveInterval,
+    AsyncMonitor,
+    HTTPCheckResult,
+    Monitor,
+    TargetsWatcher,
+    get_service_urls,
+)
+
+
+def test_close_waits_for_running_checks(tmp_path):
+    started = threading.Event()
+
+    def slow_check(url, url_id, sink, **kwargs):
+        started.set()
+        time.sleep(0.5)
+        sink.put([url_id, url])
+
+    output_path = tmp_path / "results.csv"
+    monitor = Monitor(["http://a"], slow_check, str(output_path), 60, timeout=5)
+    monitor.schedule_jobs()
+    monitor.scheduler.run_all()
+    assert started.wait(5)
+    monitor.close()
+    assert output_path.read_text() == "0\thttp://a\n"
+
+
+def read_lines(path):
+    with open(path) as f:
+        return [line.strip() for line in f]
+
+
+def test_targets_watcher(tmp_path):
+    targets = tmp_path / "targets.csv"
+    targets.write_text("http://a\n")
+    watcher = TargetsWatcher(str(targets), read_lines)
+    assert watcher.poll() is None
+    targets.write_text("http://a\nhttp://b\n")
+    assert watcher.poll() == ["http://a", "http://b"]
+    assert watcher.poll() is None
+    targets.unlink()
+    assert watcher.poll() is None  # Missing: the current targets stay
+
+
+def test_targets_watcher_unreadable_file(tmp_path):
+    targets = tmp_path / "targets.csv"
+    targets.write_text("http://a\n")
+    watcher = TargetsWatcher(str(targets), partial(get_service_urls, col_no=1))
+    targets.write_text("http://b\n")
+    assert watcher.poll() is None  # IndexError, logged
+    targets.write_text("x\thttp://c\n")
+    assert watcher.poll() == ["http://c"]
+
+
+def test_reload_targets(tmp_path):
+    targets = tmp_path / "targets.csv"
+    targets.write_text("http://a\nhttp://b\n")
+    output_path = str(tmp_path / "results.csv")
+    watcher = TargetsWatcher(str(targets), read_lines)
+
+    def make_monitor():
+        return Monitor(
+            read_lines(targets), lambda **kwargs: None, output_path, 60, watcher=watcher
+        )
+
+    monitor = make_monitor()
+    monitor.schedule_jobs()
+    try:
+        targets.write_text("http://b\nhttp://c\n")
+        monitor.reload_targets()
+        assert monitor.targets == {1: "http://b", 2: "http://c"}
+        assert {0, 1, 2} & set(monitor.scheduler.jobs) == {1, 2}
+        targets.write_text("http://a\nhttp://c\nhttp://d\n")
+        monitor.reload_targets()
+        assert monitor.targets == {0: "http://a", 2: "http://c", 3: "http://d"}
+    finally:
+        monitor.close(drain_timeout=0)
+    assert read_lines(f"{output_path}.urls") == [
+        "0\thttp://a",
+        "1\thttp://b",
+        "2\thttp://c",
+        "3\thttp://d",
+    ]
+    # A restarted monitor keeps the id's
+    targets.write_text("http://d\nhttp://e\n")
+    monitor = make_monitor()
+    try:
+        assert monitor.targets == {3: "http://d", 4: "http://e"}
+    finally:
+        monitor.close(drain_timeout=0)
+
+
+def test_shards_save_url_ids_concurrently(tmp_path):
+    output_path = str(tmp_path / "results")
+    watcher = TargetsWatcher(str(tmp_path / "targets.csv"), read_lines)
+    monitors = [
+        Monitor(["http://a", "http://b"], None, output_path, 60, watcher=watcher, shard=(i, 4))
+        for i in range(4)
+    ]
+    errors = []
+
+    def save(monitor):
+        try:
+            for _ in range(50):
+                monitor.save_url_ids()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save, args=(m,)) for m in monitors]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for monitor in monitors:
+        monitor.close(drain_timeout=0)
+    assert errors == []
+    assert read_lines(f"{output_path}.urls") == ["0\thttp://a", "1\thttp://b"]
+    assert list(tmp_path.glob("*.tmp")) == []
+
+
+def test_adaptive_interval_backs_off_and_recovers():
+    intervals = AdaptiveInterval(60, 300, backoff_after=3, densify_factor=2, densify_checks=3)
+    ok = HTTPCheckResult(status_code=200)
+    timeout = HTTPCheckResult(timeout=True)
+    results = [ok] + [timeout] * 6 + [ok] * 4
+    assert [intervals.next_interval(0, r) for r in results] == [
+        60,  # Steady
+        30, 30,  # Denser checks on the change
+        120, 240, 300, 300,  # Backing off, up to the maximum interval
+        30, 30, 30,  # Denser checks on recovery
+        60,
+    ]
+    assert intervals.next_interval(1, timeout) == 60
+    intervals.forget(0)
+    assert intervals.next_interval(0, timeout) == 60
+
+
+def test_adaptive_interval_densifies_on_status_changes():
+    intervals = AdaptiveInterval(60, 300, densify_checks=1)
+    statuses = [200, 200, 503, 503, 200, 404]
+    assert [
+        intervals.next_interval(0, HTTPCheckResult(status_code=s)) for s in statuses
+    ] == [60, 60, 30, 60, 30, 30]
+
+
+class OKHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"OK")
+
+
+def test_async_monitor(tmp_path):
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), OKHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    output_path = tmp_path / "results.csv"
+    monitor = AsyncMonitor(
+        [url],
+        check_availability_async,
+        str(output_path),
+        60,
+        timeout=5,
+        flush_interval=0.05,
+        max_per_host=1,
+    )
+    assert monitor.client is None
+    assert monitor.runner is None
+    assert isinstance(monitor.host_limiter, AsyncHostLimiter)
+    stop = monitor.run(interval=0.05)
+    try:
+        deadline = time.monotonic() + 5
+        while not output_path.exists() or not output_path.read_text():
+            assert time.monotonic() < deadline, "No check result written"
+            time.sleep(0.05)
+    finally:
+        stop.set()
+        monitor.close()
+        server.shutdown()
+        server.server_close()
+    rows = [line.split("\t") for line in read_lines(output_path)]
+    assert len(rows) == 1
+    assert rows[0][1:3] == ["0", "200"]
+    assert monitor.lag_stats.stats()["runs"] == 1
@@ -0,0 +1,101 @@
+import io
+
+import pytest
+from lxml import etree
+
+from monitoring.gml import (
+    canonical_fingerprint,
+    diff_features,
+    feature_diff_lines,
+    feature_hashes,
+)
+
+COLLECTION = """<?xml version="1.0" encoding="UTF-8"?>
+<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0"
+    xmlns:gml="http://www.opengis.net/gml/3.2"
+    xmlns:base="http://inspire.ec.europa.eu/schemas/base/3.3"
+    xmlns:ps="http://inspire.ec.europa.eu/schemas/ps/4.0"
+    gml:id="collection">
+  <wfs:member>
+    <base:SpatialDataSet gml:id="dataset">
+      <base:member>
+        <ps:ProtectedSite gml:id="PS_1">
+          <ps:inspireId><base:Identifier><base:localId>A</base:localId></base:Identifier></ps:inspireId>
+          <ps:geometry><gml:Point gml:id="P_1"><gml:pos>1 1</gml:pos></gml:Point></ps:geometry>
+          <ps:siteName>{a}</ps:siteName>
+        </ps:ProtectedSite>
+      </base:member>
+      <base:member>
+        <ps:ProtectedSite gml:id="PS_2">
+          <ps:inspireId><base:Identifier><base:localId>B</base:localId></base:Identifier></ps:inspireId>
+          <ps:siteName>{b}</ps:siteName>
+        </ps:ProtectedSite>
+      </base:member>
+    </base:SpatialDataSet>
+  </wfs:member>
+</wfs:FeatureCollection>
+"""
+
+
+def document(**names):
+    return io.BytesIO(COLLECTION.format(**names).encode("utf-8"))
+
+
+def test_features_in_collections_with_gml_id():
+    previous = feature_hashes(document(a="Site A", b="Site B"))
+    new = feature_hashes(document(a="Site A", b="Site B, renamed"))
+    assert sorted(previous) == ["A", "B"]
+    assert diff_features(previous, new) == ([], [], ["B"])
+
+
+def test_feature_diff_lines():
+    lines = feature_diff_lines(
+        document(a="Site A", b="Site B"), document(a="Site A, renamed", b="Site B"), "1", "2"
+    )
+    assert lines[2:] == [b"Features: 2 -> 2, 0 added, 0 removed, 1 modified", b"~ A"]
+
+
+def fingerprint(xml):
+    return canonical_fingerprint(io.BytesIO(xml.encode("utf-8")))
+
+
+def test_canonical_fingerprint_ignores_formatting():
+    original = fingerprint(COLLECTION.format(a="Site A", b="Site B"))
+    reformatted = fingerprint(
+        "<!-- Reformatted -->"
+        + COLLECTION.format(a="  Site A\n ", b="Site B")
+        .replace('<?xml version="1.0" encoding="UTF-8"?>\n', "")
+        .replace("\n    ", " ")
+        .replace("\n", "\n\n  ")
+        .replace("ps:", "sites:")
+        .replace("xmlns:ps=", "xmlns:sites=")
+        .replace('<wfs:member>', "<wfs:member><!-- Comment -->")
+    )
+    assert reformatted == original
+
+
+def test_canonical_fingerprint_ignores_attribute_order():
+    assert fingerprint('<a x="1" y="2"><b/></a>') == fingerprint(
+        "<a y='2'   x='1'><b></b></a>"
+    )
+
+
+@pytest.mark.parametrize(
+    "changed",
+    [
+        '<a x="1" y="3"><b>1</b></a>',  # Attribute value
+        '<a x="1"><b>1</b></a>',  # Attribute removed
+        '<a x="1" y="2"><b>2</b></a>',  # Text
+        '<a x="1" y="2"><c>1</c></a>',  # Element name
+        '<a xmlns="urn:other" x="1" y="2"><b>1</b></a>',  # Namespace
+        '<a x="1" y="2"><b>1</b><b/></a>',  # Element added
+        '<a x="1" y="2"><b/>1</a>',  # Text moved
+    ],
+)
+def test_canonical_fingerprint_changes_with_content(changed):
+    assert fingerprint(changed) != fingerprint('<a x="1" y="2"><b>1</b></a>')
+
+
+def test_canonical_fingerprint_of_invalid_xml():
+    with pytest.raises(etree.ParseError):
+        fingerprint("<a><b></a>")
@@ -0,0 +1,39 @@
+from datetime import datetime
+
+import pytz
+
+from monitoring.mk_availability_report import get_services, load_data, to_date
+
+
+def test_to_date():
+    assert to_date("2026-10-17T01:52:54+00:00") == datetime(
+        2026, 10, 17, 1, 52, 54, tzinfo=pytz.UTC
+    )
+    assert to_date("2026-10-17T03:52:54.500000+02:00") == datetime(
+        2026, 10, 17, 1, 52, 54, 500000, tzinfo=pytz.UTC
+    )
+    assert to_date("2026-10-17T01:52:54.500000").tzinfo == pytz.UTC
+    assert to_date("garbage") is None
+
+
+def test_load_data_skips_unreadable_timestamps(tmp_path):
+    results = tmp_path / "results.csv"
+    results.write_text(
+        "2026-10-17T01:52:54+00:00\t0\t200\t10\ttext/xml\t0.1\t\t0\t0\t60\n"
+        "garbage\t0\t200\t10\ttext/xml\t0.1\t\t0\t0\t60\n"
+        "2026-10-18T01:52:54.000001+00:00\t1\t500\t10\ttext/xml\t0.1\t\t0\t0\t60\n"
+    )
+    data = load_data(str(results), start=datetime(2026, 10, 17).date())
+    assert {url_id: len(checks) for url_id, checks in data.items()} == {0: 1, 1: 1}
+
+
+def test_get_services_reads_url_ids(tmp_path):
+    services = tmp_path / "services.csv"
+    services.write_text("FR\tGDSM\thttp://b\nFR\tGSDS\thttp://c\nDE\tGDSM\thttp://d\n")
+    urls = tmp_path / "results.csv.urls"
+    urls.write_text("0\thttp://a\n1\thttp://b\n2\thttp://c\n")
+    data, url_ids = get_services(str(services), str(urls))
+    assert data["FR"]["GSDS"] == ["http://c"]
+    assert url_ids == {"http://a": 0, "http://b": 1, "http://c": 2, "http://d": 3}
+    _, url_ids = get_services(str(services))
+    assert url_ids == {"http://b": 0, "http://c": 1, "http://d": 2}
@@ -0,0 +1,321 @@
+import hashlib
+import http.server
+import io
+import json
+import re
+import socketserver
+import sqlite3
+import threading
+import time
+import zipfile
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from monitoring import reliability
+from monitoring.blobstore import BlobStore, write_manifest
+from monitoring.client import HTTPClient
+from monitoring.gml import DIFF_TEXT
+
+CONTENT = b"<doc>" + b"<a>x</a>" * 50000 + b"</doc>"
+ETAG = f'"{hashlib.md5(CONTENT).hexdigest()}"'
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves `CONTENT`, supporting `Range` requests, and cuts the body of the
+    first `server.breaks` responses short.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(CONTENT)))
+        self.end_headers()
+
+    def do_GET(self):
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range") in (None, ETAG):
+            start = int(re.match(r"bytes=(\d+)-", range_header).group(1))
+        body = CONTENT[start:]
+        self.send_response(206 if start else 200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(body)))
+        if start:
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}"
+            )
+        self.end_headers()
+        with self.server.lock:
+            broken = self.server.breaks > 0
+            self.server.breaks -= 1
+        if broken:
+            self.wfile.write(body[: len(body) // 3])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class RangeServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    server = RangeServer(("127.0.0.1", 0), RangeHandler)
+    server.lock = threading.Lock()
+    server.breaks = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("max_per_host", [None, 1])
+def test_download_resumes_within_host_limit(server, tmp_path, monkeypatch, max_per_host):
+    monkeypatch.setattr(reliability, "RETRY_DELAY", 0)
+    server.breaks = 1
+    url = f"http://127.0.0.1:{server.server_address[1]}/data.gml"
+    client = HTTPClient(max_per_host=max_per_host)
+    result = {}
+
+    def run():
+        with client.get(url, timeout=5, stream=True) as r:
+            result["checksum"], result["validators"] = reliability.download(
+                client, url, r, tmp_path / "download", 5
+            )
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive(), "The resumed download is blocked by the host limit"
+    assert result["checksum"] == hashlib.md5(CONTENT).hexdigest()
+    assert (tmp_path / "download").read_bytes() == CONTENT
+    assert result["validators"]["ETag"] == ETAG
+    assert result["validators"]["Content-Length"] == str(len(CONTENT))
+
+
+def test_head_check_records_the_skip(server, tmp_path):
+    url = f"http://127.0.0.1:{server.server_address[1]}/data.gml"
+    client = HTTPClient()
+    for _ in range(2):
+        reliability.check_reliability(
+            SimpleNamespace(url=url), tmp_path, 5, client, head_check=True
+        )
+    db = reliability.ReliabilityDB(tmp_path)
+    try:
+        checks = db.db.execute("SELECT * FROM checks ORDER BY id").fetchall()
+    finally:
+        db.close()
+    assert [c["status"] for c in checks] == [200, 200]
+    assert [c["not_downloaded"] for c in checks] == [0, 1]
+    assert checks[0]["checksum"] == checks[1]["checksum"]
+
+
+def test_db_of_previous_versions_gets_new_columns(tmp_path):
+    db = sqlite3.connect(str(tmp_path / reliability.ReliabilityDB.file_name))
+    db.execute(
+        "CREATE TABLE checks (id INTEGER PRIMARY KEY, ts TEXT NOT NULL, checksum TEXT, "
+        "status INTEGER, timeout INTEGER NOT NULL DEFAULT 0, "
+        "conn_error INTEGER NOT NULL DEFAULT 0, content_error INTEGER NOT NULL DEFAULT 0, "
+        "circuit_open INTEGER NOT NULL DEFAULT 0, note TEXT)"
+    )
+    db.execute("INSERT INTO checks (ts, status) VALUES ('20260101_000000', 200)")
+    db.commit()
+    db.close()
+    db = reliability.ReliabilityDB(tmp_path)
+    try:
+        assert db.get_check("20260101_000000")["not_downloaded"] is False
+    finally:
+        db.close()
+
+
+def test_tinydb_data_is_migrated(tmp_path):
+    results_dir = tmp_path / "FR" / "abc"
+    results_dir.mkdir(parents=True)
+    documents = {
+        "1": {
+            "type": "metadata",
+            "country_code": "FR",
+            "service_type": "GSDS",
+            "url": "http://a",
+            "results_dir": "abc",
+            "latest_checksum": "c2",
+            "latest_changed_ts": "20200102_000000",
+        },
+        "2": {"type": "check", "ts": "20200101_000000", "checksum": "c1", "status": 200},
+        "10": {"type": "check", "ts": "20200103_000000", "status": 503, "note": "Down"},
+        "3": {
+            "type": "check",
+            "ts": "20200102_000000",
+            "checksum": "c2",
+            "status": 200,
+            "timeout": False,
+        },
+    }
+    (results_dir / "data.json").write_text(json.dumps({"_default": documents}))
+    service = reliability.ServiceMetadata("FR", "GSDS", "http://b", "abc")
+    db = reliability.ReliabilityDB.from_service(service, tmp_path)
+    try:
+        assert db.metadata == reliability.ServiceMetadata(
+            "FR",
+            "GSDS",
+            "http://a",
+            "abc",
+            latest_check_ts="20200103_000000",
+            latest_checksum="c2",
+            latest_changed_ts="20200102_000000",
+        )
+        checks = db.db.execute("SELECT ts FROM checks ORDER BY id").fetchall()
+        assert [c["ts"] for c in checks] == [
+            "20200101_000000",
+            "20200102_000000",
+            "20200103_000000",
+        ]
+        assert db.get_latest_check() == {
+            "ts": "20200103_000000",
+            "checksum": None,
+            "status": 503,
+            "timeout": False,
+            "conn_error": False,
+            "content_error": False,
+            "circuit_open": False,
+            "not_downloaded": False,
+            "note": "Down",
+        }
+        assert db.get_check("20200101_000000")["checksum"] == "c1"
+    finally:
+        db.close()
+    assert (results_dir / "data.json").exists()
+
+
+def test_fingerprint_switch_keeps_unchanged_members(tmp_path):
+    blobs = BlobStore(tmp_path / "blobs")
+    work_path = tmp_path / "work"
+
+    def snapshot(ts, contents, fingerprint, previous_dir=None):
+        zip_path = tmp_path / f"{ts}.zip"
+        with zipfile.ZipFile(str(zip_path), "w") as z:
+            for name, content in contents.items():
+                z.writestr(name, content)
+        with zipfile.ZipFile(str(zip_path)) as z:
+            members = z.infolist()
+        checksums = reliability.member_checksums(zip_path, members, fingerprint, work_path)
+        entries, lines = reliability.snapshot_members(
+            zip_path, members, checksums, previous_dir, None, ts, blobs, work_path, DIFF_TEXT
+        )
+        (tmp_path / ts).mkdir()
+        write_manifest(tmp_path / ts, entries)
+        return lines
+
+    snapshot("1", {"a.xml": b"<a>1</a>", "b.xml": b"<b>1</b>"}, "pretty")
+    lines = snapshot(
+        "2", {"a.xml": b"<a>1</a>", "b.xml": b"<b>2</b>"}, "canonical", tmp_path / "1"
+    )
+    assert lines[0] == b"Members: 2 -> 2, 0 added, 0 removed, 1 modified"
+    assert b"~ b.xml" in lines
+
+
+class ContentHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves `server.content`, whatever the path.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.server.content)))
+        self.end_headers()
+        self.wfile.write(self.server.content)
+
+
+def zip_content(members):
+    path_content = io.BytesIO()
+    with zipfile.ZipFile(path_content, "w") as z:
+        for name, content in members.items():
+            z.writestr(name, content)
+    return path_content.getvalue()
+
+
+class Clock(datetime):
+    """
+    Ticks a second each time it is read, so checks get distinct timestamps.
+    """
+
+    now = datetime(2026, 1, 1)
+
+    @classmethod
+    def utcnow(cls):
+        cls.now += timedelta(seconds=1)
+        return cls.now
+
+
+def test_zip_reduced_to_a_single_member(tmp_path, monkeypatch):
+    monkeypatch.setattr(reliability, "datetime", Clock)
+    server = socketserver.TCPServer(("127.0.0.1", 0), ContentHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/f.zip"
+    service = SimpleNamespace(url=url)
+    client = HTTPClient()
+    try:
+        server.content = zip_content({"a.xml": b"<a>1</a>", "b.xml": b"<b>1</b>"})
+        reliability.check_reliability(service, tmp_path, 5, client)
+        for content in (b"<a>2</a>", b"<a>3</a>"):
+            server.content = zip_content({"a.xml": content})
+            reliability.check_reliability(service, tmp_path, 5, client)
+    finally:
+        server.shutdown()
+        server.server_close()
+    db = reliability.ReliabilityDB(tmp_path)
+    try:
+        checks = db.db.execute("SELECT checksum FROM checks ORDER BY id").fetchall()
+        latest_changed_ts = db.latest_changed_ts
+        assert db.latest_checksum == checks[-1]["checksum"]
+        assert db.latest_changed_file_name == "a.xml"
+    finally:
+        db.close()
+    assert len({c["checksum"] for c in checks}) == 3
+    snapshots = sorted(p for p in tmp_path.iterdir() if p.is_dir() and p.name != "blobs")
+    assert len(snapshots) == 3
+    assert snapshots[-1].name == latest_changed_ts
+    assert b"+<a>2</a>" in (snapshots[1] / "diff").read_bytes()
+    assert b"+<a>3</a>" in (snapshots[2] / "diff").read_bytes()
+
+
+def test_close_waits_for_running_checks(tmp_path):
+    services = tmp_path / "services.csv"
+    services.write_text("FR\tGDSM\thttp://a\n")
+    started = threading.Event()
+    done = []
+
+    def slow_check(**kwargs):
+        started.set()
+        time.sleep(0.5)
+        done.append(kwargs["service"].url)
+
+    state_path = tmp_path / "state.json"
+    monitor = reliability.ReliabilityMonitor(
+        str(services), slow_check, str(tmp_path / "out"), 60, timeout=5,
+        state_path=str(state_path),
+    )
+    monitor.schedule_jobs()
+    monitor.scheduler.run_all()
+    assert started.wait(5)
+    monitor.close()
+    assert done == ["http://a"]
+    assert state_path.exists()
+    monitor.scheduler.run_all()  # Checks due once closed do not start
+    time.sleep(0.1)
+    assert done == ["http://a"]
@@ -0,0 +1,56 @@
+import threading
+import time
+
+from monitoring.scheduler import BoundedJobRunner, HeapScheduler, LagStats
+
+
+def test_runner_records_lag_when_jobs_start():
+    lag_stats = LagStats()
+    runner = BoundedJobRunner(1, max_queue=1, lag_stats=lag_stats)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    now = time.monotonic()
+    assert runner.submit("a", block, run_at=now)
+    started.wait(5)
+    assert runner.submit("b", lambda: None, run_at=now)
+    assert not runner.submit("c", lambda: None, run_at=now)  # Queue full
+    time.sleep(0.2)
+    release.set()
+    while runner.stats()["completed"] < 2:
+        time.sleep(0.01)
+    stats = lag_stats.stats()
+    assert stats["runs"] == 2
+    assert stats["missed"] == 1
+    assert stats["max"] >= 0.2  # b waited for a worker
+
+
+def test_scheduler_leaves_lag_to_the_runner():
+    scheduler = HeapScheduler()
+    runner = BoundedJobRunner(1, lag_stats=scheduler.lag_stats)
+    done = threading.Event()
+    scheduler.add("a", 60, runner.submit, "a", done.set, offset=0, records_lag=True)
+    stop = scheduler.run_continuously(interval=0.05)
+    try:
+        assert done.wait(5)
+    finally:
+        stop.set()
+    assert scheduler.lag_stats.stats()["runs"] == 1
+
+
+def test_runner_counts_failures_apart():
+    runner = BoundedJobRunner(2)
+
+    def fail():
+        raise RuntimeError("Expected")
+
+    runner.submit("a", fail)
+    runner.submit("b", lambda: None)
+    while runner.stats()["running"] or runner.stats()["pending"]:
+        time.sleep(0.01)
+    stats = runner.stats()
+    assert (stats["completed"], stats["failed"]) == (1, 1)
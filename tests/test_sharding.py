@@ -0,0 +1,18 @@
+import argparse
+
+import pytest
+
+from monitoring.sharding import parse_shard
+
+
+def test_parse_shard():
+    assert parse_shard("2/8") == (2, 8)
+
+
+@pytest.mark.parametrize("value", ["2", "a/8", "8/8"])
+def test_parse_shard_message(value, capsys):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shard", type=parse_shard)
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--shard", value])
+    assert f"Invalid shard: {value}" in capsys.readouterr().err
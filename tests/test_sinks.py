@@ -0,0 +1,50 @@
+import time
+from datetime import datetime
+
+import pytz
+
+from monitoring.mk_availability_report import load_data
+from monitoring.sinks import CSVResultSink, ParquetResultSink
+
+
+def row(url_id):
+    return [datetime.now(pytz.UTC), url_id, 200, 10, "text/xml", 0.1, None, 0, 0, 60.0] + [
+        None
+    ] * 6
+
+
+def test_parquet_file_is_published_once_closed(tmp_path):
+    sink = ParquetResultSink(str(tmp_path), batch_size=1, flush_interval=0.01)
+    sink.put(row(0))
+    time.sleep(0.5)
+    assert list(tmp_path.glob("date=*/*.parquet")) == []
+    assert load_data(str(tmp_path)) == {}
+    sink.close()
+    assert len(list(tmp_path.glob("date=*/*.parquet"))) == 1
+    assert list(tmp_path.glob("date=*/*.tmp")) == []
+    assert list(load_data(str(tmp_path))) == [0]
+
+
+class FlakyCSVResultSink(CSVResultSink):
+    """
+    Fails to write its first batch.
+    """
+
+    failures = 1
+
+    def write_batch(self, rows):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("No space left on device")
+        super().write_batch(rows)
+
+
+def test_writer_survives_a_failed_batch(tmp_path):
+    results = tmp_path / "results.csv"
+    sink = FlakyCSVResultSink(str(results), batch_size=1, flush_interval=0.01)
+    sink.put(row(0))
+    time.sleep(0.5)
+    assert sink.writer_thread.is_alive()
+    sink.put(row(1))
+    sink.close()
+    assert list(load_data(str(results))) == [1]